@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+"""
+Бенчмарки хранения, поиска и операций с графом друзей на синтетических данных
+
+Данные генерируются детерминированно (одинаковые при каждом запуске), поэтому
+результаты разных версий бота можно сравнивать между собой.
+
+Запуск:
+    python bench.py                        # 1k и 100k пользователей
+    python bench.py --sizes 1k,100k,1m     # 1M пользователей требует нескольких ГБ памяти
+    python bench.py --save-baseline        # Записать результаты как эталон
+
+При первом запуске результаты сохраняются в bench_baseline.json. Последующие
+запуски сравниваются с ним; если операция стала медленнее эталона больше чем
+на --tolerance, скрипт завершается с кодом 1 (удобно перед деплоем).
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+
+# Бенчмарк не подключается к Telegram, токен нужен только для импорта модуля бота
+os.environ.setdefault('BOT_TOKEN', '0:bench')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+import bot  # noqa: E402
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_baseline.json')
+SIZE_SUFFIXES = {'k': 1_000, 'm': 1_000_000}
+# Сколько раз повторяется каждая операция (берется лучший результат - он меньше всего зависит от шума)
+REPEATS = {1_000: 20, 100_000: 5, 1_000_000: 2}
+# Разница меньше этой считается шумом, даже если в процентах она большая
+MIN_REGRESSION_SECONDS = 0.002
+
+FIRST_NAMES = [
+    "Александр", "Анна", "Мария", "Дмитрий", "Екатерина", "Иван", "Ольга", "Сергей",
+    "Наталья", "Андрей", "Елена", "Алексей", "Татьяна", "Михаил", "Юлия", "Никита",
+    "Анастасия", "Павел", "Светлана", "Артём", "Ксения", "Максим", "Дарья", "Кирилл",
+    "Полина", "Егор", "Виктория", "Роман", "Алина", "Илья"
+]
+LAST_NAMES = [
+    "Иванов", "Смирнова", "Кузнецов", "Попова", "Васильев", "Петрова", "Соколов",
+    "Михайлова", "Новиков", "Фёдорова", "Морозов", "Волкова", "Алексеев", "Лебедева",
+    "Семёнов", "Егорова", "Павлов", "Козлова", "Степанов", "Николаева", ""
+]
+WALK_SCHEDULES = [
+    "будни 7:00-8:00, 20:00-21:00", "ежедневно 8-9", "выходные 10-12", "пн, ср, пт 19:00-20:30",
+    "будни 6:30-7:30", "ежедневно 21-22", "сб, вс 9-11; будни 19-20"
+]
+USERNAME_WORDS = [
+    "dog", "walker", "sharik", "bobik", "laika", "husky", "corgi", "pes", "lapa",
+    "hvost", "guliaem", "park", "volk", "mops", "taksa", "spaniel"
+]
+
+
+def parse_size(text):
+    """'1k' -> 1000, '100k' -> 100000, '1m' -> 1000000"""
+    text = text.strip().lower()
+    if text[-1] in SIZE_SUFFIXES:
+        return int(float(text[:-1]) * SIZE_SUFFIXES[text[-1]])
+    return int(text)
+
+
+def format_size(count):
+    for suffix, factor in sorted(SIZE_SUFFIXES.items(), key=lambda item: -item[1]):
+        if count >= factor and count % factor == 0:
+            return f"{count // factor}{suffix}"
+    return str(count)
+
+
+def get_catalog_places():
+    """Все места для прогулок из каталога бота (районы крупных городов идут первыми)"""
+    places = []
+    for region in bot.get_regions_list():
+        for district in bot.get_districts_by_region(region):
+            for place in bot.get_walking_places_by_district(region, district):
+                if place not in places:
+                    places.append(place)
+    return places
+
+
+def generate_users(count, seed=42):
+    """
+    Генерирует user_data и friend_requests в формате бота
+
+    Распределения: у 70% есть username, у 60% - телефон (80% из них подтверждены),
+    популярность мест - по закону Ципфа, число друзей - логнормальное (медиана ~4,
+    длинный хвост до 500).
+    """
+    rng = random.Random(seed * 1_000_003 + count)
+    user_ids = [100_000_000 + index * 7 for index in range(count)]
+    places = get_catalog_places()
+    place_weights = [1 / rank for rank in range(1, len(places) + 1)]
+
+    users = {}
+    for user_id in user_ids:
+        first_name = rng.choice(FIRST_NAMES)
+        last_name = rng.choice(LAST_NAMES)
+        username = None
+        if rng.random() < 0.7:
+            username = f"{rng.choice(USERNAME_WORDS)}_{rng.choice(USERNAME_WORDS)}{rng.randint(1, 9999)}"
+
+        phone_number = None
+        phone_verified = False
+        if rng.random() < 0.6:
+            phone_number = f"79{rng.randint(0, 999_999_999):09d}"
+            phone_verified = rng.random() < 0.8
+
+        roll = rng.random()
+        if roll < 0.7:
+            walking_location = rng.choices(places, weights=place_weights)[0]
+        elif roll < 0.85:
+            walking_location = f"{rng.uniform(55.5, 56.0):.6f}, {rng.uniform(37.3, 37.9):.6f}"
+        else:
+            walking_location = None
+
+        users[user_id] = {
+            'first_name': first_name,
+            'last_name': last_name,
+            'username': username,
+            'walking_location': walking_location,
+            'pet_photo_id': None,
+            'friends': [],
+            'phone_number': phone_number,
+            'phone_verified': phone_verified
+        }
+
+    # Дружба взаимная: ребро добавляется обоим пользователям
+    for user_id in user_ids:
+        degree = min(int(rng.lognormvariate(1.4, 1.0)), 500, count - 1)
+        friends = users[user_id]['friends']
+        if len(friends) >= degree:
+            continue
+        known = {friend['user_id'] for friend in friends}
+        for _ in range(degree - len(friends)):
+            friend_id = user_ids[rng.randrange(count)]
+            if friend_id == user_id or friend_id in known:
+                continue
+            known.add(friend_id)
+            friends.append({'user_id': friend_id, 'name': users[friend_id]['first_name']})
+            users[friend_id]['friends'].append({'user_id': user_id, 'name': users[user_id]['first_name']})
+
+    # Входящие запросы в друзья: {кому: [от кого]}
+    friend_requests = {}
+    for user_id in user_ids:
+        if rng.random() < 0.05:
+            friend_requests[user_id] = [user_ids[rng.randrange(count)] for _ in range(rng.randint(1, 3))]
+
+    return users, friend_requests
+
+
+def add_walk_schedules(users, seed=7):
+    """Расписания прогулок половине пользователей (отдельный генератор, чтобы не менять остальные данные)"""
+    rng = random.Random(seed * 1_000_003 + len(users))
+    schedules = [bot.parse_walk_windows(text) for text in WALK_SCHEDULES]
+    for user_info in users.values():
+        if rng.random() < 0.5:
+            user_info['walk_windows'] = rng.choice(schedules)
+
+
+def measure(func, repeats, setup=None):
+    """Лучшее время выполнения func за repeats запусков"""
+    durations = []
+    for _ in range(repeats):
+        arguments = (setup(),) if setup else ()
+        started = time.perf_counter()
+        func(*arguments)
+        durations.append(time.perf_counter() - started)
+    return min(durations)
+
+
+def run_size(count, data_dir):
+    """Прогоняет все бенчмарки для count пользователей. Возвращает {операция: секунды}"""
+    repeats = REPEATS.get(count, 3)
+    started = time.perf_counter()
+    users, friend_requests = generate_users(count)
+    add_walk_schedules(users)
+    print(f"\n== {format_size(count)} пользователей "
+          f"(генерация {time.perf_counter() - started:.1f} с, повторов: {repeats})")
+
+    rng = random.Random(count)
+    user_ids = list(users)
+    searcher_id = user_ids[0]
+    with_phone = [uid for uid in user_ids[:10_000] if users[uid]['phone_number']]
+    phone_owner = rng.choice(with_phone)
+    phone_number = users[phone_owner]['phone_number']
+    with_username = [uid for uid in user_ids[:10_000] if users[uid]['username']]
+    username = users[rng.choice(with_username)]['username']
+
+    bot.DATA_FILE = os.path.join(data_dir, f"user_data_{count}.json")
+    bot.user_data = users
+    bot.friend_requests = friend_requests
+
+    results = {}
+    results['save_user_data'] = measure(bot.write_user_data, repeats)
+    results['load_user_data'] = measure(bot.load_user_data, repeats)
+    users = bot.user_data
+
+    def search(query):
+        parsed_query, normalized_phone = bot.parse_search_query(query)
+        return lambda: bot.find_matching_users(users, parsed_query, normalized_phone, searcher_id)
+
+    results['search_first_name'] = measure(search("Екатер"), repeats)
+    results['search_username'] = measure(search('@' + username[:8]), repeats)
+    results['search_phone'] = measure(search('8' + phone_number[1:]), repeats)
+    results['search_miss'] = measure(search("несуществующий"), repeats)
+    results['contact_phone_scan'] = measure(
+        lambda: bot.find_users_with_phone(users, phone_number, searcher_id), repeats
+    )
+    results['location_choice_scan'] = measure(
+        lambda: bot.find_users_in_location(users, "Парк Горького", searcher_id), repeats
+    )
+
+    bot.walk_partners.radius = bot.WALK_PARTNER_RADIUS_METERS
+    results['walk_partners_build'] = measure(bot.walk_partners.build, repeats)
+    partner_id = next(
+        uid for uid in user_ids
+        if users[uid].get('walk_windows') and users[uid].get('walking_location') == "Парк Горького"
+    )
+    results['find_company'] = measure(lambda: bot.walk_partners.find(partner_id, users[partner_id]), repeats)
+
+    # Большой город: у каждого координаты в пределах Москвы, рядом с центром - сотни соседей
+    city_rng = random.Random(count)
+    schedules = [bot.parse_walk_windows(text) for text in WALK_SCHEDULES]
+    city = bot.WalkPartnerIndex(bot.WALK_PARTNER_RADIUS_METERS, 0)
+    for uid in user_ids:
+        city.update(uid, {
+            'walk_windows': city_rng.choice(schedules),
+            'walking_location_lat': city_rng.uniform(55.5, 56.0),
+            'walking_location_lon': city_rng.uniform(37.3, 37.9)
+        })
+    center_user = {'walk_windows': schedules[0], 'walking_location_lat': 55.75, 'walking_location_lon': 37.6}
+    results['find_company_city'] = measure(lambda: city.find(user_ids[0], center_user), repeats)
+
+    # "Возможно, вы знакомы": первый просмотр считает счетчики, повторные берут их из памяти
+    suggester_id = max(user_ids[:1000], key=lambda uid: len(users[uid]['friends']))
+    results['friend_suggestions_first'] = measure(
+        lambda: bot.FriendSuggestions(10, 0).suggest(suggester_id, bot.FRIEND_SUGGESTIONS_LIMIT), repeats
+    )
+    suggestions = bot.FriendSuggestions(10, 0)
+    suggestions.counts(suggester_id)
+    results['friend_suggestions_cached'] = measure(
+        lambda: suggestions.suggest(suggester_id, bot.FRIEND_SUGGESTIONS_LIMIT), repeats
+    )
+
+    # Ветклиники и зоомагазины: по точке на пользователя в той же области, что и места с координатами
+    pois = []
+    for index in range(count):
+        lat, lon = rng.uniform(55.5, 56.0), rng.uniform(37.3, 37.9)
+        pois.append(((lat, lon), {'name': f"Место {index}", 'lat': lat, 'lon': lon}))
+    results['poi_tree_build'] = measure(lambda: bot.KDTree(pois), repeats)
+    tree = bot.KDTree(pois)
+    results['poi_nearest'] = measure(
+        lambda: tree.nearest(55.75, 37.6, bot.POI_NEAREST_COUNT, bot.POI_MAX_DISTANCE_METERS), repeats
+    )
+
+    # Поиск мест в inline-режиме: по месту на пользователя, кеш отключен (каждый запрос - промах)
+    place_kinds = ("Парк", "Сквер", "Сад", "Бульвар", "Набережная", "Лесопарк")
+    places = [
+        (f"Регион {index % 50}", f"Район {rng.choice(LAST_NAMES)}", f"{rng.choice(place_kinds)} {rng.choice(FIRST_NAMES)} {index}", None, None)
+        for index in range(count)
+    ]
+    results['inline_index_build'] = measure(lambda: bot.PlaceSearchIndex(places, bot.INLINE_SEARCH_RESULTS, 0), repeats)
+    search_index = bot.PlaceSearchIndex(places, bot.INLINE_SEARCH_RESULTS, 0)
+    results['inline_search_prefix'] = measure(lambda: search_index.search("парк екат"), repeats)
+    results['inline_search_typo'] = measure(lambda: search_index.search("сквир екатирина"), repeats)
+
+    # Каждый повтор удаляет другого пользователя с друзьями: кто дружит с ним, берется из обратного индекса
+    followers = bot.FriendFollowers(0)
+    results['friend_followers_build'] = measure(followers.build, repeats)
+    victims = iter(uid for uid in user_ids[1:] if users[uid]['friends'])
+
+    def delete_cascade(victim):
+        affected = followers.followers(victim)
+        bot.delete_user_records(users, bot.friend_requests, victim, affected)
+        followers.update(victim, None)
+        for follower_id in affected:
+            followers.update(follower_id, users.get(follower_id))
+
+    results['admin_delete_cascade'] = measure(delete_cascade, repeats, setup=lambda: next(victims))
+
+    os.remove(bot.DATA_FILE)
+    for name, seconds in results.items():
+        print(f"  {name:<24} {seconds * 1000:10.2f} мс")
+    return results
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    """Печатает сравнение с эталоном. Возвращает список регрессий"""
+    regressions = []
+    print(f"\n== Сравнение с {os.path.basename(BASELINE_FILE)} (допуск {tolerance:.0%})")
+    for size, operations in results.items():
+        baseline_operations = baseline.get('results', {}).get(size)
+        if not baseline_operations:
+            print(f"  {size}: нет эталона")
+            continue
+        for name, seconds in operations.items():
+            reference = baseline_operations.get(name)
+            if not reference:
+                continue
+            ratio = seconds / reference
+            regressed = ratio > 1 + tolerance and seconds - reference > MIN_REGRESSION_SECONDS
+            marker = "  << РЕГРЕССИЯ" if regressed else ""
+            print(f"  {size:>5} {name:<24} {reference * 1000:10.2f} -> {seconds * 1000:10.2f} мс ({ratio:5.2f}x){marker}")
+            if regressed:
+                regressions.append(f"{size}/{name}")
+    return regressions
+
+
+def save_baseline(results):
+    baseline = {
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'results': results
+    }
+    with open(BASELINE_FILE, 'w', encoding='utf-8') as f:
+        json.dump(baseline, f, ensure_ascii=False, indent=2)
+    print(f"\nЭталон сохранен в {BASELINE_FILE}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки бота на синтетических данных")
+    parser.add_argument('--sizes', default='1k,100k', help="Размеры базы через запятую: 1k,100k,1m")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="Допустимое замедление (0.25 = 25%%)")
+    parser.add_argument('--save-baseline', action='store_true', help="Записать результаты как новый эталон")
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='bot-bench-') as data_dir:
+        for count in (parse_size(size) for size in args.sizes.split(',')):
+            results[format_size(count)] = run_size(count, data_dir)
+
+    if args.save_baseline or not os.path.exists(BASELINE_FILE):
+        save_baseline(results)
+        return 0
+
+    with open(BASELINE_FILE, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    regressions = compare_with_baseline(results, baseline, args.tolerance)
+    if regressions:
+        print(f"\nОбнаружены регрессии: {', '.join(regressions)}")
+        return 1
+    print("\nРегрессий нет")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,28 +1,162 @@
 import os
+import re
+import gzip
+import hashlib
 import json
+import hmac
+import signal
+import asyncio
+import atexit
+import bisect
 import logging
+import logging.handlers
+import math
+import queue
 import random
 import time
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRemove
+import contextlib
+import contextvars
+import heapq
+import itertools
+import multiprocessing
+import sqlite3
+import sys
+import threading
+import zlib
+from array import array
+from collections import Counter, OrderedDict, deque
+from collections.abc import MutableMapping
+from datetime import datetime, timedelta
+from functools import partial, wraps
+from zoneinfo import ZoneInfo
+from telegram import (
+    Bot,
+    Update,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    InlineQueryResultArticle,
+    InlineQueryResultVenue,
+    InputTextMessageContent,
+    KeyboardButton,
+    ReplyKeyboardMarkup,
+    ReplyKeyboardRemove
+)
 from telegram.ext import (
     Application,
+    BasePersistence,
+    BaseUpdateProcessor,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
+    InlineQueryHandler,
     ContextTypes,
     ConversationHandler,
+    ApplicationHandlerStop,
+    PersistenceInput,
+    TypeHandler,
+    Updater,
     filters
 )
+from telegram.request import HTTPXRequest
 from dotenv import load_dotenv  # pyright: ignore[reportMissingImports]
 
 # Загружаем переменные окружения
 load_dotenv()
 
-# Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+# Настройка логирования: обработчики пишут записи в очередь, а в поток вывода
+# их переносит отдельный поток QueueListener, поэтому медленный диск не блокирует бота
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text').lower()  # text или json
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_DEBUG_SAMPLE_RATE = float(os.getenv('LOG_DEBUG_SAMPLE_RATE', '0.01'))  # Доля DEBUG-записей, попадающих в лог
+LOG_TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+# Структурные поля записи: заполняются из контекста обработчика или через extra=
+LOG_CONTEXT_FIELDS = ('user_id', 'route', 'duration_ms')
+
+# Контекст текущего обновления для записей лога: {'user_id': ..., 'route': ...}
+log_context = contextvars.ContextVar('log_context', default=None)
+
+
+class LogContextFilter(logging.Filter):
+    """Добавляет в запись поля контекста текущего обновления"""
+    
+    def filter(self, record):
+        context = log_context.get()
+        if context:
+            for name, value in context.items():
+                if not hasattr(record, name):
+                    setattr(record, name, value)
+        return True
+
+
+class DebugSamplingFilter(logging.Filter):
+    """Пропускает только долю rate записей уровня DEBUG - частые события не забивают лог"""
+    
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+    
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or random.random() < self.rate
+
+
+class JsonLogFormatter(logging.Formatter):
+    """Одна запись - одна строка JSON"""
+    
+    def format(self, record):
+        entry = {
+            'ts': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        for name in LOG_CONTEXT_FIELDS:
+            value = getattr(record, name, None)
+            if value is not None:
+                entry[name] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class StructuredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, сохраняющий исключение для форматирования в потоке вывода"""
+    
+    def prepare(self, record):
+        # Сообщение форматируется здесь, в вызывающем потоке, - аргументы еще не изменились.
+        # Трассировка превращается в текст, а саму запись форматирует обработчик вывода.
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def setup_logging():
+    """Настраивает неблокирующее логирование через очередь"""
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(JsonLogFormatter() if LOG_FORMAT == 'json' else logging.Formatter(LOG_TEXT_FORMAT))
+    
+    log_queue = queue.SimpleQueue()
+    queue_handler = StructuredQueueHandler(log_queue)
+    queue_handler.addFilter(LogContextFilter())
+    queue_handler.addFilter(DebugSamplingFilter(LOG_DEBUG_SAMPLE_RATE))
+    
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    # httpx пишет INFO-запись на каждый запрос к Bot API, включая getUpdates
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+
+setup_logging()
 logger = logging.getLogger(__name__)
 
 # Получаем токен бота из переменных окружения
@@ -33,223 +167,1943 @@ YANDEX_GEOCODER_API_KEY = os.getenv('YANDEX_GEOCODER_API_KEY')  # Опциона
 if not BOT_TOKEN:
     raise ValueError("BOT_TOKEN не найден! Убедитесь, что вы создали .env файл с токеном.")
 
+# Адрес Bot API (к нему дописывается токен). Для нагрузочных тестов указывается
+# локальный сервер из fake_bot_api.py
+TELEGRAM_API_BASE_URL = os.getenv('TELEGRAM_API_BASE_URL', 'https://api.telegram.org/bot')
+
+# Режим получения обновлений: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv('BOT_MODE', 'polling').lower()
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # Публичный URL вебхука; если не указан, setWebhook не вызывается
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '127.0.0.1')  # Адрес встроенного HTTP-сервера
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_SECRET_TOKEN = os.getenv('WEBHOOK_SECRET_TOKEN')  # Проверяется в заголовке X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_MAX_BODY_SIZE = 1024 * 1024  # Обновления Telegram заметно меньше 1 МБ
+
+# Типы обновлений, которые бот действительно обрабатывает
+# (правки сообщений - это новые позиции живой геопозиции, inline-запросы - поиск мест)
+ALLOWED_UPDATES = [Update.MESSAGE, Update.EDITED_MESSAGE, Update.CALLBACK_QUERY, Update.INLINE_QUERY]
+
+# Сколько обновлений разных пользователей обрабатывается одновременно
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '64'))
+
+# Число процессов-воркеров. При значении больше 1 основной процесс только принимает
+# обновления и распределяет их по воркерам по хешу ID пользователя
+BOT_WORKERS = int(os.getenv('BOT_WORKERS', '1'))
+STATE_DB_FILE = os.getenv('STATE_DB_FILE', 'bot_state.sqlite3')  # Общая SQLite-база состояния
+
+# Журнал обработки обновлений: после перезапуска необработанные обновления
+# обрабатываются заново, а уже обработанные повторы от Telegram пропускаются
+UPDATE_JOURNAL_KEEP = int(os.getenv('UPDATE_JOURNAL_KEEP', '10000'))  # Сколько ID обработанных обновлений помнить
+UPDATE_JOURNAL_FLUSH_INTERVAL = float(os.getenv('UPDATE_JOURNAL_FLUSH_INTERVAL', '1'))
+
+# Сохранение сессий (context.user_data и состояний диалогов) между перезапусками
+SESSION_PERSISTENCE = os.getenv('SESSION_PERSISTENCE', '1') == '1'
+PERSISTENCE_UPDATE_INTERVAL = float(os.getenv('PERSISTENCE_UPDATE_INTERVAL', '5'))  # Секунды между записями
+
+# Вытеснение неактивных сессий из памяти
+SESSION_TTL = float(os.getenv('SESSION_TTL', str(6 * 3600)))  # Секунды без активности до вытеснения
+SESSION_SWEEP_INTERVAL = float(os.getenv('SESSION_SWEEP_INTERVAL', '60'))
+
+# Коды подтверждения телефона
+VERIFICATION_CODE_TTL = 300  # 5 минут
+VERIFICATION_MAX_ATTEMPTS = int(os.getenv('VERIFICATION_MAX_ATTEMPTS', '5'))
+VERIFICATION_MAX_CODES = int(os.getenv('VERIFICATION_MAX_CODES', '10000'))  # Предел памяти при спаме контактами
+VERIFICATION_CODES_PERSIST = os.getenv('VERIFICATION_CODES_PERSIST', '0') == '1'
+
+# Ограничение частоты запросов: ведро на RATE_LIMIT_CAPACITY токенов,
+# пополняется на RATE_LIMIT_REFILL_PER_SECOND токенов в секунду
+RATE_LIMIT_CAPACITY = float(os.getenv('RATE_LIMIT_CAPACITY', '10'))
+RATE_LIMIT_REFILL_PER_SECOND = float(os.getenv('RATE_LIMIT_REFILL_PER_SECOND', '1'))
+CALLBACK_DEBOUNCE_SECONDS = float(os.getenv('CALLBACK_DEBOUNCE_SECONDS', '0.7'))  # Повторное нажатие той же кнопки
+# Стоимость дорогих маршрутов в токенах (остальные запросы стоят 1 токен)
+RATE_LIMIT_CALLBACK_COSTS = {
+    'select_walking_place_': 2,  # Геокодер
+    'share_place_to_': 2,
+    'invite_to_walk': 5,  # Рассылка всем друзьям
+    'admin_list_subscribers': 2
+}
+RATE_LIMIT_SEARCH_COST = 3  # Поиск пользователя - полный проход по базе
+RATE_LIMIT_CONTACT_COST = 3  # Проход по базе в поисках такого же номера и сохранение
+
+# Метрики в формате Prometheus на http://METRICS_LISTEN:METRICS_PORT/metrics (0 - отключено).
+# В режиме воркеров воркер N слушает порт METRICS_PORT + N.
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9108'))
+# Границы корзин гистограмм задержек, секунды
+SLOW_HANDLER_SECONDS = float(os.getenv('SLOW_HANDLER_SECONDS', '1'))  # Более медленные обработчики пишутся в лог
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Контроль задержки цикла событий и отключение дорогих функций под нагрузкой.
+# Уровень повышается сразу при превышении порога, а понижается только после
+# LOOP_LAG_RECOVERY_SECONDS спокойной работы.
+LOOP_LAG_PROBE_INTERVAL = float(os.getenv('LOOP_LAG_PROBE_INTERVAL', '0.25'))
+LOOP_LAG_DEGRADED_SECONDS = float(os.getenv('LOOP_LAG_DEGRADED_SECONDS', '0.1'))  # Без геокодера, рассылки медленнее
+LOOP_LAG_CRITICAL_SECONDS = float(os.getenv('LOOP_LAG_CRITICAL_SECONDS', '0.5'))  # Плюс отложенное сохранение
+LOOP_LAG_RECOVERY_SECONDS = float(os.getenv('LOOP_LAG_RECOVERY_SECONDS', '15'))
+LOAD_SHED_MAX_SAVE_DELAY = float(os.getenv('LOAD_SHED_MAX_SAVE_DELAY', '60'))  # Дольше сохранение не откладывается
+BROADCAST_DELAYS = (0, 0.1, 0.5)  # Пауза между сообщениями рассылки на каждом уровне нагрузки
+
+# Профилирование из меню администратора: сэмплирование стека основного потока
+PROFILE_DURATION_SECONDS = float(os.getenv('PROFILE_DURATION_SECONDS', '30'))
+PROFILE_SAMPLE_INTERVAL = float(os.getenv('PROFILE_SAMPLE_INTERVAL', '0.005'))
+PROFILE_REPORT_TOP = 15  # Функций в отчете на каждый маршрут
+
+# Режим "Я гуляю сейчас": живая геопозиция Telegram (правка сообщения каждые несколько секунд)
+LIVE_WALK_RADIUS_METERS = float(os.getenv('LIVE_WALK_RADIUS_METERS', '500'))  # Друзья ближе получают уведомление
+LIVE_WALK_TICK_SECONDS = float(os.getenv('LIVE_WALK_TICK_SECONDS', '2'))  # Как часто последние позиции попадают в индекс
+LIVE_WALK_IDLE_TIMEOUT = float(os.getenv('LIVE_WALK_IDLE_TIMEOUT', '900'))  # Прогулка без новых позиций завершается
+LIVE_WALK_PERSIST_INTERVAL = float(os.getenv('LIVE_WALK_PERSIST_INTERVAL', '30'))  # Секунды между записями в базу
+# Треки прогулок
+TRACK_MIN_STEP_METERS = float(os.getenv('TRACK_MIN_STEP_METERS', '5'))  # Меньшие сдвиги считаются шумом GPS и не попадают в трек
+TRACK_SIMPLIFY_METERS = float(os.getenv('TRACK_SIMPLIFY_METERS', '10'))  # Допуск упрощения Дугласа - Пекера
+WALK_HISTORY_WEEKS = 4  # Недель на экране "Мои прогулки"
+# Поиск компании по расписанию прогулок ("Найти компанию")
+WALK_PARTNER_RADIUS_METERS = float(os.getenv('WALK_PARTNER_RADIUS_METERS', '3000'))  # Кто гуляет дальше - не рядом
+WALK_PARTNER_PAGE_SIZE = 5
+WALK_WINDOWS_MAX = 28  # Окон прогулок в неделю у одного пользователя
+WALK_PARTNER_CHANGES_KEEP = 10000  # Изменений профилей, которые хранятся для воркеров
+# "Возможно, вы знакомы": друзья друзей
+FRIEND_SUGGESTIONS_CACHE_USERS = int(os.getenv('FRIEND_SUGGESTIONS_CACHE_USERS', '10000'))  # Счетчики в памяти
+FRIEND_SUGGESTIONS_LIMIT = 20
+FRIEND_SUGGESTIONS_PAGE_SIZE = 5
+FRIEND_GRAPH_CHANGES_KEEP = 10000  # Изменений списков друзей, которые хранятся для воркеров
+# Запланированные прогулки: приглашения с ответами и напоминания
+SCHEDULE_TZ = ZoneInfo(os.getenv('SCHEDULE_TZ', 'Europe/Moscow'))  # В этом поясе пользователи вводят и видят время
+WALK_REMINDER_MINUTES = [int(value) for value in os.getenv('WALK_REMINDER_MINUTES', '60,15').split(',') if value.strip()]
+WALK_PLAN_MAX_DAYS = 30  # Дальше вперед прогулку назначить нельзя
+WALK_PLAN_KEEP_DAYS = 7  # Сколько дней хранятся прошедшие прогулки
+# Ветклиники и зоомагазины: локальный файл точек, без запросов к внешним API
+POI_FILE = os.getenv('POI_FILE', 'pois.json')
+POI_NEAREST_COUNT = 5  # Сколько ближайших мест показывать
+POI_MAX_DISTANCE_METERS = float(os.getenv('POI_MAX_DISTANCE_METERS', '30000'))  # Дальние места не показываются
+# Каталог мест для прогулок (регионы, районы, места): файл import_places.py,
+# перечитывается без перезапуска по /reload_places или при изменении файла
+PLACES_FILE = os.getenv('PLACES_FILE', 'places.json')  # Нет файла - встроенный каталог
+PLACES_CHECK_INTERVAL = float(os.getenv('PLACES_CHECK_INTERVAL', '30'))  # Секунды между проверками файла, 0 - не следить
+PLACE_CATALOG_KEEP_VERSIONS = 5  # Прошлые версии для пользователей, начавших выбор места до перезагрузки
+# Поиск мест в inline-режиме ("@bot парк горь" в любом чате)
+INLINE_SEARCH_RESULTS = 50  # Результатов на запрос (листаются страницами по INLINE_PAGE_SIZE)
+INLINE_PAGE_SIZE = 20
+INLINE_CACHE_SIZE = int(os.getenv('INLINE_CACHE_SIZE', '1000'))  # Запросов в кеше результатов на версию каталога
+INLINE_CACHE_TIME = int(os.getenv('INLINE_CACHE_TIME', '300'))  # Секунды, которые Telegram хранит ответ у себя
+
+# Запись входящих обновлений для воспроизведения (replay_updates.py): сжатый JSON Lines.
+# ID, имена, телефоны и тексты обезличиваются HMAC с ключом UPDATE_RECORD_SECRET
+UPDATE_RECORD_FILE = os.getenv('UPDATE_RECORD_FILE')  # Не задан - запись отключена
+UPDATE_RECORD_SECRET = os.getenv('UPDATE_RECORD_SECRET')
+UPDATE_RECORD_FLUSH_INTERVAL = 5  # Секунды между сбросами буфера на диск
+
+PLACE_CATALOG_CHANGED_TEXT = "Список мест обновился, выберите регион заново."
+
 # Состояния для ConversationHandler
-WAITING_LOCATION, WAITING_FRIEND_NAME, WAITING_DISTRICT, WAITING_LOCATION_CHOICE, WAITING_SEARCH_USERNAME, WAITING_VERIFICATION_CODE, WAITING_ADMIN_TAG, WAITING_MESSAGE_TEXT, WAITING_ADMIN_MESSAGE_TEXT, WAITING_LOCATION_COORDS = range(10)
+WAITING_LOCATION, WAITING_FRIEND_NAME, WAITING_DISTRICT, WAITING_LOCATION_CHOICE, WAITING_SEARCH_USERNAME, WAITING_VERIFICATION_CODE, WAITING_ADMIN_TAG, WAITING_MESSAGE_TEXT, WAITING_ADMIN_MESSAGE_TEXT, WAITING_LOCATION_COORDS, WAITING_WALK_SCHEDULE, WAITING_WALK_TIME = range(12)
 
 # Хранение данных пользователей
 user_data = {}
-DATA_FILE = 'user_data.json'
+DATA_FILE = os.getenv('DATA_FILE', 'user_data.json')
 # Хранение запросов на добавление в друзья (от кого -> кому)
 friend_requests = {}  # {user_id: [list of user_ids who sent requests]}
-# Хранение кодов верификации: {user_id: {'code': str, 'phone': str, 'timestamp': float}}
-verification_codes = {}
-
-
-def load_user_data():
-    """Загружает данные пользователей из JSON файла"""
-    global user_data, friend_requests
-    try:
-        if os.path.exists(DATA_FILE):
-            with open(DATA_FILE, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                # Проверяем новый формат с friend_requests
-                if isinstance(data, dict) and 'users' in data:
-                    users = data['users']
-                    user_data = {int(k): v for k, v in users.items()}
-                    load_friend_requests()
-                else:
-                    # Старый формат - только user_data напрямую
-                    user_data = {int(k): v for k, v in data.items()}
-                    friend_requests = {}
-                logger.info(f"Загружены данные для {len(user_data)} пользователей")
-        else:
-            user_data = {}
-            friend_requests = {}
-            logger.info("Файл данных не найден, создан новый словарь")
-    except Exception as e:
-        logger.error(f"Ошибка при загрузке данных: {e}")
-        user_data = {}
-        friend_requests = {}
 
 
-def save_user_data():
-    """Сохраняет данные пользователей в JSON файл"""
-    try:
-        data_to_save = {
-            'users': user_data,
-            'friend_requests': friend_requests
-        }
-        with open(DATA_FILE, 'w', encoding='utf-8') as f:
-            json.dump(data_to_save, f, ensure_ascii=False, indent=2)
-        logger.debug("Данные пользователей сохранены")
-    except Exception as e:
-        logger.error(f"Ошибка при сохранении данных: {e}")
+class LatencyHistogram:
+    """Гистограмма задержек с фиксированными корзинами (как histogram в Prometheus)"""
+    
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Последняя корзина - +Inf
+        self.count = 0
+        self.sum = 0.0
+    
+    def observe(self, seconds):
+        index = 0
+        while index < len(self.buckets) and seconds > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += seconds
+    
+    def quantile(self, q):
+        """Оценка квантиля линейной интерполяцией внутри корзины"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            if seen + bucket_count >= rank and bucket_count:
+                if index == len(self.buckets):
+                    return self.buckets[-1]  # Выше верхней границы точнее оценить нельзя
+                lower = self.buckets[index - 1] if index else 0.0
+                return lower + (self.buckets[index] - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.buckets[-1]
 
 
-def load_friend_requests():
-    """Загружает запросы на добавление в друзья из сохраненных данных"""
-    global friend_requests
-    try:
-        if os.path.exists(DATA_FILE):
-            with open(DATA_FILE, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                if isinstance(data, dict) and 'friend_requests' in data:
-                    requests = data['friend_requests']
-                    friend_requests = {int(k): [int(i) for i in v] for k, v in requests.items()}
-                else:
-                    # Старый формат - только user_data
-                    friend_requests = {}
-    except Exception as e:
-        logger.error(f"Ошибка при загрузке запросов: {e}")
-        friend_requests = {}
+class MetricsTimer:
+    """Замеряет время блока или функции и записывает его в гистограмму"""
+    
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+        self._started = None
+    
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        self.registry.observe(self.name, time.perf_counter() - self._started, **self.labels)
+        return False
+    
+    def __call__(self, func):
+        # Время начала - локальная переменная вызова: функцию могут вызывать
+        # одновременно из нескольких потоков (asyncio.to_thread)
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.registry.observe(self.name, time.perf_counter() - started, **self.labels)
+        return wrapper
 
 
-def get_main_menu(user_id=None):
-    """Создает главное меню с 5 кнопками"""
-    keyboard = [
-        [InlineKeyboardButton("Мой профиль", callback_data="profile")],
-        [InlineKeyboardButton("Гулять с друзьями", callback_data="walk_with_friends")],
-        [InlineKeyboardButton("Найти локацию для прогулки", callback_data="find_location")],
-        [InlineKeyboardButton("Найти ветклинику", callback_data="find_vet")],
-        [InlineKeyboardButton("Найти зоомагазин", callback_data="find_pet_shop")]
-    ]
-    # Добавляем кнопку администратора, если пользователь - администратор
-    if ADMIN_ID and user_id and str(user_id) == str(ADMIN_ID):
-        keyboard.append([InlineKeyboardButton("👥 Управление подписчиками", callback_data="admin_subscribers")])
-    return InlineKeyboardMarkup(keyboard)
+class MetricsRegistry:
+    """Счетчики, гистограммы и вычисляемые показатели процесса"""
+    
+    def __init__(self):
+        self.histograms = {}  # {(name, labels): LatencyHistogram}
+        self.counters = {}  # {(name, labels): value}
+        self.gauges = {}  # {name: функция без аргументов}
+        self.help = {}
+    
+    def describe(self, name, text):
+        self.help[name] = text
+    
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = LatencyHistogram()
+        histogram.observe(seconds)
+    
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+    
+    def gauge(self, name, func, text=None, kind='gauge'):
+        """Показатель, вычисляемый при каждом запросе метрик (kind='counter' для монотонных)"""
+        self.gauges[name] = (func, kind)
+        if text:
+            self.help[name] = text
+    
+    def timed(self, name, **labels):
+        """Контекстный менеджер и декоратор для замера времени"""
+        return MetricsTimer(self, name, labels)
+    
+    def render(self):
+        """Текстовый формат экспозиции Prometheus"""
+        lines = []
+        described = set()
+        
+        def header(name, kind):
+            if name not in described:
+                described.add(name)
+                if name in self.help:
+                    lines.append(f"# HELP {name} {self.help[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+        
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, bucket_count in zip(list(histogram.buckets) + ['+Inf'], histogram.counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{format_metric_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_sum{format_metric_labels(labels)} {histogram.sum:.6f}")
+            lines.append(f"{name}_count{format_metric_labels(labels)} {histogram.count}")
+        
+        for (name, labels), value in sorted(self.counters.items()):
+            header(name, 'counter')
+            lines.append(f"{name}{format_metric_labels(labels)} {value}")
+        
+        for name, (func, kind) in sorted(self.gauges.items()):
+            try:
+                value = func()
+            except Exception as e:
+                logger.warning("Не удалось вычислить метрику %s: %s", name, e)
+                continue
+            header(name, kind)
+            lines.append(f"{name} {value}")
+        
+        return '\n'.join(lines) + '\n'
 
 
-def get_profile_menu():
-    """Создает меню профиля"""
-    keyboard = [
-        [InlineKeyboardButton("Назад", callback_data="main_menu")],
-        [InlineKeyboardButton("Где я гуляю", callback_data="my_walking_location")],
-        [InlineKeyboardButton("Фото питомца", callback_data="pet_photo")],
-        [InlineKeyboardButton("📱 Поделиться контактом", callback_data="share_contact")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+def format_metric_labels(labels):
+    """Форматирует метки Prometheus: {name="value",...}"""
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_metric_label(value)}"' for name, value in labels) + '}'
 
 
-def get_walking_location_menu():
-    """Меню для редактирования локации прогулок"""
-    keyboard = [
-        [InlineKeyboardButton("Назад", callback_data="profile")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+def escape_metric_label(value):
+    """Экранирует значение метки Prometheus"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
 
 
-def get_walk_with_friends_menu():
-    """Меню для прогулок с друзьями"""
-    keyboard = [
-        [InlineKeyboardButton("Назад", callback_data="main_menu")],
-        [InlineKeyboardButton("👥 Мои друзья", callback_data="my_friends")],
-        [InlineKeyboardButton("📥 Входящие запросы", callback_data="friend_requests_incoming")],
-        [InlineKeyboardButton("Написать другу", callback_data="write_friend")],
-        [InlineKeyboardButton("🔍 Найти пользователя", callback_data="search_user")],
-        [InlineKeyboardButton("🐕 Позвать гулять", callback_data="invite_to_walk")],
-        [InlineKeyboardButton("📍 Поделиться своим местоположением", callback_data="share_my_location")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+metrics = MetricsRegistry()
+metrics.describe('bot_handler_duration_seconds', 'Время работы обработчиков обновлений')
+metrics.describe('bot_handler_errors_total', 'Необработанные исключения в обработчиках')
+metrics.describe('bot_save_user_data_duration_seconds', 'Время сохранения данных пользователей')
+metrics.describe('bot_geocoder_duration_seconds', 'Время запросов к Яндекс.Геокодеру')
+metrics.describe('bot_telegram_request_duration_seconds', 'Время запросов к Telegram Bot API')
+metrics.describe('bot_telegram_request_errors_total', 'Запросы к Telegram Bot API с ошибкой')
+metrics.describe('bot_load_shed_total', 'Пропущенные или отложенные дорогие операции')
+metrics.describe('bot_load_level_changes_total', 'Смены уровня нагрузки')
 
 
-def get_find_location_menu():
-    """Меню для поиска локации"""
-    keyboard = [
-        [InlineKeyboardButton("Назад", callback_data="main_menu")],
-        [InlineKeyboardButton("🗺️ Выбрать регион", callback_data="choose_region")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+LOAD_NORMAL, LOAD_DEGRADED, LOAD_CRITICAL = range(3)
+LOAD_LEVEL_NAMES = ('normal', 'degraded', 'critical')
 
 
-def get_regions_list():
-    """Список регионов России"""
-    regions = [
-        "Москва", "Санкт-Петербург", "Московская область", "Ленинградская область",
-        "Краснодарский край", "Ростовская область", "Республика Татарстан",
-        "Свердловская область", "Челябинская область", "Республика Башкортостан",
-        "Нижегородская область", "Самарская область", "Новосибирская область",
-        "Красноярский край", "Воронежская область", "Пермский край",
-        "Волгоградская область", "Омская область", "Республика Дагестан",
-        "Тюменская область", "Иркутская область", "Кемеровская область",
-        "Саратовская область", "Тульская область", "Ульяновская область",
-        "Ярославская область", "Алтайский край", "Республика Крым",
-        "Хабаровский край", "Ставропольский край", "Белгородская область",
-        "Архангельская область", "Калужская область", "Тверская область",
-        "Липецкая область", "Оренбургская область", "Курская область",
-        "Республика Саха (Якутия)", "Приморский край", "Тамбовская область"
-    ]
-    return regions
+class LoadMonitor:
+    """
+    Измеряет задержку планирования цикла событий и определяет уровень нагрузки
+    
+    Фоновая задача засыпает на interval секунд и замеряет, насколько позже она
+    проснулась. Задержка сглаживается: рост учитывается сразу, спад - постепенно.
+    """
+    
+    def __init__(self, interval, degraded_threshold, critical_threshold, recovery_seconds, max_save_delay):
+        self.interval = interval
+        self.thresholds = (degraded_threshold, critical_threshold)
+        self.recovery_seconds = recovery_seconds
+        self.max_save_delay = max_save_delay
+        self.lag = 0.0
+        self.level = LOAD_NORMAL
+        self.save_pending_since = None  # Время первого отложенного сохранения
+        self._calm_since = None
+        self._task = None
+    
+    @property
+    def degraded(self):
+        return self.level >= LOAD_DEGRADED
+    
+    @property
+    def critical(self):
+        return self.level >= LOAD_CRITICAL
+    
+    def record(self, lag, now):
+        """Учитывает очередной замер и при необходимости меняет уровень"""
+        self.lag = lag if lag > self.lag else self.lag * 0.8 + lag * 0.2
+        target = LOAD_NORMAL
+        for level, threshold in enumerate(self.thresholds, start=LOAD_DEGRADED):
+            if self.lag >= threshold:
+                target = level
+        
+        if target > self.level:
+            self._calm_since = None
+            self._set_level(target)
+        elif target < self.level:
+            if self._calm_since is None:
+                self._calm_since = now
+            elif now - self._calm_since >= self.recovery_seconds:
+                self._calm_since = None
+                self._set_level(target)
+        else:
+            self._calm_since = None
+    
+    def _set_level(self, level):
+        previous = self.level
+        self.level = level
+        metrics.inc('bot_load_level_changes_total', level=LOAD_LEVEL_NAMES[level])
+        logger.log(
+            logging.WARNING if level > previous else logging.INFO,
+            "Уровень нагрузки: %s -> %s (задержка цикла событий %.0f мс)",
+            LOAD_LEVEL_NAMES[previous], LOAD_LEVEL_NAMES[level], self.lag * 1000
+        )
+        if previous == LOAD_CRITICAL and self.save_pending_since is not None:
+            write_user_data()
+    
+    def defer_save(self):
+        """Возвращает True, если сохранение нужно отложить из-за критической нагрузки"""
+        if not self.critical:
+            return False
+        now = time.monotonic()
+        if self.save_pending_since is None:
+            self.save_pending_since = now
+        elif now - self.save_pending_since >= self.max_save_delay:
+            return False
+        metrics.inc('bot_load_shed_total', feature='save')
+        return True
+    
+    def broadcast_delay(self):
+        """Пауза между сообщениями рассылки на текущем уровне нагрузки"""
+        return BROADCAST_DELAYS[self.level]
+    
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            now = loop.time()
+            self.record(max(0.0, now - expected), now)
+            # Отложенное сохранение выполняется не позже max_save_delay, даже если
+            # новых сохранений не было и нагрузка все еще критическая
+            if self.save_pending_since is not None and time.monotonic() - self.save_pending_since >= self.max_save_delay:
+                write_user_data()
+    
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+    
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self.save_pending_since is not None:
+            write_user_data()
 
 
-def get_regions_menu():
-    """Меню выбора региона"""
-    keyboard = [
-        [InlineKeyboardButton("Назад", callback_data="find_location")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+load_monitor = LoadMonitor(
+    LOOP_LAG_PROBE_INTERVAL,
+    LOOP_LAG_DEGRADED_SECONDS,
+    LOOP_LAG_CRITICAL_SECONDS,
+    LOOP_LAG_RECOVERY_SECONDS,
+    LOAD_SHED_MAX_SAVE_DELAY
+)
+metrics.gauge('bot_event_loop_lag_seconds', lambda: round(load_monitor.lag, 6), 'Сглаженная задержка цикла событий')
+metrics.gauge('bot_load_level', lambda: load_monitor.level, 'Уровень нагрузки: 0 - норма, 1 - деградация, 2 - критический')
 
 
-def get_districts_by_region(region):
-    """Получает список районов по региону"""
-    # Базовый список районов для популярных регионов
-    districts_map = {
-        "Москва": [
-            "Центральный", "Северный", "Северо-Восточный", "Восточный",
-            "Юго-Восточный", "Южный", "Юго-Западный", "Западный",
-            "Северо-Западный", "Зеленоградский", "Новомосковский", "Троицкий"
-        ],
-        "Санкт-Петербург": [
-            "Адмиралтейский", "Василеостровский", "Выборгский", "Калининский",
-            "Кировский", "Колпинский", "Красногвардейский", "Красносельский",
-            "Кронштадтский", "Курортный", "Московский", "Невский",
-            "Петроградский", "Петродворцовый", "Приморский", "Пушкинский",
-            "Фрунзенский", "Центральный"
-        ],
-        "Московская область": [
-            "Балашиха", "Подольск", "Химки", "Королёв", "Мытищи",
-            "Люберцы", "Коломна", "Электросталь", "Одинцово", "Красногорск"
-        ],
-        "Краснодарский край": [
-            "Краснодар", "Сочи", "Новороссийск", "Армавир", "Ейск",
-            "Кропоткин", "Анапа", "Геленджик", "Туапсе", "Славянск-на-Кубани"
-        ],
-        "Ленинградская область": [
-            "Всеволожск", "Гатчина", "Выборг", "Сосновый Бор", "Тихвин",
-            "Кириши", "Кингисепп", "Волхов", "Сланцы", "Луга"
-        ]
-    }
+class TimerWheel:
+    """
+    Колесо таймеров: ключи раскладываются по корзинам по времени истечения
     
-    # Возвращаем районы для региона или общий список
-    if region in districts_map:
-        return districts_map[region]
-    else:
-        # Для регионов без данных возвращаем типовой список районов
-        return [
-            "Центральный район", "Северный район", "Южный район",
-            "Восточный район", "Западный район"
-        ]
+    Добавление и отмена - O(1), продвижение на один тик отдает ключи только из одной корзины.
+    Корзин должно хватать на весь срок жизни (slots * tick >= TTL).
+    """
+    
+    def __init__(self, tick, slots):
+        self.tick = tick
+        self._slots = [set() for _ in range(slots)]
+        self._current_tick = int(time.time() // tick)
+    
+    def _slot(self, expires_at):
+        tick_index = max(int(expires_at // self.tick), self._current_tick + 1)
+        return self._slots[tick_index % len(self._slots)]
+    
+    def schedule(self, key, expires_at):
+        self._slot(expires_at).add(key)
+    
+    def cancel(self, key, expires_at):
+        self._slot(expires_at).discard(key)
+    
+    def advance(self, now):
+        """Продвигает колесо до момента now и возвращает ключи из пройденных корзин"""
+        now_tick = int(now // self.tick)
+        due = []
+        # После долгой паузы достаточно одного оборота колеса
+        first_tick = max(self._current_tick + 1, now_tick - len(self._slots) + 1)
+        for tick_index in range(first_tick, now_tick + 1):
+            slot = self._slots[tick_index % len(self._slots)]
+            if slot:
+                due.extend(slot)
+                slot.clear()
+        self._current_tick = max(self._current_tick, now_tick)
+        return due
 
 
-def get_walking_places_by_district(region, district):
-    """Получает список мест для прогулок по району"""
-    # Специфичные места для известных регионов и районов
-    # В реальном приложении это можно хранить в базе данных
-    places_map = {
-        ("Москва", "Центральный"): [
-            "Парк Горького", "Сокольники", "Красная площадь", "Александровский сад",
-            "Нескучный сад", "Царицыно", "Коломенское", "Измайловский парк"
-        ],
-        ("Москва", "Северный"): [
-            "Парк Дружбы", "Парк Северного речного вокзала", "Лихоборские пруды",
-            "Алтуфьевский парк", "Лианозовский парк"
-        ],
-        ("Москва", "Южный"): [
-            "Царицыно", "Битцевский лесопарк", "Коломенское", "Царицынские пруды",
-            "Парк усадьбы Люблино"
-        ],
-        ("Санкт-Петербург", "Центральный"): [
-            "Летний сад", "Марсово поле", "Михайловский сад", "Парк 300-летия",
-            "Елагин остров", "Таврический сад", "Александровский парк"
+class VerificationCodeStore:
+    """
+    Хранилище кодов подтверждения телефона с ограниченным сроком жизни
+    
+    Запись и поиск - O(1), просроченные коды удаляются колесом таймеров, даже если
+    пользователь так и не ввел код. Число кодов ограничено max_codes, число попыток
+    ввода - max_attempts. При persist=True коды сохраняются в STATE_DB_FILE и
+    переживают перезапуск. В режиме воркеров таблица общая, и каждый воркер
+    загружает и удаляет только коды своих пользователей.
+    """
+    
+    def __init__(self, ttl, max_attempts, max_codes, persist=False):
+        self.ttl = ttl
+        self.max_attempts = max_attempts
+        self.max_codes = max_codes
+        self.persist = persist
+        self.shard = None  # (индекс воркера, число воркеров) в режиме воркеров
+        self._codes = {}  # {user_id: {'code', 'phone', 'timestamp', 'expires_at', 'attempts'}}
+        self._wheel = TimerWheel(tick=1, slots=int(ttl) + 2)
+        self._dirty = set()
+        self._conn = None
+        self._task = None
+    
+    def __contains__(self, user_id):
+        entry = self._codes.get(user_id)
+        return entry is not None and entry['expires_at'] > time.time()
+    
+    def __len__(self):
+        return len(self._codes)
+    
+    def get(self, user_id):
+        """Возвращает запись или None (запись может быть просрочена, если колесо еще не дошло до нее)"""
+        return self._codes.get(user_id)
+    
+    def issue(self, user_id, code, phone):
+        """Сохраняет новый код. Возвращает False, если хранилище переполнено"""
+        if user_id not in self._codes and len(self._codes) >= self.max_codes:
+            self.expire()
+            if len(self._codes) >= self.max_codes:
+                return False
+        self.remove(user_id)
+        now = time.time()
+        self._codes[user_id] = {
+            'code': code,
+            'phone': phone,
+            'timestamp': now,
+            'expires_at': now + self.ttl,
+            'attempts': 0
+        }
+        self._wheel.schedule(user_id, now + self.ttl)
+        self._dirty.add(user_id)
+        return True
+    
+    def register_failed_attempt(self, user_id):
+        """Учитывает неверный ввод. Возвращает число оставшихся попыток (0 - код аннулирован)"""
+        entry = self._codes.get(user_id)
+        if not entry:
+            return 0
+        entry['attempts'] += 1
+        self._dirty.add(user_id)
+        remaining = self.max_attempts - entry['attempts']
+        if remaining <= 0:
+            self.remove(user_id)
+            return 0
+        return remaining
+    
+    def remove(self, user_id):
+        entry = self._codes.pop(user_id, None)
+        if entry:
+            self._wheel.cancel(user_id, entry['expires_at'])
+            self._dirty.add(user_id)
+    
+    def expire(self, now=None):
+        """Удаляет коды, срок которых истек. Возвращает число удаленных"""
+        now = now or time.time()
+        expired = 0
+        for user_id in self._wheel.advance(now):
+            entry = self._codes.get(user_id)
+            if entry is None:
+                continue
+            if entry['expires_at'] <= now:
+                del self._codes[user_id]
+                self._dirty.add(user_id)
+                expired += 1
+            else:
+                self._wheel.schedule(user_id, entry['expires_at'])
+        return expired
+    
+    def load(self):
+        """Загружает сохраненные коды (если включено сохранение)"""
+        if not self.persist:
+            return
+        self._conn = open_state_db()
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS verification_codes (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL)"
+        )
+        now = time.time()
+        for user_id, raw in self._conn.execute("SELECT user_id, data FROM verification_codes").fetchall():
+            if self.shard and shard_for_user(user_id, self.shard[1]) != self.shard[0]:
+                continue
+            entry = json.loads(raw)
+            if entry['expires_at'] > now:
+                self._codes[user_id] = entry
+                self._wheel.schedule(user_id, entry['expires_at'])
+            else:
+                self._dirty.add(user_id)
+        logger.info("Загружено кодов подтверждения: %s", len(self._codes))
+    
+    def flush(self):
+        """Записывает изменившиеся коды в базу"""
+        if not self.persist or not self._conn or not self._dirty:
+            self._dirty.clear()
+            return
+        dirty, self._dirty = self._dirty, set()
+        with self._conn:
+            self._conn.execute("BEGIN")
+            for user_id in dirty:
+                entry = self._codes.get(user_id)
+                if entry:
+                    self._conn.execute(
+                        "INSERT INTO verification_codes (user_id, data) VALUES (?, ?) "
+                        "ON CONFLICT (user_id) DO UPDATE SET data = excluded.data",
+                        (user_id, json.dumps(entry))
+                    )
+                else:
+                    self._conn.execute("DELETE FROM verification_codes WHERE user_id = ?", (user_id,))
+    
+    async def run(self):
+        while True:
+            await asyncio.sleep(self._wheel.tick)
+            try:
+                self.expire()
+                self.flush()
+            except Exception as e:
+                logger.error("Ошибка при очистке кодов подтверждения: %s", e, exc_info=True)
+    
+    def start(self):
+        self.load()
+        self._task = asyncio.create_task(self.run())
+    
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        self.flush()
+
+
+# Хранение кодов верификации: {user_id: {'code': str, 'phone': str, 'timestamp': float, ...}}
+verification_codes = VerificationCodeStore(
+    ttl=VERIFICATION_CODE_TTL,
+    max_attempts=VERIFICATION_MAX_ATTEMPTS,
+    max_codes=VERIFICATION_MAX_CODES,
+    persist=VERIFICATION_CODES_PERSIST
+)
+
+
+class KeyedLocks:
+    """Асинхронные блокировки по ключу (ID пользователя), создаются по требованию и удаляются после освобождения"""
+    
+    def __init__(self):
+        self._locks = {}
+        self._holders = {}  # {key: сколько задач держат или ждут блокировку}
+    
+    @contextlib.asynccontextmanager
+    async def hold(self, *keys):
+        """
+        Захватывает блокировки для всех переданных ключей
+        
+        Ключи захватываются в отсортированном порядке, поэтому две задачи,
+        блокирующие одну и ту же пару пользователей, не могут войти во взаимоблокировку.
+        """
+        keys = sorted({key for key in keys if key is not None})
+        for key in keys:
+            if key not in self._locks:
+                self._locks[key] = asyncio.Lock()
+                self._holders[key] = 0
+            self._holders[key] += 1
+        
+        acquired = []
+        try:
+            for key in keys:
+                await self._locks[key].acquire()
+                acquired.append(key)
+            yield
+        finally:
+            for key in reversed(acquired):
+                self._locks[key].release()
+            for key in keys:
+                self._holders[key] -= 1
+                if not self._holders[key]:
+                    del self._holders[key]
+                    del self._locks[key]
+    
+    def __len__(self):
+        return len(self._locks)
+
+
+# Блокировки для изменений user_data, friend_requests и verification_codes.
+# Для операций над дружбой блокируется пара пользователей.
+state_locks = KeyedLocks()
+
+
+class UpdateAnonymizer:
+    """
+    Обезличивает обновление перед записью
+    
+    Одинаковые значения превращаются в одинаковые псевдонимы (HMAC с секретным ключом),
+    поэтому в записи сохраняются связи между пользователями: кто кого искал, добавлял
+    в друзья и звал гулять. Каждое слово текста заменяется псевдонимом так же, как имена,
+    и поиск по имени в воспроизведении находит того же пользователя. Команды (без
+    аргументов), номера вариантов и коды подтверждения остаются как есть.
+    """
+    
+    # ID пользователей в callback_data: add_friend_<id>, admin_remove_tag_confirm_<id>_<тег>
+    CALLBACK_ID_PATTERN = re.compile(r'(?<=_)\d{5,}(?=_|$)')
+    
+    def __init__(self, secret):
+        self._key = secret.encode('utf-8')
+    
+    def digest(self, kind, value):
+        return hmac.new(self._key, f"{kind}:{value}".encode('utf-8'), 'sha256').hexdigest()
+    
+    def user_id(self, user_id):
+        if user_id < 0:
+            return -self.user_id(-user_id)  # Группы и каналы
+        return 10 ** 9 + int(self.digest('id', user_id)[:12], 16) % 10 ** 12
+    
+    def name(self, value):
+        if not value:
+            return value
+        return 'u' + self.digest('name', value.casefold())[:8]
+    
+    def phone(self, phone):
+        # Псевдоним зависит только от последних 10 цифр: +7..., 8... и 7... одного номера совпадают
+        digits = ''.join(filter(str.isdigit, phone))
+        prefix, tail = digits[:-10], digits[-10:]
+        hashed = str(int(self.digest('phone', tail), 16))[-len(tail):]
+        return ('+' if phone.startswith('+') else '') + prefix + hashed
+    
+    def text(self, text):
+        if text.startswith('/'):
+            return text.split()[0]
+        digits = ''.join(filter(str.isdigit, text))
+        if digits and not text.strip(' +-()0123456789'):
+            return self.phone(text) if len(digits) >= 7 else text
+        if text.startswith('@'):
+            return '@' + self.name(text[1:])
+        return ' '.join(self.name(word) for word in text.split())
+    
+    def callback_data(self, data):
+        if not data:
+            return data
+        return self.CALLBACK_ID_PATTERN.sub(lambda match: str(self.user_id(int(match.group()))), data)
+    
+    def user(self, user):
+        result = {'id': self.user_id(user['id']), 'is_bot': user.get('is_bot', False), 'first_name': self.name(user.get('first_name'))}
+        for field in ('last_name', 'username'):
+            if user.get(field):
+                result[field] = self.name(user[field])
+        if user.get('language_code'):
+            result['language_code'] = user['language_code']
+        return result
+    
+    def message(self, message, content=True):
+        """Сообщение без лишних полей. content=False - только адрес сообщения (для сообщений бота)"""
+        result = {
+            'message_id': message['message_id'],
+            'date': message.get('date', 0),
+            'chat': {'id': self.user_id(message['chat']['id']), 'type': message['chat'].get('type', 'private')}
+        }
+        if message.get('from'):
+            result['from'] = self.user(message['from'])
+        if message.get('edit_date'):
+            result['edit_date'] = message['edit_date']
+        if not content:
+            return result
+        
+        if 'text' in message:
+            result['text'] = self.text(message['text'])
+            if result['text'].startswith('/'):
+                result['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(result['text'])}]
+        if 'contact' in message:
+            contact = message['contact']
+            result['contact'] = {'phone_number': self.phone(contact['phone_number']), 'first_name': self.name(contact.get('first_name'))}
+            if contact.get('user_id'):
+                result['contact']['user_id'] = self.user_id(contact['user_id'])
+        if 'location' in message:
+            # Точность около километра: район сохраняется, адрес - нет
+            location = dict(message['location'])
+            location['latitude'] = round(location['latitude'], 2)
+            location['longitude'] = round(location['longitude'], 2)
+            result['location'] = location
+        if 'photo' in message:
+            result['photo'] = [
+                {
+                    'file_id': self.digest('file', size['file_id'])[:32],
+                    'file_unique_id': self.digest('file', size['file_unique_id'])[:16],
+                    'width': size['width'],
+                    'height': size['height']
+                }
+                for size in message['photo']
+            ]
+        return result
+    
+    def update(self, data):
+        """Обезличенная копия Update.to_dict(); пустой словарь для неподдерживаемых типов"""
+        result = {}
+        for key in ('message', 'edited_message'):
+            if key in data:
+                result[key] = self.message(data[key])
+        if 'callback_query' in data:
+            query = data['callback_query']
+            result['callback_query'] = {
+                'id': self.digest('query', query['id'])[:16],
+                'from': self.user(query['from']),
+                'chat_instance': self.digest('chat', query.get('chat_instance'))[:16],
+                'data': self.callback_data(query.get('data'))
+            }
+            if query.get('message'):
+                result['callback_query']['message'] = self.message(query['message'], content=False)
+        if 'inline_query' in data:
+            query = data['inline_query']
+            result['inline_query'] = {
+                'id': self.digest('query', query['id'])[:16],
+                'from': self.user(query['from']),
+                'query': self.text(query.get('query', '')),
+                'offset': query.get('offset', '')
+            }
+        return result
+
+
+class UpdateRecorder:
+    """
+    Записывает входящие обновления в сжатый файл JSON Lines (только дозапись)
+    
+    Строка файла: {"ts": время получения, "update": обезличенное обновление}. Обработчики
+    только кладут обновление в очередь, обезличивание, сериализация и сжатие выполняются
+    в отдельном потоке. Каждый запуск дописывает в файл новый gzip-поток; такие файлы
+    читаются целиком (zcat, gzip.open).
+    """
+    
+    def __init__(self, path, secret, flush_interval):
+        self.path = path
+        self.secret = secret
+        self.flush_interval = flush_interval
+        self.recorded_total = 0
+        self._anonymizer = None
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+    
+    def record(self, update):
+        if self._thread is not None:
+            # Update неизменяем, поэтому to_dict() безопасно вызывать в потоке записи
+            self._queue.put((time.time(), update))
+    
+    def run(self):
+        with gzip.open(self.path, 'at', encoding='utf-8') as f:
+            last_flush = time.monotonic()
+            while True:
+                try:
+                    item = self._queue.get(timeout=self.flush_interval)
+                except queue.Empty:
+                    item = ()
+                if item is None:
+                    break
+                if item:
+                    received, update = item
+                    try:
+                        data = self._anonymizer.update(update.to_dict())
+                    except Exception as e:
+                        logger.error("Не удалось записать обновление %s: %s", update.update_id, e, exc_info=True)
+                        data = None
+                    if data:
+                        f.write(json.dumps({'ts': round(received, 3), 'update': data}, ensure_ascii=False) + '\n')
+                        self.recorded_total += 1
+                if time.monotonic() - last_flush >= self.flush_interval:
+                    f.flush()
+                    last_flush = time.monotonic()
+    
+    def start(self):
+        if not self.path or self._thread is not None:
+            return
+        secret = self.secret
+        if not secret:
+            secret = os.urandom(16).hex()
+            logger.warning("UPDATE_RECORD_SECRET не задан: после перезапуска псевдонимы пользователей будут другими")
+        self._anonymizer = UpdateAnonymizer(secret)
+        self._thread = threading.Thread(target=self.run, name='update-recorder', daemon=True)
+        self._thread.start()
+        logger.info("Запись обновлений в %s", self.path)
+        if ADMIN_ID:
+            # Для воспроизведения действий администратора: replay_updates.py --admin-id
+            logger.info("ID администратора в записи: %s", self._anonymizer.user_id(int(ADMIN_ID)))
+    
+    def stop(self):
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join(timeout=30)
+        self._thread = None
+        logger.info("Записано обновлений: %s", self.recorded_total)
+
+
+# Запускается только в процессе, который принимает обновления (в режиме воркеров - в основном)
+update_recorder = UpdateRecorder(UPDATE_RECORD_FILE, UPDATE_RECORD_SECRET, UPDATE_RECORD_FLUSH_INTERVAL)
+
+
+class PerUserUpdateQueue(asyncio.Queue):
+    """
+    Очередь обновлений приложения, которая выдает обновления одного пользователя по одному
+    
+    Следующее обновление пользователя попадает в очередь только после того, как
+    обработка предыдущего завершилась (done()), а до этого ждет в его собственной
+    очереди. Поэтому поток обновлений от одного пользователя занимает не больше одного
+    из max_concurrent_updates слотов обработки, а обновления разных пользователей
+    обрабатываются параллельно. Сюда же кладут обновления Updater, вебхук и воркеры.
+    """
+    
+    def __init__(self):
+        super().__init__()
+        self._waiting = {}  # {user_id: deque обновлений, ожидающих конца обработки текущего}
+        self._closed = False
+    
+    @property
+    def waiting_total(self):
+        return sum(len(waiting) for waiting in self._waiting.values())
+    
+    def put_nowait(self, item):
+        if not isinstance(item, Update):
+            # Сигнал остановки приложения: дальше очередь никто не читает, а ждущие
+            # обновления остаются в журнале и обработаются после перезапуска
+            self._closed = True
+            super().put_nowait(item)
+            return
+        if not update_journal.begin(item):
+            logger.info("Обновление %s уже обработано, повтор пропущен", item.update_id)
+            return
+        update_recorder.record(item)
+        user = item.effective_user
+        if user is None:
+            super().put_nowait(item)
+            return
+        session_sweeper.touch(user.id)
+        waiting = self._waiting.get(user.id)
+        if waiting is not None:
+            waiting.append(item)
+            return
+        self._waiting[user.id] = deque()
+        super().put_nowait(item)
+    
+    async def put(self, item):
+        # Очередь не ограничена, ждать места не нужно
+        self.put_nowait(item)
+    
+    def done(self, update, processed=True):
+        """Обработка update завершена (processed=False - прервана остановкой): выпускает следующее обновление пользователя"""
+        if processed:
+            update_journal.finish(update)
+        user = update.effective_user
+        waiting = self._waiting.get(user.id) if user else None
+        if waiting is None:
+            return
+        if waiting and not self._closed:
+            super().put_nowait(waiting.popleft())
+        else:
+            del self._waiting[user.id]
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Обрабатывает обновления параллельно (до max_concurrent_updates) и сообщает
+    PerUserUpdateQueue о конце обработки, чтобы она выпустила следующее обновление пользователя
+    """
+    
+    def __init__(self, max_concurrent_updates, update_queue):
+        super().__init__(max_concurrent_updates)
+        self.update_queue = update_queue
+    
+    async def do_process_update(self, update, coroutine) -> None:
+        begin_shared_session()
+        if not isinstance(update, Update):
+            await coroutine
+            return
+        cancelled = False
+        try:
+            await coroutine
+        except asyncio.CancelledError:
+            cancelled = True  # Остановка посреди обработки: обновление обработается после перезапуска
+            raise
+        finally:
+            self.update_queue.done(update, processed=not cancelled)
+    
+    async def initialize(self) -> None:
+        pass
+    
+    async def shutdown(self) -> None:
+        pass
+
+
+class SessionSweeper:
+    """
+    Освобождает память от context.user_data пользователей, которые не присылали
+    обновлений дольше SESSION_TTL секунд
+    
+    С SessionPersistence сессия сначала записывается в базу, а затем ключ
+    пользователя удаляется из application.user_data (drop_user_data), но запись в
+    базе остается: при следующем обновлении сессия лениво загрузится снова - как
+    после перезапуска. Без сохранения сессий она удаляется.
+    Незавершенные диалоги завершает ConversationHandler (conversation_timeout).
+    """
+    
+    def __init__(self, ttl, interval):
+        self.ttl = ttl
+        self.interval = interval
+        self.evicted_total = 0
+        # {user_id: время последней активности}, упорядочен от давно неактивных к недавним
+        self._last_seen = {}
+        self._task = None
+    
+    @property
+    def live_sessions(self):
+        return len(self._last_seen)
+    
+    def touch(self, user_id):
+        """Отмечает активность пользователя (вызывается при каждом обновлении)"""
+        self._last_seen.pop(user_id, None)
+        self._last_seen[user_id] = time.monotonic()
+    
+    def sweep(self, application):
+        """Вытесняет просроченные сессии. Возвращает число вытесненных пользователей"""
+        deadline = time.monotonic() - self.ttl
+        expired = []
+        for user_id, last_seen in self._last_seen.items():
+            if last_seen > deadline:
+                break
+            expired.append(user_id)
+        if not expired:
+            return 0
+        
+        persistence = application.persistence
+        for user_id in expired:
+            del self._last_seen[user_id]
+            if isinstance(persistence, SessionPersistence):
+                session = application.user_data.get(user_id)
+                if session is None or not persistence.evict_user_data(user_id, session):
+                    continue
+            application.drop_user_data(user_id)
+        
+        self.evicted_total += len(expired)
+        logger.info("Вытеснено неактивных сессий: %s, активных: %s", len(expired), self.live_sessions)
+        return len(expired)
+    
+    async def run(self, application):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.sweep(application)
+            except Exception as e:
+                logger.error("Ошибка при очистке сессий: %s", e, exc_info=True)
+    
+    def start(self, application):
+        self._task = asyncio.create_task(self.run(application))
+    
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+
+session_sweeper = SessionSweeper(SESSION_TTL, SESSION_SWEEP_INTERVAL)
+
+
+def open_state_db(path=None):
+    """Открывает SQLite-базу состояния бота (WAL, общая для нескольких процессов)"""
+    conn = sqlite3.connect(path or STATE_DB_FILE, timeout=30, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+MISSING = object()  # Нет ключа или записи (для merge_json)
+
+
+def merge_json(original, ours, theirs):
+    """
+    Трехстороннее слияние JSON-значений: изменения ours относительно original
+    накладываются на theirs - запись, которую тем временем сохранил другой воркер
+    
+    Словари сливаются по ключам, списки - по элементам (добавленные в ours
+    дописываются, удаленные убираются), для остальных значений побеждает ours.
+    Отсутствие ключа обозначается MISSING.
+    """
+    if ours == original or theirs == ours:
+        return theirs
+    if theirs == original:
+        return ours
+    if isinstance(ours, dict) and isinstance(theirs, dict):
+        base = original if isinstance(original, dict) else {}
+        result = {}
+        for key in [*theirs, *(key for key in ours if key not in theirs)]:
+            value = merge_json(base.get(key, MISSING), ours.get(key, MISSING), theirs.get(key, MISSING))
+            if value is not MISSING:
+                result[key] = value
+        return result
+    if isinstance(ours, list) and isinstance(theirs, list):
+        base = original if isinstance(original, list) else []
+        
+        def encode(item):
+            return json.dumps(item, ensure_ascii=False, sort_keys=True)
+        
+        base_items = {encode(item) for item in base}
+        removed = base_items - {encode(item) for item in ours}
+        theirs_items = {encode(item) for item in theirs}
+        return [item for item in theirs if encode(item) not in removed] + [
+            item for item in ours if encode(item) not in base_items and encode(item) not in theirs_items
+        ]
+    return ours
+
+
+class SharedStore:
+    """
+    Общее локальное хранилище пользователей и запросов в друзья для режима нескольких воркеров
+    
+    Записи хранятся в SQLite как JSON по ключу (пространство имен, ID пользователя),
+    поэтому операции между пользователями разных воркеров (запросы в друзья, удаление,
+    рассылки) видят одни и те же данные.
+    """
+    
+    def __init__(self, path=None):
+        self._path = path
+        self._local = threading.local()
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS shared_kv ("
+            "namespace TEXT NOT NULL, key INTEGER NOT NULL, value TEXT NOT NULL, "
+            "PRIMARY KEY (namespace, key))"
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS shared_meta (name TEXT PRIMARY KEY, value TEXT)")
+    
+    @property
+    def _conn(self):
+        """Соединение текущего потока (полные сканы выполняются вне цикла событий, см. scan_records)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = open_state_db(self._path)
+        return conn
+    
+    def get(self, namespace, key):
+        row = self._conn.execute(
+            "SELECT value FROM shared_kv WHERE namespace = ? AND key = ?", (namespace, key)
+        ).fetchone()
+        return row[0] if row else None
+    
+    def keys(self, namespace):
+        return [row[0] for row in self._conn.execute("SELECT key FROM shared_kv WHERE namespace = ?", (namespace,))]
+    
+    def items(self, namespace):
+        return self._conn.execute("SELECT key, value FROM shared_kv WHERE namespace = ?", (namespace,)).fetchall()
+    
+    def count(self, namespace):
+        return self._conn.execute("SELECT COUNT(*) FROM shared_kv WHERE namespace = ?", (namespace,)).fetchone()[0]
+    
+    def commit(self, mappings):
+        """
+        Записывает изменения текущего обновления во всех mappings одной транзакцией
+        
+        Запись читается и пишется под BEGIN IMMEDIATE. Если другой воркер изменил
+        ее после того, как она была прочитана, изменения сливаются (merge_json), а не
+        затирают чужие: два одновременных добавления в друзья одного пользователя
+        сохраняются оба. Удаленная другим воркером запись не восстанавливается.
+        """
+        pending = [(mapping, *mapping.pending()) for mapping in mappings]
+        if not any(changes or deletes for _, changes, deletes in pending):
+            return
+        written = []
+        with self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            for mapping, changes, deletes in pending:
+                upserts = {}
+                for key, (value, raw, original) in changes.items():
+                    current = self.get(mapping.namespace, key)
+                    if current != original:
+                        if current is None and original is not None:
+                            continue  # Запись удалена другим воркером (например, администратором)
+                        base = json.loads(original) if original is not None else MISSING
+                        value = merge_json(base, value, json.loads(current) if current is not None else MISSING)
+                        raw = json.dumps(value, ensure_ascii=False)
+                        metrics.inc('bot_shared_store_merges_total', namespace=mapping.namespace)
+                    upserts[key] = (value, raw)
+                self._conn.executemany(
+                    "INSERT INTO shared_kv (namespace, key, value) VALUES (?, ?, ?) "
+                    "ON CONFLICT (namespace, key) DO UPDATE SET value = excluded.value",
+                    [(mapping.namespace, key, raw) for key, (_, raw) in upserts.items()]
+                )
+                self._conn.executemany(
+                    "DELETE FROM shared_kv WHERE namespace = ? AND key = ?",
+                    [(mapping.namespace, key) for key in deletes]
+                )
+                written.append((mapping, upserts, deletes))
+        for mapping, upserts, deletes in written:
+            mapping.committed(upserts, deletes)
+    
+    def replace_all(self, namespace, data):
+        """Полностью заменяет содержимое пространства имен"""
+        with self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._conn.execute("DELETE FROM shared_kv WHERE namespace = ?", (namespace,))
+            self._conn.executemany(
+                "INSERT INTO shared_kv (namespace, key, value) VALUES (?, ?, ?)",
+                [(namespace, int(key), json.dumps(value, ensure_ascii=False)) for key, value in data.items()]
+            )
+    
+    def get_meta(self, name):
+        row = self._conn.execute("SELECT value FROM shared_meta WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+    
+    def set_meta(self, name, value):
+        self._conn.execute(
+            "INSERT INTO shared_meta (name, value) VALUES (?, ?) "
+            "ON CONFLICT (name) DO UPDATE SET value = excluded.value",
+            (name, str(value))
+        )
+
+
+class SharedMapping(MutableMapping):
+    """
+    dict-подобное представление пространства имен SharedStore
+    
+    Прочитанные записи кэшируются в рамках текущего обновления (contextvars),
+    поэтому изменения «на месте» (user_data[uid]['friends'].append(...))
+    работают как с обычным словарем. flush() записывает только записи,
+    JSON которых изменился, - его вызывает save_user_data(). Если запись тем
+    временем сохранил другой воркер, изменения сливаются (SharedStore.commit).
+    """
+    
+    def __init__(self, store, namespace):
+        self._store = store
+        self.namespace = namespace
+        self._session = contextvars.ContextVar(f'shared_session_{namespace}', default=None)
+    
+    def begin_session(self):
+        """Начинает новый кэш чтения (вызывается перед обработкой каждого обновления)"""
+        self._session.set({'loaded': {}, 'deleted': set()})
+    
+    def _current(self):
+        session = self._session.get()
+        if session is None:
+            session = {'loaded': {}, 'deleted': set()}
+            self._session.set(session)
+        return session
+    
+    def _load(self, key, raw):
+        value = json.loads(raw)
+        self._current()['loaded'][key] = (value, raw)
+        return value
+    
+    def __getitem__(self, key):
+        session = self._current()
+        if key in session['deleted']:
+            raise KeyError(key)
+        if key in session['loaded']:
+            return session['loaded'][key][0]
+        raw = self._store.get(self.namespace, key)
+        if raw is None:
+            raise KeyError(key)
+        return self._load(key, raw)
+    
+    def __setitem__(self, key, value):
+        session = self._current()
+        session['deleted'].discard(key)
+        previous = session['loaded'].get(key)
+        session['loaded'][key] = (value, previous[1] if previous else None)
+    
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        session = self._current()
+        session['loaded'].pop(key, None)
+        session['deleted'].add(key)
+    
+    def __iter__(self):
+        session = self._current()
+        stored = self._store.keys(self.namespace)
+        stored_set = set(stored)
+        for key in stored:
+            if key not in session['deleted']:
+                yield key
+        for key in list(session['loaded']):
+            if key not in stored_set:
+                yield key
+    
+    def __len__(self):
+        return sum(1 for _ in self)
+    
+    def items(self):
+        """Перебор всех записей одним запросом (полный скан, как по обычному словарю)"""
+        session = self._current()
+        seen = set()
+        result = []
+        for key, raw in self._store.items(self.namespace):
+            seen.add(key)
+            if key in session['deleted']:
+                continue
+            if key in session['loaded']:
+                result.append((key, session['loaded'][key][0]))
+            else:
+                result.append((key, self._load(key, raw)))
+        for key, (value, _) in list(session['loaded'].items()):
+            if key not in seen:
+                result.append((key, value))
+        return result
+    
+    def values(self):
+        return [value for _, value in self.items()]
+    
+    def pending(self):
+        """Изменения текущего обновления: ({ключ: (значение, JSON, прочитанный JSON)}, удаленные ключи)"""
+        session = self._current()
+        changes = {}
+        for key, (value, original) in session['loaded'].items():
+            raw = json.dumps(value, ensure_ascii=False)
+            if raw != original:
+                changes[key] = (value, raw, original)
+        return changes, set(session['deleted'])
+    
+    def committed(self, upserts, deletes):
+        """Записи сохранены (значения могли слиться с чужими изменениями)"""
+        session = self._current()
+        for key, (value, raw) in upserts.items():
+            session['loaded'][key] = (value, raw)
+        session['deleted'] -= deletes
+    
+    def flush(self, *others):
+        """Записывает в хранилище измененные в текущем обновлении записи (и записи others той же транзакцией)"""
+        self._store.commit([self, *others])
+    
+    def snapshot(self):
+        """Возвращает копию всех данных в виде обычного словаря"""
+        return {key: json.loads(raw) for key, raw in self._store.items(self.namespace)}
+
+
+async def scan_records(mapping):
+    """
+    Все записи mapping для поиска только на чтение
+    
+    В режиме воркеров это полный скан общего хранилища с разбором JSON каждой
+    записи, поэтому он выполняется в отдельном потоке, а не в цикле событий.
+    Несохраненные изменения текущего обновления в результат не попадают.
+    """
+    if isinstance(mapping, SharedMapping):
+        return await asyncio.to_thread(mapping.snapshot)
+    return mapping
+
+
+def use_shared_store(store):
+    """Переключает user_data и friend_requests на общее хранилище (режим воркера)"""
+    global user_data, friend_requests
+    user_data = SharedMapping(store, 'users')
+    friend_requests = SharedMapping(store, 'friend_requests')
+
+
+def begin_shared_session():
+    """Сбрасывает кэш общего хранилища перед обработкой обновления"""
+    if isinstance(user_data, SharedMapping):
+        user_data.begin_session()
+        friend_requests.begin_session()
+
+
+class ChangeLog:
+    """
+    Журнал ID измененных пользователей в базе состояния для индексов в памяти воркеров
+    
+    Воркер, изменивший данные пользователя, дописывает его ID, а остальные перед
+    чтением своего индекса забирают записи новее последней прочитанной. Хранятся
+    только keep последних записей: если воркер отстал сильнее, read() возвращает
+    None, и индекс нужно перестроить целиком. Вне режима воркеров журнал не открывается.
+    """
+    
+    def __init__(self, table, keep):
+        self.table = table
+        self.keep = keep
+        self._conn = None
+        self._seq = 0
+        self._own = set()  # Номера собственных записей: этот процесс их уже учел
+    
+    def open(self):
+        self._conn = open_state_db()
+        self._conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {self.table} (seq INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL)"
+        )
+        # Номер берется до построения индекса: изменения во время построения будут прочитаны повторно
+        self._seq = self._conn.execute(f"SELECT COALESCE(MAX(seq), 0) FROM {self.table}").fetchone()[0]
+    
+    def append(self, user_id):
+        if self._conn is None:
+            return
+        seq = self._conn.execute(f"INSERT INTO {self.table} (user_id) VALUES (?)", (user_id,)).lastrowid
+        self._own.add(seq)
+        self._conn.execute(f"DELETE FROM {self.table} WHERE seq <= ?", (seq - self.keep,))
+    
+    def read(self):
+        """
+        ID пользователей, измененных другими процессами с прошлого чтения (без повторов)
+        
+        Returns:
+            list: ID или None, если часть записей уже удалена
+        """
+        if self._conn is None:
+            return []
+        rows = self._conn.execute(
+            f"SELECT seq, user_id FROM {self.table} WHERE seq > ? ORDER BY seq", (self._seq,)
+        ).fetchall()
+        if not rows:
+            return []
+        gap = rows[0][0] != self._seq + 1
+        self._seq = rows[-1][0]
+        changed = [user_id for seq, user_id in rows if seq not in self._own]
+        self._own.clear()
+        if gap:
+            return None
+        return list(dict.fromkeys(changed))
+
+
+class SessionPersistence(BasePersistence):
+    """
+    Хранит context.user_data и состояния ConversationHandler в SQLite (STATE_DB_FILE)
+    
+    Записываются только изменившиеся сессии (по одной строке на пользователя),
+    а context.user_data загружается лениво - при первом обновлении от пользователя
+    после запуска, а не целиком при старте.
+    """
+    
+    def __init__(self, path=None, update_interval=5):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self._conn = open_state_db(path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS user_sessions (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS conversations ("
+            "name TEXT NOT NULL, key TEXT NOT NULL, state TEXT NOT NULL, PRIMARY KEY (name, key))"
+        )
+        self._loaded_user_ids = set()
+        self._written_sessions = {}  # {user_id: JSON последней записанной версии}
+        self._evicted_user_ids = set()  # Выгружены из памяти: drop_user_data не удаляет их из базы
+    
+    async def get_user_data(self):
+        # Сессии загружаются лениво в refresh_user_data
+        return {}
+    
+    async def refresh_user_data(self, user_id, user_data):
+        if user_id in self._loaded_user_ids:
+            return
+        self._loaded_user_ids.add(user_id)
+        row = self._conn.execute("SELECT data FROM user_sessions WHERE user_id = ?", (user_id,)).fetchone()
+        if row:
+            self._written_sessions[user_id] = row[0]
+            # Данные, уже записанные в текущей сессии, важнее сохраненных
+            for key, value in json.loads(row[0]).items():
+                user_data.setdefault(key, value)
+    
+    async def update_user_data(self, user_id, data):
+        self._write_user_data(user_id, data)
+    
+    def _write_user_data(self, user_id, data):
+        if user_id not in self._loaded_user_ids:
+            return True  # Сессия выгружена из памяти (evict_user_data), в базе лежит полная версия
+        try:
+            raw = json.dumps(data, ensure_ascii=False, sort_keys=True)
+        except (TypeError, ValueError) as e:
+            logger.error("Не удалось сохранить сессию пользователя %s: %s", user_id, e)
+            return False
+        if self._written_sessions.get(user_id) == raw:
+            return True
+        if data:
+            self._conn.execute(
+                "INSERT INTO user_sessions (user_id, data) VALUES (?, ?) "
+                "ON CONFLICT (user_id) DO UPDATE SET data = excluded.data",
+                (user_id, raw)
+            )
+        else:
+            self._conn.execute("DELETE FROM user_sessions WHERE user_id = ?", (user_id,))
+        self._written_sessions[user_id] = raw
+        return True
+    
+    def evict_user_data(self, user_id, user_data):
+        """
+        Записывает сессию неактивного пользователя перед выгрузкой из памяти
+        
+        Возвращает False, если записать не удалось - тогда сессия остается в памяти.
+        После успешной записи вызывающий удаляет пользователя из application.user_data
+        через drop_user_data, а при следующем обновлении refresh_user_data загрузит
+        сессию из базы.
+        """
+        if user_id in self._loaded_user_ids and not self._write_user_data(user_id, user_data):
+            return False
+        self._loaded_user_ids.discard(user_id)
+        self._written_sessions.pop(user_id, None)
+        self._evicted_user_ids.add(user_id)
+        return True
+    
+    async def drop_user_data(self, user_id):
+        if user_id in self._evicted_user_ids:
+            # Application передает сюда и выгрузку неактивной сессии: запись в базе нужна
+            self._evicted_user_ids.discard(user_id)
+            return
+        self._conn.execute("DELETE FROM user_sessions WHERE user_id = ?", (user_id,))
+        self._written_sessions.pop(user_id, None)
+        self._loaded_user_ids.discard(user_id)
+    
+    async def get_conversations(self, name):
+        rows = self._conn.execute("SELECT key, state FROM conversations WHERE name = ?", (name,))
+        return {tuple(json.loads(key)): json.loads(state) for key, state in rows}
+    
+    async def update_conversation(self, name, key, new_state):
+        if new_state is None:
+            self._conn.execute(
+                "DELETE FROM conversations WHERE name = ? AND key = ?", (name, json.dumps(list(key)))
+            )
+        else:
+            self._conn.execute(
+                "INSERT INTO conversations (name, key, state) VALUES (?, ?, ?) "
+                "ON CONFLICT (name, key) DO UPDATE SET state = excluded.state",
+                (name, json.dumps(list(key)), json.dumps(new_state))
+            )
+    
+    async def get_chat_data(self):
+        return {}
+    
+    async def get_bot_data(self):
+        return {}
+    
+    async def get_callback_data(self):
+        return None
+    
+    async def update_chat_data(self, chat_id, data):
+        pass
+    
+    async def update_bot_data(self, data):
+        pass
+    
+    async def update_callback_data(self, data):
+        pass
+    
+    async def drop_chat_data(self, chat_id):
+        pass
+    
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+    
+    async def refresh_bot_data(self, bot_data):
+        pass
+    
+    async def flush(self):
+        logger.info("Сессии сохранены в %s", STATE_DB_FILE)
+
+
+class UpdateJournal:
+    """
+    Журнал обработки обновлений в базе состояния
+    
+    Обновление записывается в журнал при поступлении, до того как Telegram получит
+    подтверждение (следующий getUpdates или ответ вебхука), и отмечается после
+    обработки. При запуске необработанные обновления (бот упал или был остановлен
+    посреди обработки) ставятся в очередь заново, а повторно присланные Telegram
+    обновления, которые уже обработаны, пропускаются. Поступившие обновления пишутся
+    в отдельном потоке одной пачкой перед подтверждением (flush_received), отметки
+    об обработке - раз в flush_interval секунд; обработчики, которые пишут другим
+    пользователям, отмечают обновление сразу через commit() - рассылка не
+    повторится после перезапуска. Пока сохранение данных отложено критической
+    нагрузкой, отметки не пишутся.
+    """
+    
+    def __init__(self, keep, flush_interval):
+        self.keep = keep
+        self.flush_interval = flush_interval
+        self.shard = None  # (индекс воркера, число воркеров) в режиме воркеров
+        self.received_upstream = False  # Обновления уже записал основной процесс (режим воркеров)
+        self.duplicates_total = 0
+        self._done = set()
+        self._done_order = deque()
+        self._active = set()
+        self._received = []  # Поступившие и еще не записанные: [Update]
+        self._finished = []  # Обработанные и еще не отмеченные в базе: [(update_id, user_id)]
+        self._conn = None
+        self._write_lock = threading.Lock()  # commit() из цикла событий и фоновая запись
+        self._receive_lock = asyncio.Lock()
+        self._task = None
+    
+    def begin(self, update):
+        """Отмечает начало обработки. Возвращает False для повтора уже обработанного обновления"""
+        if update.edited_message is not None:
+            return True  # Правки (позиции живой геопозиции) повторять безопасно, журнал их не хранит
+        update_id = update.update_id
+        if update_id in self._done or update_id in self._active:
+            self.duplicates_total += 1
+            return False
+        if not self.received_upstream:
+            self.receive(update)
+        self._active.add(update_id)
+        return True
+    
+    def receive(self, update):
+        """Добавляет поступившее обновление в пачку для flush_received()"""
+        if update.edited_message is None:
+            self._received.append(update)
+    
+    async def flush_received(self):
+        """Записывает поступившие обновления; вызывается перед подтверждением их получения Telegram"""
+        async with self._receive_lock:
+            if not self._received:
+                return
+            received, self._received = self._received, []
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self.write_received, received)
+            except Exception:
+                # Обновления не подтверждены и будут записаны при следующей попытке
+                self._received[:0] = received
+                raise
+    
+    def write_received(self, received):
+        if not self._conn or not received:
+            return
+        # Update неизменяем, поэтому to_dict() безопасно вызывать в потоке записи
+        rows = [
+            (update.update_id, update.effective_user.id if update.effective_user else None, json.dumps(update.to_dict()))
+            for update in received
+        ]
+        with self._write_lock, self._conn:
+            self._conn.execute("BEGIN")
+            # DO NOTHING: повтор уже обработанного обновления не должен снять отметку
+            self._conn.executemany(
+                "INSERT INTO update_journal (update_id, user_id, data) VALUES (?, ?, ?) "
+                "ON CONFLICT (update_id) DO NOTHING",
+                rows
+            )
+    
+    def finish(self, update):
+        update_id = update.update_id
+        if update_id in self._done or update.edited_message is not None:
+            return
+        self._active.discard(update_id)
+        user = update.effective_user
+        self._finished.append((update_id, user.id if user else None))
+        self._done.add(update_id)
+        self._done_order.append(update_id)
+        while len(self._done_order) > self.keep:
+            self._done.discard(self._done_order.popleft())
+    
+    def commit(self, update):
+        """Отмечает обновление обработанным и сразу записывает журнал (перед действиями, которые нельзя повторять)"""
+        self.finish(update)
+        self.write_after_save()
+    
+    def write_after_save(self):
+        # Отметка без сохраненных данных означала бы потерю изменений после падения:
+        # отложенное под критической нагрузкой сохранение выполняется раньше
+        if load_monitor.save_pending_since is not None:
+            write_user_data()
+        self.write(*self.take())
+    
+    def open(self):
+        """Открывает журнал только для записи поступающих обновлений (основной процесс режима воркеров)"""
+        self._conn = open_state_db()
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS update_journal (update_id INTEGER PRIMARY KEY, user_id INTEGER, data TEXT)"
+        )
+        self._conn.create_function('shard_for_user', 2, shard_for_user, deterministic=True)
+    
+    def load(self):
+        """Открывает журнал. Возвращает необработанные обновления этого процесса (словари)"""
+        self.open()
+        for (update_id,) in self._conn.execute(
+            "SELECT update_id FROM update_journal WHERE data IS NULL ORDER BY update_id DESC LIMIT ?", (self.keep,)
+        ).fetchall()[::-1]:
+            self._done.add(update_id)
+            self._done_order.append(update_id)
+        
+        pending = []
+        for update_id, user_id, raw in self._conn.execute(
+            "SELECT update_id, user_id, data FROM update_journal WHERE data IS NOT NULL ORDER BY update_id"
+        ).fetchall():
+            # Обновления без пользователя основной процесс отдает воркеру 0
+            shard = shard_for_user(user_id, self.shard[1]) if self.shard and user_id is not None else 0
+            if self.shard and shard != self.shard[0]:
+                continue
+            pending.append(json.loads(raw))
+        logger.info("Журнал обновлений: обработанных %s, необработанных %s", len(self._done), len(pending))
+        return pending
+    
+    def take(self):
+        """Забирает накопленные отметки для write()"""
+        finished, self._finished = self._finished, []
+        return finished, self._done_order[0] if self._done_order else None
+    
+    def write(self, finished, oldest_done):
+        if not self._conn or not finished:
+            return
+        with self._write_lock, self._conn:
+            self._conn.execute("BEGIN")
+            self._conn.executemany(
+                "INSERT INTO update_journal (update_id, user_id, data) VALUES (?, ?, NULL) "
+                "ON CONFLICT (update_id) DO UPDATE SET data = NULL",
+                finished
+            )
+            if oldest_done is None:
+                return
+            # Старые отметки больше не нужны: такие ID Telegram уже не пришлет. Воркер
+            # удаляет только отметки своих пользователей - у других воркеров свое окно
+            if self.shard:
+                self._conn.execute(
+                    "DELETE FROM update_journal WHERE data IS NULL AND update_id < ? "
+                    "AND (CASE WHEN user_id IS NULL THEN 0 ELSE shard_for_user(user_id, ?) END) = ?",
+                    (oldest_done, self.shard[1], self.shard[0])
+                )
+            else:
+                self._conn.execute(
+                    "DELETE FROM update_journal WHERE data IS NULL AND update_id < ?", (oldest_done,)
+                )
+    
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            if load_monitor.save_pending_since is not None:
+                # Сохранение данных отложено (критическая нагрузка): отметки ждут его,
+                # чтобы после падения эти обновления обработались заново
+                continue
+            try:
+                await loop.run_in_executor(None, self.write, *self.take())
+            except Exception as e:
+                logger.error("Ошибка при записи журнала обновлений: %s", e, exc_info=True)
+    
+    def start(self):
+        pending = self.load()
+        self._task = asyncio.create_task(self.run())
+        return pending
+    
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        # Обновления, обработка которых не завершилась, остаются в журнале до следующего запуска
+        received, self._received = self._received, []
+        self.write_received(received)
+        self.write_after_save()
+
+
+update_journal = UpdateJournal(UPDATE_JOURNAL_KEEP, UPDATE_JOURNAL_FLUSH_INTERVAL)
+
+
+def shard_for_user(user_id, workers):
+    """Номер воркера для пользователя (стабильный хеш ID)"""
+    return zlib.crc32(str(user_id).encode('ascii')) % workers
+
+
+def load_user_data():
+    """Загружает данные пользователей из JSON файла"""
+    global user_data, friend_requests
+    try:
+        if os.path.exists(DATA_FILE):
+            with open(DATA_FILE, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+                # Проверяем новый формат с friend_requests
+                if isinstance(data, dict) and 'users' in data:
+                    users = data['users']
+                    user_data = {int(k): v for k, v in users.items()}
+                    load_friend_requests()
+                else:
+                    # Старый формат - только user_data напрямую
+                    user_data = {int(k): v for k, v in data.items()}
+                    friend_requests = {}
+                logger.info("Загружены данные для %s пользователей", len(user_data))
+        else:
+            user_data = {}
+            friend_requests = {}
+            logger.info("Файл данных не найден, создан новый словарь")
+    except Exception as e:
+        logger.error("Ошибка при загрузке данных: %s", e)
+        user_data = {}
+        friend_requests = {}
+
+
+def save_user_data():
+    """Сохраняет данные пользователей (под критической нагрузкой сохранение в файл откладывается)"""
+    # В режиме воркеров изменения текущего обновления нужно записать сразу:
+    # они известны только в его сессии SharedMapping
+    if not isinstance(user_data, SharedMapping) and load_monitor.defer_save():
+        return
+    write_user_data()
+
+
+@metrics.timed('bot_save_user_data_duration_seconds')
+def write_user_data():
+    """Сохраняет данные пользователей в JSON файл"""
+    load_monitor.save_pending_since = None
+    if isinstance(user_data, SharedMapping):
+        # В режиме воркеров записываем только измененные записи в общее хранилище
+        try:
+            # Обе стороны дружбы и запрос в друзья сохраняются одной транзакцией
+            user_data.flush(friend_requests)
+        except Exception as e:
+            logger.error("Ошибка при сохранении данных в общее хранилище: %s", e)
+            metrics.inc('bot_save_user_data_errors_total')
+        return
+    
+    try:
+        data_to_save = {
+            'users': user_data,
+            'friend_requests': friend_requests
+        }
+        with open(DATA_FILE, 'w', encoding='utf-8') as f:
+            json.dump(data_to_save, f, ensure_ascii=False, indent=2)
+        logger.debug("Данные пользователей сохранены")
+    except Exception as e:
+        logger.error("Ошибка при сохранении данных: %s", e)
+        metrics.inc('bot_save_user_data_errors_total')
+
+
+def load_friend_requests():
+    """Загружает запросы на добавление в друзья из сохраненных данных"""
+    global friend_requests
+    try:
+        if os.path.exists(DATA_FILE):
+            with open(DATA_FILE, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+                if isinstance(data, dict) and 'friend_requests' in data:
+                    requests = data['friend_requests']
+                    friend_requests = {int(k): [int(i) for i in v] for k, v in requests.items()}
+                else:
+                    # Старый формат - только user_data
+                    friend_requests = {}
+    except Exception as e:
+        logger.error("Ошибка при загрузке запросов: %s", e)
+        friend_requests = {}
+
+
+def get_main_menu(user_id=None):
+    """Создает главное меню с 5 кнопками"""
+    keyboard = [
+        [InlineKeyboardButton("Мой профиль", callback_data="profile")],
+        [InlineKeyboardButton("Гулять с друзьями", callback_data="walk_with_friends")],
+        [InlineKeyboardButton("Найти локацию для прогулки", callback_data="find_location")],
+        [InlineKeyboardButton("Найти ветклинику", callback_data="find_vet")],
+        [InlineKeyboardButton("Найти зоомагазин", callback_data="find_pet_shop")]
+    ]
+    # Добавляем кнопку администратора, если пользователь - администратор
+    if ADMIN_ID and user_id and str(user_id) == str(ADMIN_ID):
+        keyboard.append([InlineKeyboardButton("👥 Управление подписчиками", callback_data="admin_subscribers")])
+    return InlineKeyboardMarkup(keyboard)
+
+
+def get_profile_menu():
+    """Создает меню профиля"""
+    keyboard = [
+        [InlineKeyboardButton("Назад", callback_data="main_menu")],
+        [InlineKeyboardButton("Где я гуляю", callback_data="my_walking_location")],
+        [InlineKeyboardButton("🕒 Когда я гуляю", callback_data="my_walk_schedule")],
+        [InlineKeyboardButton("Фото питомца", callback_data="pet_photo")],
+        [InlineKeyboardButton("📱 Поделиться контактом", callback_data="share_contact")],
+        [InlineKeyboardButton("📊 Мои прогулки", callback_data="my_walks")]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+
+def get_walking_location_menu():
+    """Меню для редактирования локации прогулок"""
+    keyboard = [
+        [InlineKeyboardButton("Назад", callback_data="profile")]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+
+def get_walk_with_friends_menu():
+    """Меню для прогулок с друзьями"""
+    keyboard = [
+        [InlineKeyboardButton("Назад", callback_data="main_menu")],
+        [InlineKeyboardButton("👥 Мои друзья", callback_data="my_friends")],
+        [InlineKeyboardButton("📥 Входящие запросы", callback_data="friend_requests_incoming")],
+        [InlineKeyboardButton("Написать другу", callback_data="write_friend")],
+        [InlineKeyboardButton("🔍 Найти пользователя", callback_data="search_user")],
+        [InlineKeyboardButton("🤝 Возможно, вы знакомы", callback_data="friend_suggestions")],
+        [InlineKeyboardButton("🐕 Позвать гулять", callback_data="invite_to_walk")],
+        [InlineKeyboardButton("📅 Запланированные прогулки", callback_data="planned_walks")],
+        [InlineKeyboardButton("🟢 Я гуляю сейчас", callback_data="walk_now")],
+        [InlineKeyboardButton("👫 Найти компанию", callback_data="find_company")],
+        [InlineKeyboardButton("📍 Поделиться своим местоположением", callback_data="share_my_location")]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+
+def get_find_location_menu():
+    """Меню для поиска локации"""
+    keyboard = [
+        [InlineKeyboardButton("Назад", callback_data="main_menu")],
+        [InlineKeyboardButton("🗺️ Выбрать регион", callback_data="choose_region")]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+
+def get_builtin_regions():
+    """Встроенный список регионов России (если PLACES_FILE не задан)"""
+    regions = [
+        "Москва", "Санкт-Петербург", "Московская область", "Ленинградская область",
+        "Краснодарский край", "Ростовская область", "Республика Татарстан",
+        "Свердловская область", "Челябинская область", "Республика Башкортостан",
+        "Нижегородская область", "Самарская область", "Новосибирская область",
+        "Красноярский край", "Воронежская область", "Пермский край",
+        "Волгоградская область", "Омская область", "Республика Дагестан",
+        "Тюменская область", "Иркутская область", "Кемеровская область",
+        "Саратовская область", "Тульская область", "Ульяновская область",
+        "Ярославская область", "Алтайский край", "Республика Крым",
+        "Хабаровский край", "Ставропольский край", "Белгородская область",
+        "Архангельская область", "Калужская область", "Тверская область",
+        "Липецкая область", "Оренбургская область", "Курская область",
+        "Республика Саха (Якутия)", "Приморский край", "Тамбовская область"
+    ]
+    return regions
+
+
+def get_regions_menu():
+    """Меню выбора региона"""
+    keyboard = [
+        [InlineKeyboardButton("Назад", callback_data="find_location")]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+
+def get_builtin_districts(region):
+    """Встроенный список районов региона"""
+    # Базовый список районов для популярных регионов
+    districts_map = {
+        "Москва": [
+            "Центральный", "Северный", "Северо-Восточный", "Восточный",
+            "Юго-Восточный", "Южный", "Юго-Западный", "Западный",
+            "Северо-Западный", "Зеленоградский", "Новомосковский", "Троицкий"
+        ],
+        "Санкт-Петербург": [
+            "Адмиралтейский", "Василеостровский", "Выборгский", "Калининский",
+            "Кировский", "Колпинский", "Красногвардейский", "Красносельский",
+            "Кронштадтский", "Курортный", "Московский", "Невский",
+            "Петроградский", "Петродворцовый", "Приморский", "Пушкинский",
+            "Фрунзенский", "Центральный"
+        ],
+        "Московская область": [
+            "Балашиха", "Подольск", "Химки", "Королёв", "Мытищи",
+            "Люберцы", "Коломна", "Электросталь", "Одинцово", "Красногорск"
+        ],
+        "Краснодарский край": [
+            "Краснодар", "Сочи", "Новороссийск", "Армавир", "Ейск",
+            "Кропоткин", "Анапа", "Геленджик", "Туапсе", "Славянск-на-Кубани"
+        ],
+        "Ленинградская область": [
+            "Всеволожск", "Гатчина", "Выборг", "Сосновый Бор", "Тихвин",
+            "Кириши", "Кингисепп", "Волхов", "Сланцы", "Луга"
+        ]
+    }
+    
+    # Возвращаем районы для региона или общий список
+    if region in districts_map:
+        return districts_map[region]
+    else:
+        # Для регионов без данных возвращаем типовой список районов
+        return [
+            "Центральный район", "Северный район", "Южный район",
+            "Восточный район", "Западный район"
+        ]
+
+
+def get_builtin_walking_places(region, district):
+    """Встроенный список мест для прогулок района"""
+    # Специфичные места для известных регионов и районов
+    places_map = {
+        ("Москва", "Центральный"): [
+            "Парк Горького", "Сокольники", "Красная площадь", "Александровский сад",
+            "Нескучный сад", "Царицыно", "Коломенское", "Измайловский парк"
+        ],
+        ("Москва", "Северный"): [
+            "Парк Дружбы", "Парк Северного речного вокзала", "Лихоборские пруды",
+            "Алтуфьевский парк", "Лианозовский парк"
+        ],
+        ("Москва", "Южный"): [
+            "Царицыно", "Битцевский лесопарк", "Коломенское", "Царицынские пруды",
+            "Парк усадьбы Люблино"
+        ],
+        ("Санкт-Петербург", "Центральный"): [
+            "Летний сад", "Марсово поле", "Михайловский сад", "Парк 300-летия",
+            "Елагин остров", "Таврический сад", "Александровский парк"
         ],
         ("Санкт-Петербург", "Приморский"): [
             "Парк 300-летия Санкт-Петербурга", "Приморский парк Победы",
@@ -257,211 +2111,3057 @@ def get_walking_places_by_district(region, district):
         ],
     }
     
-    # Проверяем, есть ли специфичные места для этого района
-    key = (region, district)
-    if key in places_map:
-        return places_map[key]
+    # Проверяем, есть ли специфичные места для этого района
+    key = (region, district)
+    if key in places_map:
+        return places_map[key]
+    
+    # Если нет специфичных мест, формируем общий список без названия района
+    base_places = [
+        "Центральный парк",
+        "Парк Победы",
+        "Лесопарк",
+        "Сквер у озера",
+        "Набережная",
+        "Парк культуры и отдыха",
+        "Детский парк",
+        "Ботанический сад",
+        "Лесная зона",
+        "Сквер возле реки",
+        "Парк развлечений",
+        "Аллея для прогулок",
+        "Зона отдыха",
+        "Парк с озером",
+        "Природный парк"
+    ]
+    
+    return base_places
+
+
+@metrics.timed('bot_geocoder_duration_seconds')
+def get_coordinates_from_yandex_geocoder(search_query):
+    """
+    Получает координаты места через Яндекс.Геокодер API
+    
+    Args:
+        search_query: Поисковый запрос (например, "Парк Горького, Москва")
+    
+    Returns:
+        tuple: (latitude, longitude) или None в случае ошибки
+    """
+    if not YANDEX_GEOCODER_API_KEY:
+        return None
+    
+    try:
+        try:
+            import requests  # pyright: ignore[reportMissingImports]
+        except ImportError:
+            logger.warning("Библиотека requests не установлена. Установите её для использования Яндекс.Геокодер API: pip install requests")
+            return None
+        
+        base_url = "https://geocode-maps.yandex.ru/1.x/"
+        params = {
+            "apikey": YANDEX_GEOCODER_API_KEY,
+            "geocode": search_query,
+            "format": "json"
+        }
+        
+        response = requests.get(base_url, params=params, timeout=5)
+        if response.status_code == 200:
+            json_response = response.json()
+            try:
+                pos = json_response["response"]["GeoObjectCollection"]["featureMember"][0]["GeoObject"]["Point"]["pos"]
+                longitude, latitude = map(float, pos.split())
+                return latitude, longitude
+            except (IndexError, KeyError):
+                logger.debug("Не удалось найти координаты для запроса: %s", search_query)
+                return None
+        else:
+            logger.warning("Ошибка при запросе к Яндекс.Геокодеру: %s", response.status_code)
+            metrics.inc('bot_geocoder_errors_total')
+            return None
+    except Exception as e:
+        logger.error("Ошибка при получении координат через Яндекс.Геокодер: %s", e)
+        metrics.inc('bot_geocoder_errors_total')
+        return None
+
+
+# Координаты мест встроенного каталога (по названию места)
+BUILTIN_PLACES_COORDS = {
+    # Москва
+    "Парк Горького": {"lat": "55.7326", "lon": "37.6017"},
+    "Сокольники": {"lat": "55.7902", "lon": "37.6769"},
+    "Красная площадь": {"lat": "55.7539", "lon": "37.6208"},
+    "Александровский сад": {"lat": "55.7520", "lon": "37.6156"},
+    "Нескучный сад": {"lat": "55.7147", "lon": "37.5964"},
+    "Царицыно": {"lat": "55.6214", "lon": "37.6811"},
+    "Коломенское": {"lat": "55.6682", "lon": "37.6685"},
+    "Измайловский парк": {"lat": "55.7892", "lon": "37.7735"},
+    "Парк Дружбы": {"lat": "55.7786", "lon": "37.5179"},
+    "Парк Северного речного вокзала": {"lat": "55.7917", "lon": "37.4803"},
+    "Лихоборские пруды": {"lat": "55.8633", "lon": "37.5531"},
+    "Алтуфьевский парк": {"lat": "55.8919", "lon": "37.5864"},
+    "Лианозовский парк": {"lat": "55.9000", "lon": "37.5764"},
+    "Битцевский лесопарк": {"lat": "55.6081", "lon": "37.5833"},
+    "Царицынские пруды": {"lat": "55.6214", "lon": "37.6811"},
+    "Парк усадьбы Люблино": {"lat": "55.6819", "lon": "37.7494"},
+    # Санкт-Петербург
+    "Летний сад": {"lat": "59.9444", "lon": "30.3372"},
+    "Марсово поле": {"lat": "59.9439", "lon": "30.3323"},
+    "Михайловский сад": {"lat": "59.9394", "lon": "30.3322"},
+    "Парк 300-летия": {"lat": "59.9833", "lon": "30.2000"},
+    "Елагин остров": {"lat": "59.9781", "lon": "30.2589"},
+    "Таврический сад": {"lat": "59.9458", "lon": "30.3764"},
+    "Александровский парк": {"lat": "59.9544", "lon": "30.3233"},
+    "Парк 300-летия Санкт-Петербурга": {"lat": "59.9833", "lon": "30.2000"},
+    "Приморский парк Победы": {"lat": "59.9781", "lon": "30.2589"},
+    "Крестовский остров": {"lat": "59.9733", "lon": "30.2619"},
+}
+
+
+async def get_place_info(region, district, place, catalog=None):
+    """
+    Получает информацию о месте (координаты для Яндекс карт и фото)
+    
+    catalog - версия каталога мест, из которой выбрано место (по умолчанию текущая)
+    """
+    import urllib.parse
+    
+    coords = (catalog or place_catalogs.current).coordinates(region, district, place)
+    # Если есть координаты для места в базе - используем их для точной ссылки
+    if coords:
+        yandex_map_url = f"https://yandex.ru/maps/?pt={coords[1]},{coords[0]}&z=15&l=map"
+    else:
+        # Пытаемся получить координаты через Яндекс.Геокодер API, если API ключ указан
+        search_query = f"{place}, {district}, {region}"
+        if load_monitor.degraded:
+            # Под нагрузкой не ждем геокодер: быстрый ответ важнее точной ссылки на карту
+            metrics.inc('bot_load_shed_total', feature='geocoder')
+            coordinates = None
+        else:
+            # Синхронный HTTP-запрос выполняется в отдельном потоке, а не в цикле событий
+            coordinates = await asyncio.to_thread(get_coordinates_from_yandex_geocoder, search_query)
+        
+        if coordinates:
+            # Используем полученные координаты для точной ссылки
+            lat, lon = coordinates
+            yandex_map_url = f"https://yandex.ru/maps/?pt={lon},{lat}&z=15&l=map"
+        else:
+            # Если координаты не найдены, используем текстовый поиск
+            encoded_query = urllib.parse.quote(search_query)
+            yandex_map_url = f"https://yandex.ru/maps/?text={encoded_query}"
+    
+    # URL для фото (можно использовать placeholder или реальные фото)
+    # Для демонстрации используем placeholder изображение
+    photo_url = None  # Можно добавить реальные URL фото мест
+    
+    return {
+        "yandex_map_url": yandex_map_url,
+        "photo_url": photo_url
+    }
+
+
+SEARCH_WORD_RE = re.compile(r'\w+')
+
+
+def normalize_search_words(text):
+    """Слова текста для поиска: без регистра, ё = е"""
+    return SEARCH_WORD_RE.findall(text.casefold().replace('ё', 'е'))
+
+
+def get_search_trigrams(word):
+    """Триграммы слова с границами (" па", "пар", ..., "рк ")"""
+    padded = f" {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class PlaceSearchIndex:
+    """
+    Поиск мест каталога по началам слов, с запасным поиском по триграммам при опечатках
+    
+    Места пронумерованы по длине и алфавиту названия, поэтому из одинаково подходящих
+    выше короткие. Слова названий, районов и регионов лежат в отсортированном списке:
+    все слова с данным началом - это отрезок, который находят два bisect. Ответы
+    кешируются внутри версии каталога, так что после перезагрузки кеш новый.
+    """
+    
+    TRIGRAM_MAX_SHARE = 0.05  # Триграммы, которые есть у большей доли мест, не отбирают кандидатов
+    TRIGRAM_MIN_SCORE = 0.5  # Доля триграмм запроса, которая должна найтись в названии
+    
+    def __init__(self, places, limit, cache_size):
+        """places - [(регион, район, название, lat, lon), ...]"""
+        self.places = sorted(places, key=lambda place: (len(place[2]), place[2].casefold(), place[1], place[0]))
+        self.limit = limit
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._name_postings = {}  # Слово названия -> номера мест
+        self._context_postings = {}  # Слово района или региона -> номера мест
+        self._trigram_postings = {}  # Триграмма названия -> номера мест
+        context_words = {}
+        for number, (region, district, name, _, _) in enumerate(self.places):
+            words = set(normalize_search_words(name))
+            trigrams = set()
+            for word in words:
+                self._name_postings.setdefault(word, array('I')).append(number)
+                trigrams |= get_search_trigrams(word)
+            for trigram in trigrams:
+                self._trigram_postings.setdefault(trigram, array('I')).append(number)
+            key = (region, district)
+            if key not in context_words:
+                context_words[key] = set(normalize_search_words(f"{district} {region}"))
+            for word in context_words[key] - words:
+                self._context_postings.setdefault(word, array('I')).append(number)
+        self._words = sorted(self._name_postings.keys() | self._context_postings.keys())
+    
+    def _prefix_matches(self, token):
+        """(места, где token - начало слова названия, места, где начало любого слова)"""
+        start = bisect.bisect_left(self._words, token)
+        end = bisect.bisect_left(self._words, token + '\U0010ffff')
+        in_name = set()
+        in_context = set()
+        for word in self._words[start:end]:
+            in_name.update(self._name_postings.get(word, ()))
+            in_context.update(self._context_postings.get(word, ()))
+        return in_name, in_name | in_context
+    
+    def _search_prefix(self, tokens):
+        name_sets = []
+        any_sets = []
+        for token in set(tokens):
+            in_name, in_any = self._prefix_matches(token)
+            if not in_any:
+                return []
+            name_sets.append(in_name)
+            any_sets.append(in_any)
+        any_sets.sort(key=len)
+        candidates = any_sets[0].intersection(*any_sets[1:])
+        # Сначала места, у которых все слова запроса нашлись в названии, затем - в районе или регионе
+        in_name = candidates.intersection(*name_sets)
+        result = heapq.nsmallest(self.limit, in_name)
+        if len(result) < self.limit:
+            result += heapq.nsmallest(self.limit - len(result), candidates - in_name)
+        return result
+    
+    def _search_trigrams(self, tokens):
+        trigrams = set()
+        for token in tokens:
+            trigrams |= get_search_trigrams(token)
+        max_posting = max(1, int(len(self.places) * self.TRIGRAM_MAX_SHARE))
+        scores = Counter()
+        used = 0
+        for trigram in trigrams:
+            posting = self._trigram_postings.get(trigram)
+            if posting is None:
+                used += 1
+            elif len(posting) <= max_posting:
+                used += 1
+                scores.update(posting)
+        need = max(2, math.ceil(used * self.TRIGRAM_MIN_SCORE))
+        candidates = [(-score, number) for number, score in scores.items() if score >= need]
+        return [number for _, number in heapq.nsmallest(self.limit, candidates)]
+    
+    def search(self, query):
+        """Номера лучших мест по запросу (не больше limit), лучшие первыми"""
+        tokens = normalize_search_words(query)
+        key = ' '.join(tokens)
+        if not key:
+            return []
+        result = self._cache.get(key)
+        if result is not None:
+            self._cache.move_to_end(key)
+            metrics.inc('bot_inline_search_total', cache='hit')
+            return result
+        metrics.inc('bot_inline_search_total', cache='miss')
+        result = self._search_prefix(tokens) or self._search_trigrams(tokens)
+        self._cache[key] = result
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return result
+
+
+class PlaceCatalog:
+    """
+    Неизменяемая версия каталога мест: регионы, районы и места для прогулок
+    
+    Кнопки выбора передают номера региона, района и места вместе с версией, поэтому
+    номер всегда ищется в тех же списках, по которым построена кнопка. Версия - хеш
+    содержимого, одинаковый во всех воркерах и после перезапуска.
+    """
+    
+    def __init__(self, version, regions):
+        """regions - {регион: {район: [(название, lat, lon), ...]}} в порядке показа"""
+        self.version = version
+        self.regions = list(regions)
+        self._districts = {}
+        self._places = {}
+        self._coords = {}
+        search_places = []
+        for region, districts in regions.items():
+            self._districts[region] = list(districts)
+            for district, places in districts.items():
+                self._places[region, district] = [name for name, _, _ in places]
+                for name, lat, lon in places:
+                    search_places.append((region, district, name, lat, lon))
+                    if lat is not None and lon is not None:
+                        self._coords[region, district, name] = (lat, lon)
+        # Строится вместе с версией (при перезагрузке - в потоке чтения файла)
+        self.search_index = PlaceSearchIndex(search_places, INLINE_SEARCH_RESULTS, INLINE_CACHE_SIZE)
+    
+    @property
+    def district_count(self):
+        return len(self._places)
+    
+    @property
+    def place_count(self):
+        return sum(len(places) for places in self._places.values())
+    
+    def districts(self, region):
+        return self._districts.get(region, [])
+    
+    def places(self, region, district):
+        return self._places.get((region, district), [])
+    
+    def coordinates(self, region, district, place):
+        """(lat, lon) места или None, если координаты неизвестны"""
+        return self._coords.get((region, district, place))
+    
+    @classmethod
+    def builtin(cls):
+        """Каталог из встроенных списков"""
+        regions = {}
+        for region in get_builtin_regions():
+            regions[region] = {}
+            for district in get_builtin_districts(region):
+                places = []
+                for name in get_builtin_walking_places(region, district):
+                    coords = BUILTIN_PLACES_COORDS.get(name)
+                    if coords:
+                        places.append((name, float(coords['lat']), float(coords['lon'])))
+                    else:
+                        places.append((name, None, None))
+                regions[region][district] = places
+        # Версия - тоже хеш содержимого: кнопки переживают перезапуск, если списки не менялись
+        return cls(hashlib.sha1(json.dumps(regions, ensure_ascii=False).encode('utf-8')).hexdigest()[:10], regions)
+    
+    @classmethod
+    def from_file(cls, path):
+        """
+        Каталог из файла import_places.py: {"regions": {регион: {район: [места]}}}
+        
+        Место - [название, lat, lon, ...] или просто название. ValueError, если
+        файл не похож на каталог.
+        """
+        with open(path, 'rb') as f:
+            raw = f.read()
+        data = json.loads(raw)
+        if not isinstance(data, dict) or not isinstance(data.get('regions'), dict) or not data['regions']:
+            raise ValueError("нет непустого раздела regions")
+        regions = {}
+        for region, districts in data['regions'].items():
+            if not isinstance(districts, dict):
+                raise ValueError(f"районы региона {region!r} должны быть объектом")
+            regions[region] = {}
+            for district, places in districts.items():
+                if not isinstance(places, list):
+                    raise ValueError(f"места района {region!r} / {district!r} должны быть списком")
+                parsed = []
+                for place in places:
+                    if isinstance(place, str):
+                        parsed.append((place, None, None))
+                    elif isinstance(place, list) and place and isinstance(place[0], str):
+                        lat = place[1] if len(place) > 2 else None
+                        lon = place[2] if len(place) > 2 else None
+                        if not isinstance(lat, (int, float)) or not isinstance(lon, (int, float)):
+                            lat = lon = None
+                        parsed.append((place[0], lat, lon))
+                    else:
+                        raise ValueError(f"некорректное место в районе {region!r} / {district!r}: {place!r}")
+                regions[region][district] = parsed
+        return cls(hashlib.sha1(raw).hexdigest()[:10], regions)
+
+
+class PlaceCatalogStore:
+    """
+    Текущий каталог мест и его перезагрузка из PLACES_FILE без перезапуска
+    
+    Новая версия читается и строится в отдельном потоке, а затем подменяется одним
+    присваиванием: обработчики видят либо старую, либо новую версию целиком.
+    Кнопки выбора места несут версию каталога, по которой построены (см.
+    encode_place_callback), поэтому несколько прошлых версий хранятся в памяти.
+    """
+    
+    def __init__(self, path, check_interval, keep_versions):
+        self.path = path
+        self.check_interval = check_interval
+        self.keep_versions = keep_versions
+        self.reloads_total = 0
+        self.current = PlaceCatalog.builtin()
+        self._versions = OrderedDict([(self.current.version, self.current)])
+        self._stamp = None  # (mtime, размер) прочитанного файла
+        self._task = None
+    
+    def _file_stamp(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+    
+    def _read(self):
+        """Читает и строит каталог (выполняется в отдельном потоке)"""
+        stamp = self._file_stamp()
+        if stamp is None:
+            raise FileNotFoundError(f"файл {self.path} не найден")
+        return PlaceCatalog.from_file(self.path), stamp
+    
+    def _swap(self, catalog, stamp):
+        self._stamp = stamp
+        if catalog.version == self.current.version:
+            return False
+        self._versions.pop(catalog.version, None)
+        self._versions[catalog.version] = catalog
+        while len(self._versions) > self.keep_versions:
+            self._versions.popitem(last=False)
+        self.current = catalog
+        self.reloads_total += 1
+        logger.info(
+            "Каталог мест: версия %s, регионов %d, районов %d, мест %d",
+            catalog.version, len(catalog.regions), catalog.district_count, catalog.place_count
+        )
+        return True
+    
+    async def reload(self):
+        """
+        Перечитывает PLACES_FILE, не блокируя цикл событий
+        
+        Возвращает True, если версия сменилась. При ошибке чтения (OSError,
+        ValueError) остается прежняя версия.
+        """
+        catalog, stamp = await asyncio.to_thread(self._read)
+        return self._swap(catalog, stamp)
+    
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            stamp = self._file_stamp()
+            if stamp is None or stamp == self._stamp:
+                continue
+            try:
+                await self.reload()
+            except (OSError, ValueError) as e:
+                # Файл могут дописывать прямо сейчас - повторим, когда он снова изменится
+                self._stamp = stamp
+                logger.error("Каталог мест %s не загружен, остается версия %s: %s", self.path, self.current.version, e)
+    
+    def get(self, version):
+        """Версия каталога или None, если она уже вытеснена"""
+        return self._versions.get(version)
+    
+    def for_user(self, session):
+        """Версия, из которой выбрано место в context.user_data (или текущая, если она уже вытеснена)"""
+        return self._versions.get(session.get('place_catalog_version')) or self.current
+    
+    def start(self):
+        if os.path.exists(self.path):
+            try:
+                self._swap(*self._read())
+            except (OSError, ValueError) as e:
+                logger.error("Каталог мест %s не загружен, используется встроенный: %s", self.path, e)
+        if self.check_interval > 0:
+            self._task = asyncio.create_task(self.run())
+    
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+
+place_catalogs = PlaceCatalogStore(PLACES_FILE, PLACES_CHECK_INTERVAL, PLACE_CATALOG_KEEP_VERSIONS)
+
+
+def get_regions_list():
+    """Регионы текущей версии каталога мест"""
+    return place_catalogs.current.regions
+
+
+def get_districts_by_region(region):
+    """Районы региона в текущей версии каталога мест"""
+    return place_catalogs.current.districts(region)
+
+
+def get_walking_places_by_district(region, district):
+    """Места для прогулок района в текущей версии каталога мест"""
+    return place_catalogs.current.places(region, district)
+
+
+# Кнопки выбора места (регион → район → место) не зависят от сессии: в callback_data
+# лежат версия каталога и номера, "pl1:<версия>:<действие>:<номер>[:<номер>...]".
+# Самая длинная кнопка - около 30 байт из 64 допустимых. Номер формата (pl1) меняется,
+# если меняется раскладка полей.
+PLACE_CALLBACK_PREFIX = 'pl1:'
+# Действие -> маршрут (имена прежних кнопок, чтобы метрики и лимиты не менялись)
+PLACE_CALLBACK_ROUTES = {
+    'r': 'select_region',  # Регион: номер региона
+    'R': 'choose_district_in_region',  # Список районов: регион, страница
+    'd': 'select_district',  # Места района: регион, район, страница
+    'p': 'select_walking_place',  # Место: регион, район, место
+}
+# Кнопки старого формата в сообщениях, отправленных до обновления бота
+LEGACY_PLACE_CALLBACKS = ('select_region_', 'choose_district_in_region', 'select_district_', 'select_walking_place_')
+PLACE_LIST_PAGE_SIZE = 20
+
+
+def encode_place_callback(catalog, action, *numbers):
+    return PLACE_CALLBACK_PREFIX + ':'.join([catalog.version, action, *map(str, numbers)])
+
+
+def decode_place_callback(callback_data):
+    """(версия, действие, [номера]) или None, если это не кнопка выбора места"""
+    if not callback_data.startswith(PLACE_CALLBACK_PREFIX):
+        return None
+    parts = callback_data[len(PLACE_CALLBACK_PREFIX):].split(':')
+    if len(parts) < 3 or parts[1] not in PLACE_CALLBACK_ROUTES:
+        return None
+    try:
+        numbers = [int(part) for part in parts[2:]]
+    except ValueError:
+        return None
+    return parts[0], parts[1], numbers
+
+
+def resolve_legacy_place_callback(callback_data, session):
+    """
+    Кнопка старого формата (select_district_3 и т.п.) как (каталог, действие, номера)
+    
+    Недостающие номера берутся из выбора, сохраненного в context.user_data.
+    None, если выбор в сессии потерян.
+    """
+    catalog = place_catalogs.for_user(session)
+    region = session.get('selected_region')
+    district = session.get('selected_district')
+    region_index = catalog.regions.index(region) if region in catalog.regions else None
+    districts = catalog.districts(region)
+    district_index = districts.index(district) if district in districts else None
+    try:
+        if callback_data.startswith('select_region_'):
+            return catalog, 'r', [int(callback_data.removeprefix('select_region_'))]
+        if region_index is None:
+            return None
+        if callback_data == 'choose_district_in_region':
+            return catalog, 'R', [region_index, 0]
+        if callback_data.startswith('select_district_'):
+            return catalog, 'd', [region_index, int(callback_data.removeprefix('select_district_')), 0]
+        if district_index is None:
+            return None
+        return catalog, 'p', [region_index, district_index, int(callback_data.removeprefix('select_walking_place_'))]
+    except ValueError:
+        return None
+
+
+def get_page_buttons(catalog, action, numbers, page, total):
+    """Ряд кнопок листания или None, если все помещается на одной странице"""
+    pages = (total + PLACE_LIST_PAGE_SIZE - 1) // PLACE_LIST_PAGE_SIZE
+    if pages <= 1:
+        return None
+    row = []
+    if page > 0:
+        row.append(InlineKeyboardButton(f"◀️ {page}/{pages}", callback_data=encode_place_callback(catalog, action, *numbers, page - 1)))
+    if page + 1 < pages:
+        row.append(InlineKeyboardButton(f"{page + 2}/{pages} ▶️", callback_data=encode_place_callback(catalog, action, *numbers, page + 1)))
+    return row
+
+
+def get_regions_screen(catalog):
+    """Список регионов: текст и клавиатура"""
+    regions = catalog.regions
+    keyboard = []
+    # Разбиваем на кнопки по 2 в ряд для компактности
+    for i in range(0, len(regions), 2):
+        keyboard.append([
+            InlineKeyboardButton(regions[j], callback_data=encode_place_callback(catalog, 'r', j))
+            for j in range(i, min(i + 2, len(regions)))
+        ])
+    keyboard.append([InlineKeyboardButton("Назад", callback_data="find_location")])
+    return "🗺️ Выбрать регион\n\nВыберите регион из списка:\n\n", InlineKeyboardMarkup(keyboard)
+
+
+async def get_place_browse_screen(catalog, action, numbers):
+    """
+    Экран выбора места по кнопке: (текст, клавиатура, место или None)
+    
+    Место - (регион, район, название, get_place_info) для экрана места. None вместо
+    экрана, если номера не подходят к версии каталога.
+    """
+    if any(number < 0 for number in numbers):
+        return None
+    try:
+        if action == 'r':
+            (region_index,) = numbers
+            region = catalog.regions[region_index]
+            keyboard = [
+                [InlineKeyboardButton("Назад", callback_data="choose_region")],
+                [InlineKeyboardButton("🏘️ Выбрать район", callback_data=encode_place_callback(catalog, 'R', region_index, 0))]
+            ]
+            text = f"🗺️ Регион: {region}\n\nВыберите район для поиска мест для прогулок:"
+            return text, InlineKeyboardMarkup(keyboard), None
+        
+        if action == 'R':
+            region_index, page = numbers
+            region = catalog.regions[region_index]
+            districts = catalog.districts(region)
+            first = page * PLACE_LIST_PAGE_SIZE
+            if first and first >= len(districts):
+                return None
+            keyboard = [[InlineKeyboardButton("Назад", callback_data=encode_place_callback(catalog, 'r', region_index))]]
+            # Разбиваем на кнопки по 2 в ряд
+            for i in range(first, min(first + PLACE_LIST_PAGE_SIZE, len(districts)), 2):
+                keyboard.append([
+                    InlineKeyboardButton(districts[j], callback_data=encode_place_callback(catalog, 'd', region_index, j, 0))
+                    for j in range(i, min(i + 2, first + PLACE_LIST_PAGE_SIZE, len(districts)))
+                ])
+            page_buttons = get_page_buttons(catalog, 'R', [region_index], page, len(districts))
+            if page_buttons:
+                keyboard.append(page_buttons)
+            text = f"🏘️ Выбрать район\n\nРегион: {region}\n\nВыберите район:\n\n"
+            return text, InlineKeyboardMarkup(keyboard), None
+        
+        if action == 'd':
+            region_index, district_index, page = numbers
+            region = catalog.regions[region_index]
+            district = catalog.districts(region)[district_index]
+            places = catalog.places(region, district)
+            first = page * PLACE_LIST_PAGE_SIZE
+            if first and first >= len(places):
+                return None
+            text = f"🌳 Места для прогулок\n\nРегион: {region}\nРайон: {district}\n\nВыберите место:\n\n"
+            keyboard = [[InlineKeyboardButton(
+                "Назад",
+                callback_data=encode_place_callback(catalog, 'R', region_index, district_index // PLACE_LIST_PAGE_SIZE)
+            )]]
+            for i in range(first, min(first + PLACE_LIST_PAGE_SIZE, len(places))):
+                text += f"{i + 1}. {places[i]}\n"
+                keyboard.append([InlineKeyboardButton(
+                    f"{i + 1}. {places[i]}",
+                    callback_data=encode_place_callback(catalog, 'p', region_index, district_index, i)
+                )])
+            page_buttons = get_page_buttons(catalog, 'd', [region_index, district_index], page, len(places))
+            if page_buttons:
+                keyboard.append(page_buttons)
+            return text, InlineKeyboardMarkup(keyboard), None
+        
+        region_index, district_index, place_index = numbers
+        region = catalog.regions[region_index]
+        district = catalog.districts(region)[district_index]
+        place = catalog.places(region, district)[place_index]
+    except (ValueError, IndexError):
+        return None
+    
+    place_info = await get_place_info(region, district, place, catalog)
+    text = f"🌳 {place}\n\n📍 Регион: {region}\n🏘️ Район: {district}\n\n"
+    keyboard = [
+        [InlineKeyboardButton(
+            "Назад",
+            callback_data=encode_place_callback(catalog, 'd', region_index, district_index, place_index // PLACE_LIST_PAGE_SIZE)
+        )],
+        [InlineKeyboardButton("🗺️ Открыть на Яндекс картах", url=place_info['yandex_map_url'])],
+        [InlineKeyboardButton("📤 Поделиться местом с другом", callback_data="share_place_with_friend")],
+        # Назначить прогулку - приглашение друзей на время
+        [InlineKeyboardButton("📅 Назначить прогулку здесь", callback_data="plan_walk")]
+    ]
+    return text, InlineKeyboardMarkup(keyboard), (region, district, place, place_info)
+
+
+def get_selected_place_callback(session):
+    """Кнопка возврата к месту, выбранному в сессии (из "Поделиться" и "Назначить прогулку")"""
+    catalog = place_catalogs.for_user(session)
+    region = session.get('selected_region')
+    district = session.get('selected_district')
+    try:
+        region_index = catalog.regions.index(region)
+        district_index = catalog.districts(region).index(district)
+        place_index = catalog.places(region, district).index(session.get('selected_place'))
+    except ValueError:
+        return "choose_region"
+    return encode_place_callback(catalog, 'p', region_index, district_index, place_index)
+
+
+async def handle_place_callback(query, context, callback_data):
+    """
+    Кнопки выбора места: все, что нужно для ответа, есть в callback_data
+    
+    Ответ не зависит от сессии, поэтому кнопка работает в любом воркере и после
+    перезапуска, пока версия каталога хранится в памяти (см. PlaceCatalogStore).
+    Экран места запоминает выбор в context.user_data - он нужен кнопкам
+    "Поделиться" и "Назначить прогулку".
+    """
+    decoded = decode_place_callback(callback_data)
+    if decoded:
+        version, action, numbers = decoded
+        catalog = place_catalogs.get(version)
+    else:
+        catalog, action, numbers = resolve_legacy_place_callback(callback_data, context.user_data) or (None, None, None)
+    screen = await get_place_browse_screen(catalog, action, numbers) if catalog else None
+    if screen is None:
+        text, keyboard = get_regions_screen(place_catalogs.current)
+        await query.edit_message_text(f"{PLACE_CATALOG_CHANGED_TEXT}\n\n{text}", reply_markup=keyboard)
+        return ConversationHandler.END
+    
+    text, keyboard, place = screen
+    if place is None:
+        await query.edit_message_text(text, reply_markup=keyboard)
+        return ConversationHandler.END
+    
+    region, district, selected_place, place_info = place
+    context.user_data.update({
+        'place_catalog_version': catalog.version,
+        'selected_region': region,
+        'selected_district': district,
+        'selected_place': selected_place,
+        'selected_place_full': f"{region}, {district}, {selected_place}",
+    })
+    # Если есть фото места, отправляем его с подписью
+    if place_info.get('photo_url'):
+        try:
+            await context.bot.send_photo(
+                chat_id=query.from_user.id,
+                photo=place_info['photo_url'],
+                caption=text,
+                reply_markup=keyboard
+            )
+            # Удаляем предыдущее сообщение
+            await query.delete_message()
+            return ConversationHandler.END
+        except Exception as e:
+            logger.error("Ошибка при отправке фото места: %s", e)
+    await query.edit_message_text(text, reply_markup=keyboard)
+    return ConversationHandler.END
+
+
+def get_inline_place_result(catalog, number):
+    """Результат inline-запроса: место на карте (или карточка с поиском на Яндекс картах, если координат нет)"""
+    import urllib.parse
+    
+    region, district, name, lat, lon = catalog.search_index.places[number]
+    address = f"{district}, {region}"
+    result_id = f"{catalog.version}:{number}"
+    if lat is not None and lon is not None:
+        yandex_map_url = f"https://yandex.ru/maps/?pt={lon},{lat}&z=15&l=map"
+        keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("🗺️ Открыть на Яндекс картах", url=yandex_map_url)]])
+        return InlineQueryResultVenue(result_id, lat, lon, f"🌳 {name}", address, reply_markup=keyboard)
+    
+    yandex_map_url = f"https://yandex.ru/maps/?text={urllib.parse.quote(f'{name}, {address}')}"
+    keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("🗺️ Открыть на Яндекс картах", url=yandex_map_url)]])
+    return InlineQueryResultArticle(
+        result_id,
+        f"🌳 {name}",
+        InputTextMessageContent(f"🌳 Место для прогулки: {name}\n📍 {address}"),
+        reply_markup=keyboard,
+        description=address
+    )
+
+
+def get_district_menu():
+    """Меню выбора района"""
+    keyboard = [
+        [InlineKeyboardButton("Назад", callback_data="find_location")]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+
+def get_admin_menu():
+    """Меню администратора"""
+    keyboard = [
+        [InlineKeyboardButton("👥 Список подписчиков", callback_data="admin_list_subscribers")],
+        [InlineKeyboardButton(f"🔬 Профилировать {PROFILE_DURATION_SECONDS:.0f} с", callback_data="admin_profile")],
+        [InlineKeyboardButton("Назад", callback_data="main_menu")]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+
+def get_subscriber_management_menu(subscriber_id):
+    """Меню управления конкретным подписчиком"""
+    keyboard = [
+        [InlineKeyboardButton("Назад", callback_data="admin_list_subscribers")],
+        [InlineKeyboardButton("🏷️ Добавить метку", callback_data=f"admin_add_tag_{subscriber_id}")],
+        [InlineKeyboardButton("🏷️ Удалить метку", callback_data=f"admin_remove_tag_{subscriber_id}")],
+        [InlineKeyboardButton("✉️ Написать сообщение", callback_data=f"admin_message_{subscriber_id}")],
+        [InlineKeyboardButton("🗑️ Удалить контакт", callback_data=f"admin_delete_{subscriber_id}")]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+
+def parse_search_query(search_query):
+    """
+    Разбирает поисковый запрос пользователя
+    
+    Returns:
+        tuple: (запрос без @ в начале, нормализованный номер телефона или None)
+    """
+    # Определяем тип поиска: телефон или текст
+    # Убираем все нецифровые символы для проверки на телефон
+    phone_digits = ''.join(filter(str.isdigit, search_query))
+    is_phone_search = len(phone_digits) >= 7  # Минимум 7 цифр для номера телефона
+    
+    # Убираем @ если есть (для username)
+    if search_query.startswith('@'):
+        search_query = search_query[1:]
+    
+    # Нормализуем номер телефона для поиска (убираем + и пробелы)
+    normalized_search_phone = None
+    if is_phone_search:
+        normalized_search_phone = phone_digits
+        if normalized_search_phone.startswith('8') and len(normalized_search_phone) == 11:
+            # Заменяем 8 на 7 для российских номеров
+            normalized_search_phone = '7' + normalized_search_phone[1:]
+    
+    return search_query, normalized_search_phone
+
+
+def find_matching_users(users, search_query, normalized_search_phone=None, exclude_user_id=None):
+    """Ищет пользователей по номеру телефона, username, имени или фамилии"""
+    search_lower = search_query.lower()
+    found_users = []
+    for uid, user_info in users.items():
+        # Не показываем самого пользователя в результатах
+        if uid == exclude_user_id:
+            continue
+        
+        # Пропускаем пользователей без базовой информации
+        if not user_info.get('first_name') and not user_info.get('username'):
+            continue
+        
+        match_found = False
+        
+        # Поиск по номеру телефона (полное или частичное совпадение)
+        if normalized_search_phone:
+            user_phone = user_info.get('phone_number', '')
+            if user_phone:
+                user_phone_digits = ''.join(filter(str.isdigit, user_phone))
+                if user_phone_digits and (normalized_search_phone in user_phone_digits or user_phone_digits in normalized_search_phone):
+                    match_found = True
+        
+        # Поиск по username
+        if not match_found:
+            username = user_info.get('username', '').lower() if user_info.get('username') else ''
+            if username and search_lower in username:
+                match_found = True
+        
+        # Поиск по имени
+        if not match_found:
+            first_name = user_info.get('first_name', '').lower() if user_info.get('first_name') else ''
+            if first_name and search_lower in first_name:
+                match_found = True
+        
+        # Поиск по фамилии
+        if not match_found:
+            last_name = user_info.get('last_name', '').lower() if user_info.get('last_name') else ''
+            if last_name and search_lower in last_name:
+                match_found = True
+        
+        # Поиск по полному имени (имя + фамилия)
+        if not match_found:
+            full_name = f"{user_info.get('first_name', '')} {user_info.get('last_name', '')}".strip().lower()
+            if full_name and search_lower in full_name:
+                match_found = True
+        
+        if match_found:
+            found_users.append({
+                'user_id': uid,
+                'username': user_info.get('username'),
+                'first_name': user_info.get('first_name'),
+                'last_name': user_info.get('last_name'),
+                'phone_number': user_info.get('phone_number'),
+                'phone_verified': user_info.get('phone_verified', False)
+            })
+    return found_users
+
+
+def find_users_with_phone(users, phone_number, exclude_user_id=None):
+    """Пользователи с таким же номером телефона"""
+    matching_users = []
+    for uid, user_info in users.items():
+        if uid != exclude_user_id and user_info.get('phone_number') == phone_number:
+            matching_users.append({
+                'user_id': uid,
+                'name': user_info.get('first_name', 'Пользователь'),
+                'username': user_info.get('username')
+            })
+    return matching_users
+
+
+def find_users_in_location(users, selected_location, exclude_user_id=None):
+    """Пользователи, у которых место для прогулок в профиле содержит selected_location"""
+    selected_lower = selected_location.lower()
+    users_in_location = []
+    for uid, user_info in users.items():
+        # Пропускаем самого пользователя
+        if uid == exclude_user_id:
+            continue
+        
+        user_location = user_info.get('walking_location', '')
+        if user_location and selected_lower in user_location.lower():
+            users_in_location.append({
+                'user_id': uid,
+                'first_name': user_info.get('first_name', 'Пользователь'),
+                'last_name': user_info.get('last_name', ''),
+                'username': user_info.get('username', ''),
+                'walking_location': user_location
+            })
+    return users_in_location
+
+
+def delete_user_records(users, requests, subscriber_id, affected):
+    """
+    Удаляет пользователя, его входящие запросы в друзья и ссылки на него в списках друзей
+    
+    affected - ID тех, у кого пользователь в друзьях (friend_followers): меняются
+    только их записи, остальная база не читается.
+    
+    Returns:
+        dict: данные удаленного пользователя или None, если его не было
+    """
+    subscriber_info = users.pop(subscriber_id, None)
+    if subscriber_info is None:
+        return None
+    
+    # Удаляем из friend_requests, если есть
+    requests.pop(subscriber_id, None)
+    
+    # Удаляем из списков друзей других пользователей
+    for user_id in affected:
+        user_info = users.get(user_id)
+        if user_info and 'friends' in user_info:
+            user_info['friends'] = [
+                f for f in user_info['friends']
+                if isinstance(f, dict) and f.get('user_id') != subscriber_id
+            ]
+    return subscriber_info
+
+
+def haversine_meters(lat1, lon1, lat2, lon2):
+    """Расстояние между двумя точками по поверхности Земли, метры"""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * 6371000 * math.asin(math.sqrt(a))
+
+
+class GridIndex:
+    """
+    Пространственный индекс точек: квадратная сетка со стороной cell_size метров
+    
+    Поиск в радиусе проверяет только соседние ячейки, а перемещение точки стоит O(1),
+    поэтому индекс выдерживает тысячи точек, которые двигаются каждые несколько секунд.
+    """
+    
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self._cells = {}  # {(x, y): set(ключей)}
+        self._points = {}  # {ключ: (lat, lon, ячейка)}
+    
+    def __len__(self):
+        return len(self._points)
+    
+    def __contains__(self, key):
+        return key in self._points
+    
+    def cell(self, lat, lon):
+        # Равнопромежуточная проекция: на масштабе города искажения пренебрежимо малы
+        x = lon * 111320 * math.cos(math.radians(lat))
+        y = lat * 110574
+        return int(x // self.cell_size), int(y // self.cell_size)
+    
+    def position(self, key):
+        point = self._points.get(key)
+        return (point[0], point[1]) if point else None
+    
+    def update(self, key, lat, lon):
+        cell = self.cell(lat, lon)
+        previous = self._points.get(key)
+        if previous and previous[2] != cell:
+            self._discard(key, previous[2])
+        if not previous or previous[2] != cell:
+            self._cells.setdefault(cell, set()).add(key)
+        self._points[key] = (lat, lon, cell)
+    
+    def remove(self, key):
+        point = self._points.pop(key, None)
+        if point:
+            self._discard(key, point[2])
+    
+    def _discard(self, key, cell):
+        keys = self._cells.get(cell)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._cells[cell]
+    
+    def near(self, lat, lon, radius):
+        """Пары (ключ, расстояние в метрах) для точек не дальше radius"""
+        cell_x, cell_y = self.cell(lat, lon)
+        span = math.ceil(radius / self.cell_size)
+        for dx in range(-span, span + 1):
+            for dy in range(-span, span + 1):
+                for key in self._cells.get((cell_x + dx, cell_y + dy), ()):
+                    point = self._points[key]
+                    distance = haversine_meters(lat, lon, point[0], point[1])
+                    if distance <= radius:
+                        yield key, distance
+
+
+class KDTree:
+    """
+    Неизменяемое k-d дерево для поиска ближайших точек
+    
+    Точки переводятся в векторы на единичной сфере: расстояние между векторами растет
+    вместе с расстоянием по поверхности Земли, поэтому поиск верен в любом месте, без
+    искажений проекции. Дерево хранится в списке: узел диапазона [lo, hi) - его
+    середина, левое поддерево - [lo, mid), правое - [mid + 1, hi).
+    """
+    
+    def __init__(self, points):
+        """points - пары ((lat, lon), значение)"""
+        nodes = [(self.unit_vector(lat, lon), (lat, lon), value) for (lat, lon), value in points]
+        self._build(nodes, 0, len(nodes), 0)
+        self._vectors = [node[0] for node in nodes]
+        self._coords = [node[1] for node in nodes]
+        self._values = [node[2] for node in nodes]
+    
+    def __len__(self):
+        return len(self._values)
+    
+    @staticmethod
+    def unit_vector(lat, lon):
+        lat, lon = math.radians(lat), math.radians(lon)
+        return math.cos(lat) * math.cos(lon), math.cos(lat) * math.sin(lon), math.sin(lat)
+    
+    def _build(self, nodes, lo, hi, depth):
+        # Сортировка диапазона по оси уровня ставит медиану в середину
+        while hi - lo > 1:
+            axis = depth % 3
+            nodes[lo:hi] = sorted(nodes[lo:hi], key=lambda node: node[0][axis])
+            mid = (lo + hi) // 2
+            self._build(nodes, lo, mid, depth + 1)
+            lo, depth = mid + 1, depth + 1
+    
+    def nearest(self, lat, lon, k, max_distance=None):
+        """До k пар (расстояние в метрах, значение), ближайшие первыми"""
+        if k <= 0 or not self._values:
+            return []
+        tx, ty, tz = self.unit_vector(lat, lon)
+        # Квадрат хорды, дальше которой точки не нужны
+        limit = math.inf
+        if max_distance is not None:
+            limit = (2 * math.sin(min(max_distance / 6371000, math.pi) / 2)) ** 2
+        best = []  # Куча (-квадрат хорды, индекс) из найденных лучших
+        # Стек (lo, hi, глубина, квадрат расстояния до разделяющей плоскости родителя).
+        # Ближняя половина кладется последней и просматривается первой, дальняя
+        # отбрасывается, если плоскость дальше худшей из k найденных точек.
+        stack = [(0, len(self._values), 0, 0.0)]
+        while stack:
+            lo, hi, depth, gap = stack.pop()
+            worst = -best[0][0] if len(best) == k else limit
+            if lo >= hi or gap > worst:
+                continue
+            mid = (lo + hi) // 2
+            x, y, z = self._vectors[mid]
+            distance = (x - tx) ** 2 + (y - ty) ** 2 + (z - tz) ** 2
+            if distance <= worst:
+                if len(best) == k:
+                    heapq.heapreplace(best, (-distance, mid))
+                else:
+                    heapq.heappush(best, (-distance, mid))
+            diff = (tx, ty, tz)[depth % 3] - self._vectors[mid][depth % 3]
+            if diff < 0:
+                stack.append((mid + 1, hi, depth + 1, diff * diff))
+                stack.append((lo, mid, depth + 1, gap))
+            else:
+                stack.append((lo, mid, depth + 1, diff * diff))
+                stack.append((mid + 1, hi, depth + 1, gap))
+        results = []
+        for _, index in best:
+            point_lat, point_lon = self._coords[index]
+            results.append((haversine_meters(lat, lon, point_lat, point_lon), self._values[index]))
+        results.sort(key=lambda result: result[0])
+        return results
+
+
+# Виды мест в POI_FILE: (заголовок экрана, "не нашлось ...")
+POI_KINDS = {
+    'vet': ("🏥 Ближайшие ветклиники", "ветклиник"),
+    'pet_shop': ("🛒 Ближайшие зоомагазины", "зоомагазинов"),
+}
+
+
+class PoiIndex:
+    """
+    Ветклиники и зоомагазины из POI_FILE, по k-d дереву на каждый вид
+    
+    Файл - JSON-список мест с полями kind (vet или pet_shop), name, lat, lon и
+    необязательными address, opening_hours, phone. Читается один раз при запуске,
+    поиск ближайших занимает доли миллисекунды и не обращается к внешним API.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self._trees = {}
+    
+    def __len__(self):
+        return sum(len(tree) for tree in self._trees.values())
+    
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                records = json.load(f)
+        except FileNotFoundError:
+            logger.info("Файл %s не найден, поиск ветклиник и зоомагазинов недоступен", self.path)
+            return
+        except (OSError, ValueError) as e:
+            logger.error("Ошибка при загрузке %s: %s", self.path, e)
+            return
+        started = time.perf_counter()
+        points = {kind: [] for kind in POI_KINDS}
+        skipped = 0
+        for record in records if isinstance(records, list) else ():
+            try:
+                kind = record['kind']
+                lat, lon = float(record['lat']), float(record['lon'])
+            except (KeyError, TypeError, ValueError):
+                skipped += 1
+                continue
+            if kind not in points or not (-90 <= lat <= 90 and -180 <= lon <= 180):
+                skipped += 1
+                continue
+            place = {
+                'lat': lat,
+                'lon': lon,
+                'name': str(record.get('name') or '').strip(),
+                'address': str(record.get('address') or '').strip(),
+                'opening_hours': str(record.get('opening_hours') or '').strip(),
+                'phone': str(record.get('phone') or '').strip(),
+            }
+            points[kind].append(((lat, lon), place))
+        self._trees = {kind: KDTree(kind_points) for kind, kind_points in points.items()}
+        logger.info(
+            "Загружено мест из %s: %s, пропущено записей: %d (%.0f мс)",
+            self.path, ', '.join(f"{kind} {len(tree)}" for kind, tree in self._trees.items()),
+            skipped, (time.perf_counter() - started) * 1000
+        )
+    
+    def nearest(self, kind, lat, lon, k=POI_NEAREST_COUNT, max_distance=POI_MAX_DISTANCE_METERS):
+        """До k пар (расстояние в метрах, место) вида kind, ближайшие первыми"""
+        tree = self._trees.get(kind)
+        return tree.nearest(lat, lon, k, max_distance) if tree else []
+    
+    def start(self):
+        self.load()
+
+
+poi_index = PoiIndex(POI_FILE)
+
+
+def get_poi_screen(kind, user_info):
+    """Текст и клавиатура экрана ближайших ветклиник или зоомагазинов"""
+    title, plural = POI_KINDS[kind]
+    lat = (user_info or {}).get('walking_location_lat')
+    lon = (user_info or {}).get('walking_location_lon')
+    if lat is None or lon is None:
+        keyboard = InlineKeyboardMarkup([
+            [InlineKeyboardButton("📍 Где я гуляю", callback_data="my_walking_location")],
+            [InlineKeyboardButton("Назад", callback_data="main_menu")]
+        ])
+        return (
+            f"{title}\n\n"
+            "Чтобы найти ближайшие, отправьте геопозицию места, где вы гуляете: "
+            "«Мой профиль» → «Где я гуляю».",
+            keyboard
+        )
+    
+    results = poi_index.nearest(kind, lat, lon)
+    if not results:
+        return (
+            f"{title}\n\n"
+            f"Не нашлось {plural} ближе {format_distance(POI_MAX_DISTANCE_METERS)} от места вашей прогулки.",
+            InlineKeyboardMarkup([[InlineKeyboardButton("Назад", callback_data="main_menu")]])
+        )
+    
+    lines = [title, "От места вашей прогулки:", ""]
+    keyboard = []
+    for number, (distance, place) in enumerate(results, 1):
+        name = place['name'] or "Без названия"
+        lines.append(f"{number}. {name} — {format_distance(distance)}")
+        if place['address']:
+            lines.append(f"   📍 {place['address']}")
+        if place['opening_hours']:
+            lines.append(f"   🕒 {place['opening_hours']}")
+        if place['phone']:
+            lines.append(f"   📞 {place['phone']}")
+        keyboard.append([InlineKeyboardButton(
+            f"🗺️ {number}. {name[:40]}",
+            url=f"https://yandex.ru/maps/?pt={place['lon']},{place['lat']}&z=17&l=map"
+        )])
+    keyboard.append([InlineKeyboardButton("Назад", callback_data="main_menu")])
+    return '\n'.join(lines), InlineKeyboardMarkup(keyboard)
+
+
+def get_friend_ids(user_info):
+    """ID друзей пользователя из его записи в user_data"""
+    return {
+        friend['user_id']
+        for friend in (user_info or {}).get('friends', [])
+        if isinstance(friend, dict) and friend.get('user_id')
+    }
+
+
+class WalkTrack:
+    """
+    Трек прогулки: точки в массивах float32 (12 байт на точку) и статистика,
+    которая обновляется по мере поступления точек
+    """
+    
+    def __init__(self, started_at):
+        self.started_at = started_at
+        self.ended_at = started_at
+        self.lats = array('f')
+        self.lons = array('f')
+        self.offsets = array('f')  # Секунды от начала прогулки
+        self.distance = 0.0  # Метры
+        self.max_speed = 0.0  # Метры в секунду
+        self._last = None  # Последняя точка трека в полной точности: (lat, lon, время)
+    
+    def __len__(self):
+        return len(self.lats)
+    
+    @property
+    def duration(self):
+        return self.ended_at - self.started_at
+    
+    @property
+    def pace(self):
+        """Секунды на километр или None, если пройдено слишком мало"""
+        if self.distance < 100:
+            return None
+        return self.duration / (self.distance / 1000)
+    
+    def add(self, lat, lon, timestamp):
+        """Добавляет точку. Возвращает False, если точка почти не сдвинулась (шум GPS)"""
+        self.ended_at = max(self.ended_at, timestamp)
+        if self._last is not None:
+            step = haversine_meters(self._last[0], self._last[1], lat, lon)
+            if step < TRACK_MIN_STEP_METERS:
+                return False
+            elapsed = timestamp - self._last[2]
+            if elapsed > 0:
+                self.max_speed = max(self.max_speed, step / elapsed)
+            self.distance += step
+        self._last = (lat, lon, timestamp)
+        self.lats.append(lat)
+        self.lons.append(lon)
+        self.offsets.append(timestamp - self.started_at)
+        return True
+    
+    def points_bytes(self, start=0):
+        """Точки начиная с start, упакованные тройками float32 (lat, lon, offset)"""
+        packed = array('f')
+        for index in range(start, len(self.lats)):
+            packed.extend((self.lats[index], self.lons[index], self.offsets[index]))
+        return packed.tobytes()
+    
+    def state(self):
+        return {'ended_at': self.ended_at, 'distance': self.distance, 'max_speed': self.max_speed}
+    
+    @classmethod
+    def restore(cls, started_at, state, chunks):
+        """Трек из state() и фрагментов points_bytes()"""
+        track = cls(started_at)
+        track.ended_at = state['ended_at']
+        track.distance = state['distance']
+        track.max_speed = state['max_speed']
+        for chunk in chunks:
+            packed = array('f')
+            packed.frombytes(chunk)
+            track.lats.extend(packed[0::3])
+            track.lons.extend(packed[1::3])
+            track.offsets.extend(packed[2::3])
+        if track.lats:
+            track._last = (track.lats[-1], track.lons[-1], started_at + track.offsets[-1])
+        return track
+
+
+def simplify_track(lats, lons, epsilon):
+    """
+    Упрощение ломаной алгоритмом Дугласа - Пекера
+    
+    Returns:
+        list: индексы точек, которые остаются (первая и последняя - всегда)
+    """
+    count = len(lats)
+    if count < 3:
+        return list(range(count))
+    # Локальная проекция в метры относительно первой точки
+    scale_x = 111320 * math.cos(math.radians(lats[0]))
+    xs = [(lon - lons[0]) * scale_x for lon in lons]
+    ys = [(lat - lats[0]) * 110574 for lat in lats]
+    
+    keep = [False] * count
+    keep[0] = keep[-1] = True
+    stack = [(0, count - 1)]
+    while stack:
+        first, last = stack.pop()
+        dx = xs[last] - xs[first]
+        dy = ys[last] - ys[first]
+        length = math.hypot(dx, dy)
+        farthest, max_distance = None, epsilon
+        for index in range(first + 1, last):
+            px = xs[index] - xs[first]
+            py = ys[index] - ys[first]
+            if length:
+                distance = abs(dx * py - dy * px) / length
+            else:
+                distance = math.hypot(px, py)
+            if distance > max_distance:
+                farthest, max_distance = index, distance
+        if farthest is not None:
+            keep[farthest] = True
+            stack.append((first, farthest))
+            stack.append((farthest, last))
+    return [index for index in range(count) if keep[index]]
+
+
+def encode_track(track, epsilon=TRACK_SIMPLIFY_METERS):
+    """Упрощенный трек для хранения: тройки float32 (lat, lon, offset), сжатые zlib"""
+    packed = array('f')
+    for index in simplify_track(track.lats, track.lons, epsilon):
+        packed.extend((track.lats[index], track.lons[index], track.offsets[index]))
+    return zlib.compress(packed.tobytes()), len(packed) // 3
+
+
+def decode_track(blob):
+    """Список точек (lat, lon, offset) из encode_track()"""
+    packed = array('f')
+    packed.frombytes(zlib.decompress(blob))
+    return list(zip(packed[0::3], packed[1::3], packed[2::3]))
+
+
+def format_distance(meters):
+    if meters < 1000:
+        return f"{meters:.0f} м"
+    return f"{meters / 1000:.1f} км"
+
+
+def format_duration(seconds):
+    minutes = int(seconds // 60)
+    if minutes < 60:
+        return f"{minutes} мин"
+    return f"{minutes // 60} ч {minutes % 60:02d} мин"
+
+
+def format_pace(seconds_per_km):
+    return f"{int(seconds_per_km // 60)}:{int(seconds_per_km % 60):02d} мин/км"
+
+
+def format_walk_summary(track):
+    """Итоги прогулки для сообщения пользователю"""
+    lines = [
+        "🏁 Прогулка завершена!",
+        "",
+        f"📏 Дистанция: {format_distance(track.distance)}",
+        f"⏱ Время: {format_duration(track.duration)}"
+    ]
+    if track.pace:
+        lines.append(f"🐾 Средний темп: {format_pace(track.pace)}")
+    return "\n".join(lines)
+
+
+class WalkHistory:
+    """
+    История прогулок в базе состояния
+    
+    Трек хранится упрощенным и сжатым (обычно несколько КБ на прогулку), а итоги
+    по неделям копятся в отдельной таблице при сохранении каждой прогулки, поэтому
+    экран "Мои прогулки" не пересчитывает треки.
+    """
+    
+    def __init__(self):
+        self._conn = None
+    
+    def connect(self):
+        if self._conn is None:
+            self._conn = open_state_db()
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS walks (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, "
+                "started_at REAL NOT NULL, ended_at REAL NOT NULL, distance REAL NOT NULL, points INTEGER NOT NULL, "
+                "track BLOB NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS walks_user ON walks (user_id, started_at)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS walk_weeks (user_id INTEGER NOT NULL, week TEXT NOT NULL, "
+                "walks INTEGER NOT NULL, distance REAL NOT NULL, duration REAL NOT NULL, PRIMARY KEY (user_id, week))"
+            )
+        return self._conn
+    
+    def save(self, user_id, track):
+        """Сохраняет прогулку и добавляет ее к итогам недели"""
+        blob, points = encode_track(track)
+        week = datetime.fromtimestamp(track.started_at, SCHEDULE_TZ).strftime('%G-W%V')
+        conn = self.connect()
+        with conn:
+            conn.execute("BEGIN")
+            conn.execute(
+                "INSERT INTO walks (user_id, started_at, ended_at, distance, points, track) VALUES (?, ?, ?, ?, ?, ?)",
+                (user_id, track.started_at, track.ended_at, track.distance, points, blob)
+            )
+            conn.execute(
+                "INSERT INTO walk_weeks (user_id, week, walks, distance, duration) VALUES (?, ?, 1, ?, ?) "
+                "ON CONFLICT (user_id, week) DO UPDATE SET walks = walks + 1, "
+                "distance = distance + excluded.distance, duration = duration + excluded.duration",
+                (user_id, week, track.distance, track.duration)
+            )
+        logger.info(
+            "Прогулка пользователя %s сохранена: %.0f м, %s точек из %s, %s байт",
+            user_id, track.distance, points, len(track), len(blob)
+        )
+    
+    def weeks(self, user_id, limit=WALK_HISTORY_WEEKS):
+        """Итоги последних недель: [(неделя, прогулок, метров, секунд)]"""
+        return self.connect().execute(
+            "SELECT week, walks, distance, duration FROM walk_weeks WHERE user_id = ? ORDER BY week DESC LIMIT ?",
+            (user_id, limit)
+        ).fetchall()
+    
+    def recent(self, user_id, limit=5):
+        """Последние прогулки: [(начало, конец, метров)]"""
+        return self.connect().execute(
+            "SELECT started_at, ended_at, distance FROM walks WHERE user_id = ? ORDER BY started_at DESC LIMIT ?",
+            (user_id, limit)
+        ).fetchall()
+
+
+walk_history = WalkHistory()
+
+
+class LiveWalkTracker:
+    """
+    Прогулки с живой геопозицией ("Я гуляю сейчас")
+    
+    Telegram присылает новую позицию правкой сообщения каждые несколько секунд.
+    Обработчик только запоминает последнюю позицию (более ранние перезаписываются),
+    а фоновая задача раз в tick секунд переносит последние позиции в GridIndex, ищет
+    друзей в радиусе и завершает прогулки без обновлений дольше idle_timeout. О каждом
+    друге рядом гуляющий узнает не больше одного раза за прогулку. Перенесенные позиции
+    складываются в WalkTrack; по окончании прогулки трек сохраняется в walk_history,
+    а пользователь получает итоги.
+    
+    Прогулки записываются в базу состояния не чаще раза в persist_interval секунд и
+    переживают перезапуск (из трека дописываются только новые точки). В режиме
+    воркеров запись идет каждый такт: так воркеры видят гуляющих пользователей друг друга.
+    """
+    
+    def __init__(self, radius, tick, idle_timeout, persist_interval):
+        self.radius = radius
+        self.tick = tick
+        self.idle_timeout = idle_timeout
+        self.persist_interval = persist_interval
+        self.shard = None  # (индекс воркера, число воркеров) в режиме воркеров
+        self.notifications_total = 0
+        self._walks = {}  # Прогулки пользователей этого процесса: {user_id: {...}}
+        self._latest = {}  # Позиции, еще не перенесенные в индекс: {user_id: (lat, lon, время)}
+        self._stopped = {}  # Трансляции, завершенные кнопкой в боте: {user_id: message_id}
+        self._remote = {}  # Гуляющие из других воркеров: {user_id: время последнего обновления}
+        self._index = GridIndex(radius)
+        self._dirty = set()
+        self._finished = set()
+        self._last_persist = 0.0
+        self._remote_synced = 0.0
+        self._conn = None
+        self._task = None
+        self._bot = None
+    
+    def __len__(self):
+        return len(self._walks)
+    
+    @property
+    def shared(self):
+        return isinstance(user_data, SharedMapping)
+    
+    def get(self, user_id):
+        return self._walks.get(user_id)
+    
+    def update(self, user_id, message_id, lat, lon, expires_at):
+        """Принимает позицию живой геопозиции. Возвращает True, если прогулка только началась"""
+        if self._stopped.get(user_id) == message_id:
+            return False
+        now = time.time()
+        walk = self._walks.get(user_id)
+        started = walk is None or walk['message_id'] != message_id
+        if started:
+            if walk is not None:
+                self.finish(user_id)  # Пользователь начал новую трансляцию, не остановив старую
+            self._stopped.pop(user_id, None)
+            walk = self._walks[user_id] = {
+                'message_id': message_id,
+                'started_at': now,
+                'updated_at': now,
+                'expires_at': expires_at,
+                'lat': None,
+                'lon': None,
+                'friends': get_friend_ids(user_data.get(user_id)),
+                'notified': set(),
+                'track': WalkTrack(now),
+                'track_saved': 0  # Точек трека, уже записанных в базу
+            }
+        walk['expires_at'] = expires_at
+        self._latest[user_id] = (lat, lon, now)
+        return started
+    
+    def finish(self, user_id):
+        """Завершает прогулку и сохраняет ее трек. Возвращает данные прогулки или None"""
+        walk = self._walks.pop(user_id, None)
+        if walk is None:
+            return None
+        latest = self._latest.pop(user_id, None)
+        if latest:
+            walk['track'].add(*latest)
+        self._index.remove(user_id)
+        self._dirty.discard(user_id)
+        self._finished.add(user_id)
+        if len(walk['track']) >= 2:
+            try:
+                walk_history.save(user_id, walk['track'])
+            except Exception as e:
+                logger.error("Не удалось сохранить прогулку пользователя %s: %s", user_id, e, exc_info=True)
+        return walk
+    
+    def stop_walk(self, user_id):
+        """Завершает прогулку по кнопке: дальнейшие позиции той же трансляции игнорируются"""
+        walk = self.finish(user_id)
+        if walk:
+            self._stopped[user_id] = walk['message_id']
+        return walk
+    
+    def collect(self):
+        """Переносит последние позиции в индекс. Возвращает сдвинувшихся пользователей"""
+        latest, self._latest = self._latest, {}
+        moved = []
+        for user_id, (lat, lon, received) in latest.items():
+            walk = self._walks.get(user_id)
+            if walk is None:
+                continue
+            walk['lat'], walk['lon'], walk['updated_at'] = lat, lon, received
+            walk['track'].add(lat, lon, received)
+            self._index.update(user_id, lat, lon)
+            self._dirty.add(user_id)
+            moved.append(user_id)
+        return moved
+    
+    def expire(self, now):
+        """Завершает прогулки без обновлений. Возвращает [(user_id, прогулка)]"""
+        expired = []
+        for user_id, walk in list(self._walks.items()):
+            if now - walk['updated_at'] > self.idle_timeout or now > walk['expires_at']:
+                expired.append((user_id, self.finish(user_id)))
+        for user_id, updated_at in list(self._remote.items()):
+            if now - updated_at > self.idle_timeout:
+                del self._remote[user_id]
+                self._index.remove(user_id)
+        return expired
+    
+    def find_meetings(self, moved):
+        """Тройки (кого уведомить, о ком, расстояние) для друзей, оказавшихся рядом"""
+        meetings = []
+        for user_id in moved:
+            position = self._index.position(user_id)
+            if position is None:
+                continue
+            for other_id, distance in self._index.near(position[0], position[1], self.radius):
+                if other_id == user_id:
+                    continue
+                for owner, other in ((user_id, other_id), (other_id, user_id)):
+                    walk = self._walks.get(owner)
+                    if walk and other in walk['friends'] and other not in walk['notified']:
+                        walk['notified'].add(other)
+                        self._dirty.add(owner)
+                        meetings.append((owner, other, distance))
+        return meetings
+    
+    async def notify(self, owner, other, distance):
+        position = self._index.position(other)
+        if position is None:
+            return
+        other_info = user_data.get(other) or {}
+        other_name = other_info.get('first_name') or 'Друг'
+        if other_info.get('username'):
+            other_name += f" (@{other_info['username']})"
+        keyboard = InlineKeyboardMarkup([[
+            InlineKeyboardButton(
+                "🗺️ Открыть на Яндекс картах",
+                url=f"https://yandex.ru/maps/?pt={position[1]},{position[0]}&z=16&l=map"
+            )
+        ]])
+        try:
+            await self._bot.send_message(
+                chat_id=owner,
+                text=f"🐕 Друг рядом!\n\n{other_name} тоже гуляет сейчас, примерно в {round(distance, -1):.0f} м от вас.",
+                reply_markup=keyboard
+            )
+            self.notifications_total += 1
+        except Exception as e:
+            logger.warning("Не удалось уведомить %s о друге рядом: %s", owner, e)
+    
+    def load(self):
+        """Восстанавливает прогулки этого процесса из базы"""
+        self._conn = open_state_db()
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS live_walks (user_id INTEGER PRIMARY KEY, lat REAL, lon REAL, "
+            "updated_at REAL NOT NULL, written_at REAL NOT NULL, data TEXT)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS walk_points (user_id INTEGER NOT NULL, seq INTEGER NOT NULL, "
+            "points BLOB NOT NULL, PRIMARY KEY (user_id, seq))"
+        )
+        # Прогулки, которые истекли, пока бот был остановлен, тоже восстанавливаются:
+        # первый такт завершит их, сохранит треки и отправит итоги
+        rows = self._conn.execute(
+            "SELECT user_id, lat, lon, updated_at, data FROM live_walks WHERE lat IS NOT NULL"
+        ).fetchall()
+        for user_id, lat, lon, updated_at, raw in rows:
+            if self.shard and shard_for_user(user_id, self.shard[1]) != self.shard[0]:
+                continue
+            walk = json.loads(raw)
+            chunks = [
+                chunk for (chunk,) in self._conn.execute(
+                    "SELECT points FROM walk_points WHERE user_id = ? ORDER BY seq", (user_id,)
+                )
+            ]
+            track = WalkTrack.restore(walk['started_at'], walk.pop('track'), chunks)
+            walk.update(
+                lat=lat, lon=lon, updated_at=updated_at,
+                friends=get_friend_ids(user_data.get(user_id)),
+                notified=set(walk['notified']),
+                track=track,
+                track_saved=len(track)
+            )
+            self._walks[user_id] = walk
+            self._index.update(user_id, lat, lon)
+        if not self.shard:
+            self._conn.execute("DELETE FROM live_walks WHERE lat IS NULL")
+            self._conn.execute("DELETE FROM walk_points WHERE user_id NOT IN (SELECT user_id FROM live_walks)")
+        if self._walks:
+            logger.info("Восстановлено прогулок с живой геопозицией: %s", len(self._walks))
+    
+    def flush(self, now):
+        """Записывает изменившиеся и завершенные прогулки"""
+        if not self._conn:
+            return
+        dirty, self._dirty = self._dirty, set()
+        finished, self._finished = self._finished, set()
+        rows = []
+        chunks = []
+        for user_id in dirty:
+            walk = self._walks.get(user_id)
+            if walk is None or walk['lat'] is None:
+                continue
+            data = {
+                'message_id': walk['message_id'],
+                'started_at': walk['started_at'],
+                'expires_at': walk['expires_at'],
+                'notified': sorted(walk['notified']),
+                'track': walk['track'].state()
+            }
+            rows.append((user_id, walk['lat'], walk['lon'], walk['updated_at'], now, json.dumps(data)))
+            # Из трека дописываются только точки, добавленные после прошлой записи
+            track = walk['track']
+            if len(track) > walk['track_saved']:
+                chunks.append((user_id, walk['track_saved'], track.points_bytes(walk['track_saved'])))
+                walk['track_saved'] = len(track)
+        self._last_persist = now
+        if not rows and not finished:
+            return
+        with self._conn:
+            self._conn.execute("BEGIN")
+            # Сначала завершенные: пользователь мог сразу начать новую прогулку.
+            # Они остаются в таблице без координат, пока их не увидят другие воркеры
+            self._conn.executemany(
+                "UPDATE live_walks SET lat = NULL, lon = NULL, written_at = ? WHERE user_id = ?",
+                [(now, user_id) for user_id in finished]
+            )
+            self._conn.executemany("DELETE FROM walk_points WHERE user_id = ?", [(user_id,) for user_id in finished])
+            self._conn.executemany(
+                "INSERT INTO live_walks (user_id, lat, lon, updated_at, written_at, data) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (user_id) DO UPDATE SET lat = excluded.lat, lon = excluded.lon, "
+                "updated_at = excluded.updated_at, written_at = excluded.written_at, data = excluded.data",
+                rows
+            )
+            self._conn.executemany("INSERT OR REPLACE INTO walk_points (user_id, seq, points) VALUES (?, ?, ?)", chunks)
+            self._conn.execute(
+                "DELETE FROM live_walks WHERE written_at < ? AND (lat IS NULL OR updated_at < ?)",
+                (now - self.idle_timeout, now - self.idle_timeout)
+            )
+    
+    def sync_remote(self, now):
+        """Режим воркеров: подтягивает позиции гуляющих из других воркеров. Возвращает сдвинувшихся"""
+        rows = self._conn.execute(
+            "SELECT user_id, lat, lon FROM live_walks WHERE written_at > ? AND updated_at > ?",
+            (self._remote_synced, now - self.idle_timeout)
+        ).fetchall()
+        # Запас в один такт: другой воркер мог записать строку с чуть более ранним временем
+        self._remote_synced = now - self.tick
+        moved = []
+        for user_id, lat, lon in rows:
+            if shard_for_user(user_id, self.shard[1]) == self.shard[0]:
+                continue
+            if lat is None:
+                self._remote.pop(user_id, None)
+                self._index.remove(user_id)
+            elif self._index.position(user_id) != (lat, lon):
+                self._remote[user_id] = now
+                self._index.update(user_id, lat, lon)
+                moved.append(user_id)
+        return moved
+    
+    async def step(self):
+        now = time.time()
+        begin_shared_session()
+        moved = self.collect()
+        expired = self.expire(now)
+        if self.shared:
+            self.flush(now)
+            moved += self.sync_remote(now)
+        elif now - self._last_persist >= self.persist_interval:
+            self.flush(now)
+        for owner, other, distance in self.find_meetings(moved):
+            await self.notify(owner, other, distance)
+        for user_id, walk in expired:
+            try:
+                await self._bot.send_message(chat_id=user_id, text=format_walk_summary(walk['track']))
+            except Exception as e:
+                logger.warning("Не удалось отправить итоги прогулки %s: %s", user_id, e)
+    
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            try:
+                await self.step()
+            except Exception as e:
+                logger.error("Ошибка при обработке живых геопозиций: %s", e, exc_info=True)
     
-    # Если нет специфичных мест, формируем общий список без названия района
-    base_places = [
-        "Центральный парк",
-        "Парк Победы",
-        "Лесопарк",
-        "Сквер у озера",
-        "Набережная",
-        "Парк культуры и отдыха",
-        "Детский парк",
-        "Ботанический сад",
-        "Лесная зона",
-        "Сквер возле реки",
-        "Парк развлечений",
-        "Аллея для прогулок",
-        "Зона отдыха",
-        "Парк с озером",
-        "Природный парк"
+    def start(self, application):
+        self._bot = application.bot
+        self.load()
+        self._task = asyncio.create_task(self.run())
+    
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        self.collect()
+        self.flush(time.time())
+
+
+live_walks = LiveWalkTracker(LIVE_WALK_RADIUS_METERS, LIVE_WALK_TICK_SECONDS, LIVE_WALK_IDLE_TIMEOUT, LIVE_WALK_PERSIST_INTERVAL)
+
+
+DAY_MINUTES = 24 * 60
+WEEK_MINUTES = 7 * DAY_MINUTES
+WEEKDAY_NAMES = ('пн', 'вт', 'ср', 'чт', 'пт', 'сб', 'вс')
+# Начала слов, по которым узнается день недели ("пн", "понедельник", "пон")
+WEEKDAY_ALIASES = (
+    ('пн', 0), ('пон', 0), ('вт', 1), ('ср', 2), ('чт', 3), ('чет', 3),
+    ('пт', 4), ('пят', 4), ('сб', 5), ('суб', 5), ('вс', 6), ('вос', 6)
+)
+WEEKDAY_GROUPS = {
+    'будни': (0, 1, 2, 3, 4),
+    'выходные': (5, 6),
+    'ежедневно': tuple(range(7)),
+    'каждый': tuple(range(7))
+}
+WALK_TIME_RANGE_RE = re.compile(r'(\d{1,2})(?:[:.](\d{2}))?\s*-\s*(\d{1,2})(?:[:.](\d{2}))?')
+
+
+def parse_weekdays(text):
+    """
+    Дни недели из текста ("будни", "пн-пт", "сб, вс"). Пустой текст - каждый день
+    
+    Returns:
+        list: номера дней (0 - понедельник) или None, если текст не разобран
+    """
+    days = set()
+    for token in re.split(r'[\s,:]+', text.strip()):
+        if token in ('', 'и', 'по', 'день'):
+            continue
+        if token in WEEKDAY_GROUPS:
+            days.update(WEEKDAY_GROUPS[token])
+            continue
+        first, _, last = token.partition('-')
+        first_day = next((day for alias, day in WEEKDAY_ALIASES if first.startswith(alias)), None)
+        last_day = next((day for alias, day in WEEKDAY_ALIASES if last.startswith(alias)), None) if last else first_day
+        if first_day is None or last_day is None:
+            return None
+        day = first_day
+        days.add(day)
+        while day != last_day:
+            day = (day + 1) % 7
+            days.add(day)
+    return sorted(days) if days else list(range(7))
+
+
+def merge_walk_windows(windows):
+    """Сортирует окна [начало, конец), делит окна через полночь воскресенья и сливает пересечения"""
+    pieces = []
+    for start, end in windows:
+        if end > WEEK_MINUTES:
+            pieces.append((start, WEEK_MINUTES))
+            pieces.append((0, end - WEEK_MINUTES))
+        else:
+            pieces.append((start, end))
+    merged = []
+    for start, end in sorted(pieces):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def parse_walk_windows(text):
+    """
+    Окна прогулок из текста вида "будни 7:00-8:00, 20:00-21:00; выходные 10-12"
+    
+    Группы разделяются точкой с запятой или переводом строки, в начале группы - дни
+    (без дней - каждый день). Окно, которое заканчивается раньше начала, переходит
+    через полночь, окно нулевой длины не принимается.
+    
+    Returns:
+        list: непересекающиеся окна [начало, конец) в минутах от понедельника 00:00
+        или None, если текст не разобран
+    """
+    windows = []
+    text = text.casefold().replace('–', '-').replace('—', '-')
+    for group in re.split(r'[;\n]+', text):
+        group = group.strip()
+        if not group:
+            continue
+        matches = list(WALK_TIME_RANGE_RE.finditer(group))
+        if not matches:
+            return None
+        days = parse_weekdays(group[:matches[0].start()])
+        if days is None or WALK_TIME_RANGE_RE.sub('', group[matches[0].start():]).strip(' ,и'):
+            return None
+        for match in matches:
+            start_hour, start_minute, end_hour, end_minute = (int(value or 0) for value in match.groups())
+            start = start_hour * 60 + start_minute
+            end = end_hour * 60 + end_minute
+            # Пустое окно (8-8) - скорее опечатка, чем прогулка на сутки
+            if start_minute > 59 or end_minute > 59 or start >= DAY_MINUTES or end > DAY_MINUTES or end == start:
+                return None
+            if end < start:
+                end += DAY_MINUTES
+            for day in days:
+                windows.append((day * DAY_MINUTES + start, day * DAY_MINUTES + end))
+    return merge_walk_windows(windows) if windows else None
+
+
+def format_weekdays(days):
+    days = list(days)
+    for name, group in WEEKDAY_GROUPS.items():
+        if days == list(group):
+            return name
+    parts = []
+    index = 0
+    while index < len(days):
+        last = index
+        while last + 1 < len(days) and days[last + 1] == days[last] + 1:
+            last += 1
+        if last - index >= 2:
+            parts.append(f"{WEEKDAY_NAMES[days[index]]}-{WEEKDAY_NAMES[days[last]]}")
+        else:
+            parts.extend(WEEKDAY_NAMES[day] for day in days[index:last + 1])
+        index = last + 1
+    return ", ".join(parts)
+
+
+def format_walk_windows(windows):
+    """Окна прогулок для показа, например: будни 07:00-08:00, 20:00-21:00; выходные 10:00-12:00"""
+    def clock(minutes):
+        minutes %= DAY_MINUTES
+        return f"{minutes // 60:02d}:{minutes % 60:02d}"
+    
+    if windows == [[0, WEEK_MINUTES]]:
+        return "круглосуточно"
+    # Одинаковые по времени окна разных дней собираются вместе, затем - одинаковые наборы дней
+    days_by_time = {}
+    for start, end in windows:
+        if end - start >= DAY_MINUTES:
+            label = f"{clock(start)}-{WEEKDAY_NAMES[(end // DAY_MINUTES) % 7]} {clock(end)}"
+        else:
+            label = f"{clock(start)}-{clock(end)}"
+        days_by_time.setdefault((start % DAY_MINUTES, label), []).append(start // DAY_MINUTES)
+    times_by_days = {}
+    for (_, label), days in sorted(days_by_time.items()):
+        times_by_days.setdefault(tuple(days), []).append(label)
+    groups = sorted(times_by_days.items(), key=lambda item: item[0])
+    return "; ".join(f"{format_weekdays(days)} {', '.join(labels)}" for days, labels in groups)
+
+
+class IntervalTree:
+    """
+    Дерево интервалов [начало, конец) на фиксированном отрезке целых чисел [low, high)
+    
+    Середины узлов заданы заранее делением отрезка пополам, поэтому дерево не нужно
+    перестраивать. Интервал хранится в самом верхнем узле, чью середину он содержит, в
+    двух отсортированных списках: по началу и по концу. Вставка и удаление стоят
+    O(log D + k), поиск пересечений - O(log D * (1 + ответ)), где D - длина отрезка,
+    k - число интервалов в узле.
+    """
+    
+    def __init__(self, low, high):
+        self.low = low
+        self.high = high
+        # {(low, high) узла: [по началу [(начало, конец, ключ)], по концу [(конец, начало, ключ)], интервалов в поддереве]}
+        self._nodes = {}
+    
+    def __len__(self):
+        node = self._nodes.get((self.low, self.high))
+        return node[2] if node else 0
+    
+    def _path(self, start, end):
+        """Узлы от корня до узла, в котором хранится интервал"""
+        low, high = self.low, self.high
+        while True:
+            center = (low + high) // 2
+            yield low, high
+            if end <= center:
+                high = center
+            elif start > center:
+                low = center + 1
+            else:
+                return
+    
+    def add(self, start, end, key):
+        if not self.low <= start < end <= self.high:
+            raise ValueError(f"Интервал [{start}, {end}) вне [{self.low}, {self.high})")
+        for bounds in self._path(start, end):
+            node = self._nodes.get(bounds)
+            if node is None:
+                node = self._nodes[bounds] = [[], [], 0]
+            node[2] += 1
+        bisect.insort(node[0], (start, end, key))
+        bisect.insort(node[1], (end, start, key))
+    
+    def remove(self, start, end, key):
+        path = list(self._path(start, end))
+        node = self._nodes.get(path[-1])
+        if node is None:
+            return False
+        index = bisect.bisect_left(node[0], (start, end, key))
+        if index == len(node[0]) or node[0][index] != (start, end, key):
+            return False
+        del node[0][index]
+        node[1].pop(bisect.bisect_left(node[1], (end, start, key)))
+        for bounds in path:
+            node = self._nodes[bounds]
+            node[2] -= 1
+            if not node[2]:
+                del self._nodes[bounds]
+        return True
+    
+    def overlapping(self, start, end):
+        """Интервалы (начало, конец, ключ), пересекающиеся с [start, end)"""
+        stack = [(self.low, self.high)]
+        while stack:
+            bounds = stack.pop()
+            node = self._nodes.get(bounds)
+            if node is None:
+                continue
+            low, high = bounds
+            center = (low + high) // 2
+            by_start, by_end, _ = node
+            if end <= center:
+                # Все интервалы узла заканчиваются правее запроса: подходят начавшиеся до его конца
+                for interval in by_start:
+                    if interval[0] >= end:
+                        break
+                    yield interval
+                stack.append((low, center))
+            elif start > center:
+                for index in range(len(by_end) - 1, -1, -1):
+                    interval_end, interval_start, key = by_end[index]
+                    if interval_end <= start:
+                        break
+                    yield interval_start, interval_end, key
+                stack.append((center + 1, high))
+            else:
+                yield from by_start
+                stack.append((low, center))
+                stack.append((center + 1, high))
+
+
+def get_partner_profile(user_info):
+    """
+    Что нужно для поиска компании: (окна, lat, lon, место) или None
+    
+    Место - нормализованное текстовое название, если координаты не указаны.
+    """
+    if not user_info or not user_info.get('walk_windows'):
+        return None
+    windows = [tuple(window) for window in user_info['walk_windows']]
+    lat = user_info.get('walking_location_lat')
+    lon = user_info.get('walking_location_lon')
+    if lat is not None and lon is not None:
+        return windows, lat, lon, None
+    place = ' '.join((user_info.get('walking_location') or '').casefold().split())
+    if not place or place == 'не указано':
+        return None
+    return windows, None, None, place
+
+
+class WalkPartnerIndex:
+    """
+    Поиск компании для прогулок по расписанию ("Найти компанию")
+    
+    Окна прогулок лежат в IntervalTree по минутам недели - отдельном для каждой
+    области: ячейки сетки GridIndex со стороной radius для мест с координатами и
+    текстового названия для остальных. Поиск обходит деревья ячеек в радиусе (или
+    дерево своего места), берет только пересекающиеся окна и отсеивает тех, кто
+    дальше radius, поэтому его время зависит от числа людей рядом в те же часы, а
+    не от размера города. user_data не просматривается.
+    
+    Индекс строится при запуске и обновляется через update() там, где меняются окна
+    или место прогулок. В режиме воркеров update() записывает ID пользователя в
+    ChangeLog, и перед поиском каждый воркер переиндексирует изменившихся у других
+    воркеров пользователей.
+    """
+    
+    def __init__(self, radius, keep_changes):
+        self.radius = radius
+        self._grid = GridIndex(radius)  # Только разбиение на ячейки, точки в нем не хранятся
+        self._trees = {}  # {ячейка сетки или название места: IntervalTree}
+        self._profiles = {}  # {user_id: результат get_partner_profile()}
+        self._changes = ChangeLog('walk_partner_changes', keep_changes)
+    
+    def __len__(self):
+        return len(self._profiles)
+    
+    def _area(self, profile):
+        _, lat, lon, place = profile
+        return self._grid.cell(lat, lon) if lat is not None else place
+    
+    def _discard(self, user_id):
+        profile = self._profiles.pop(user_id, None)
+        if profile is None:
+            return
+        area = self._area(profile)
+        tree = self._trees[area]
+        for start, end in profile[0]:
+            tree.remove(start, end, user_id)
+        if not len(tree):
+            del self._trees[area]
+    
+    def _reindex(self, user_id, user_info):
+        self._discard(user_id)
+        profile = get_partner_profile(user_info)
+        if profile is None:
+            return
+        area = self._area(profile)
+        tree = self._trees.get(area)
+        if tree is None:
+            tree = self._trees[area] = IntervalTree(0, WEEK_MINUTES)
+        for start, end in profile[0]:
+            tree.add(start, end, user_id)
+        self._profiles[user_id] = profile
+    
+    def build(self):
+        self._grid = GridIndex(self.radius)
+        self._trees = {}
+        self._profiles = {}
+        for user_id, user_info in user_data.items():
+            self._reindex(user_id, user_info)
+    
+    def update(self, user_id, user_info):
+        """Переиндексирует пользователя после изменения профиля (user_info=None - пользователь удален)"""
+        self._reindex(user_id, user_info)
+        self._changes.append(user_id)
+    
+    def sync(self):
+        """Переиндексирует пользователей, измененных другими воркерами"""
+        changed = self._changes.read()
+        if changed is None:
+            self.build()
+            return
+        for user_id in changed:
+            self._reindex(user_id, user_data.get(user_id))
+    
+    def find(self, user_id, user_info):
+        """
+        Компания для пользователя: гуляют рядом и в пересекающееся время
+        
+        Returns:
+            list: [(user_id, минут пересечения в неделю, расстояние в метрах или None)],
+            лучшие совпадения первыми
+        """
+        self.sync()
+        profile = get_partner_profile(user_info)
+        if profile is None:
+            return []
+        windows, lat, lon, place = profile
+        if lat is not None:
+            cell_x, cell_y = self._grid.cell(lat, lon)
+            span = math.ceil(self.radius / self._grid.cell_size)
+            areas = [(cell_x + dx, cell_y + dy) for dx in range(-span, span + 1) for dy in range(-span, span + 1)]
+        else:
+            areas = [place]
+        
+        overlaps = Counter()
+        distances = {}  # Расстояние считается один раз для каждого, с кем пересеклись окна
+        for area in areas:
+            tree = self._trees.get(area)
+            if tree is None:
+                continue
+            for start, end in windows:
+                for other_start, other_end, other_id in tree.overlapping(start, end):
+                    if other_id == user_id:
+                        continue
+                    if lat is not None:
+                        distance = distances.get(other_id)
+                        if distance is None:
+                            _, other_lat, other_lon, _ = self._profiles[other_id]
+                            distance = distances[other_id] = haversine_meters(lat, lon, other_lat, other_lon)
+                        if distance > self.radius:
+                            continue
+                    overlaps[other_id] += min(end, other_end) - max(start, other_start)
+        matches = [(other_id, minutes, distances.get(other_id)) for other_id, minutes in overlaps.items() if minutes > 0]
+        matches.sort(key=lambda match: (-match[1], match[2] or 0, match[0]))
+        return matches
+    
+    def start(self):
+        if isinstance(user_data, SharedMapping):
+            self._changes.open()
+        started = time.perf_counter()
+        begin_shared_session()
+        self.build()
+        begin_shared_session()
+        logger.info(
+            "Индекс поиска компании построен: %s пользователей за %.2f с", len(self), time.perf_counter() - started
+        )
+
+
+walk_partners = WalkPartnerIndex(WALK_PARTNER_RADIUS_METERS, WALK_PARTNER_CHANGES_KEEP)
+
+
+RELATIVE_DAYS = {'сегодня': 0, 'завтра': 1, 'послезавтра': 2}
+WALK_TIME_RE = re.compile(
+    r'^(?:([а-яё]+)\s+|(\d{1,2})\.(\d{1,2})(?:\.(\d{2}|\d{4}))?\s+)?(?:в\s+)?(\d{1,2})(?:[:.](\d{2}))?$'
+)
+
+
+def parse_walk_time(text, now=None):
+    """
+    Начало прогулки из текста: "сегодня 19:30", "завтра 8", "сб 10:00", "25.10 18:30", "19:30"
+    
+    Время без дня - сегодня, а если оно уже прошло - завтра. День недели - ближайший
+    такой день.
+    
+    Returns:
+        datetime: момент в SCHEDULE_TZ или None, если текст не разобран, время прошло
+        или до него больше WALK_PLAN_MAX_DAYS дней
+    """
+    now = now or datetime.now(SCHEDULE_TZ)
+    match = WALK_TIME_RE.match(' '.join(text.casefold().replace('ё', 'е').split()))
+    if not match:
+        return None
+    word, day, month, year, hour, minute = match.groups()
+    hour, minute = int(hour), int(minute or 0)
+    if hour > 23 or minute > 59:
+        return None
+    
+    shift = 0
+    if word is not None:
+        if word in RELATIVE_DAYS:
+            shift = RELATIVE_DAYS[word]
+        else:
+            weekday = next((number for alias, number in WEEKDAY_ALIASES if word.startswith(alias)), None)
+            if weekday is None:
+                return None
+            shift = (weekday - now.weekday()) % 7
+    try:
+        if day is not None:
+            year = int(year) if year else now.year
+            moment = datetime(year + 2000 if year < 100 else year, int(month), int(day), hour, minute, tzinfo=SCHEDULE_TZ)
+            if not match.group(4) and moment <= now:
+                moment = moment.replace(year=moment.year + 1)
+        else:
+            moment = datetime(now.year, now.month, now.day, hour, minute, tzinfo=SCHEDULE_TZ) + timedelta(days=shift)
+            if moment <= now and word not in RELATIVE_DAYS:
+                moment += timedelta(days=7 if word else 1)
+    except ValueError:
+        return None
+    if moment <= now or moment - now > timedelta(days=WALK_PLAN_MAX_DAYS):
+        return None
+    return moment
+
+
+def format_walk_time(timestamp):
+    """Время прогулки в SCHEDULE_TZ, например: сегодня в 19:30, завтра в 08:00, сб 25.10 в 10:00"""
+    moment = datetime.fromtimestamp(timestamp, SCHEDULE_TZ)
+    days = (moment.date() - datetime.now(SCHEDULE_TZ).date()).days
+    clock = moment.strftime('%H:%M')
+    if days == 0:
+        return f"сегодня в {clock}"
+    if days == 1:
+        return f"завтра в {clock}"
+    return f"{WEEKDAY_NAMES[moment.weekday()]} {moment:%d.%m} в {clock}"
+
+
+class WalkPlanner:
+    """
+    Запланированные прогулки: приглашения с ответами и напоминания перед началом
+    
+    Прогулки, ответы приглашенных и напоминания хранятся в базе состояния. Все
+    напоминания процесса лежат в одной куче (heapq) по времени отправки, и ее
+    обслуживает одна задача: она спит до ближайшего напоминания или до добавления
+    более раннего. При запуске куча строится заново из таблицы walk_reminders;
+    напоминания, время которых прошло, пока бот был остановлен, отправляются сразу,
+    если прогулка еще не началась. Напоминания отмененных прогулок из кучи не
+    удаляются, а пропускаются при извлечении.
+    
+    В режиме воркеров каждый воркер отправляет напоминания прогулок своих
+    организаторов: прогулку создает и отменяет воркер организатора.
+    """
+    
+    def __init__(self, reminder_minutes, keep_days):
+        self.reminder_minutes = sorted(set(reminder_minutes), reverse=True)
+        self.keep_days = keep_days
+        self.shard = None  # (индекс воркера, число воркеров) в режиме воркеров
+        self.reminders_sent_total = 0
+        self._heap = []  # [(время отправки, ID прогулки, минут до начала)]
+        self._wakeup = None
+        self._conn = None
+        self._task = None
+        self._bot = None
+    
+    def __len__(self):
+        return len(self._heap)
+    
+    def connect(self):
+        if self._conn is None:
+            self._conn = open_state_db()
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS planned_walks (id INTEGER PRIMARY KEY, organizer_id INTEGER NOT NULL, "
+                "starts_at REAL NOT NULL, place TEXT NOT NULL, place_full TEXT NOT NULL, map_url TEXT, "
+                "cancelled INTEGER NOT NULL DEFAULT 0)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS planned_walks_organizer ON planned_walks (organizer_id, starts_at)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS walk_rsvps (walk_id INTEGER NOT NULL, user_id INTEGER NOT NULL, "
+                "answer TEXT, PRIMARY KEY (walk_id, user_id))"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS walk_rsvps_user ON walk_rsvps (user_id)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS walk_reminders (walk_id INTEGER NOT NULL, due_at REAL NOT NULL, "
+                "minutes INTEGER NOT NULL, PRIMARY KEY (walk_id, minutes))"
+            )
+        return self._conn
+    
+    def _schedule(self, due_at, walk_id, minutes):
+        heapq.heappush(self._heap, (due_at, walk_id, minutes))
+        # Задачу будим, только если новое напоминание стало ближайшим
+        if self._wakeup is not None and self._heap[0][1:] == (walk_id, minutes):
+            self._wakeup.set()
+    
+    def create(self, organizer_id, starts_at, place, place_full, map_url, invitees):
+        """Создает прогулку с приглашенными и ее напоминания. Возвращает ID прогулки"""
+        now = time.time()
+        reminders = [
+            (starts_at - minutes * 60, minutes) for minutes in self.reminder_minutes
+            if starts_at - minutes * 60 > now
+        ]
+        conn = self.connect()
+        with conn:
+            conn.execute("BEGIN")
+            walk_id = conn.execute(
+                "INSERT INTO planned_walks (organizer_id, starts_at, place, place_full, map_url) VALUES (?, ?, ?, ?, ?)",
+                (organizer_id, starts_at, place, place_full, map_url)
+            ).lastrowid
+            conn.executemany(
+                "INSERT OR IGNORE INTO walk_rsvps (walk_id, user_id) VALUES (?, ?)",
+                [(walk_id, user_id) for user_id in invitees]
+            )
+            conn.executemany(
+                "INSERT INTO walk_reminders (walk_id, due_at, minutes) VALUES (?, ?, ?)",
+                [(walk_id, due_at, minutes) for due_at, minutes in reminders]
+            )
+        for due_at, minutes in reminders:
+            self._schedule(due_at, walk_id, minutes)
+        return walk_id
+    
+    def get(self, walk_id):
+        row = self.connect().execute(
+            "SELECT id, organizer_id, starts_at, place, place_full, map_url, cancelled FROM planned_walks WHERE id = ?",
+            (walk_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        keys = ('id', 'organizer_id', 'starts_at', 'place', 'place_full', 'map_url', 'cancelled')
+        return dict(zip(keys, row))
+    
+    def answers(self, walk_id):
+        """Ответы приглашенных: {user_id: 'yes' | 'no' | None}"""
+        return dict(self.connect().execute("SELECT user_id, answer FROM walk_rsvps WHERE walk_id = ?", (walk_id,)))
+    
+    def rsvp(self, walk_id, user_id, answer):
+        """
+        Записывает ответ приглашенного
+        
+        Returns:
+            str: предыдущий ответ ('yes', 'no' или None) или 'not_invited'
+        """
+        conn = self.connect()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT answer FROM walk_rsvps WHERE walk_id = ? AND user_id = ?", (walk_id, user_id)
+            ).fetchone()
+            if row is None:
+                return 'not_invited'
+            conn.execute(
+                "UPDATE walk_rsvps SET answer = ? WHERE walk_id = ? AND user_id = ?", (answer, walk_id, user_id)
+            )
+        return row[0]
+    
+    def cancel(self, walk_id):
+        conn = self.connect()
+        with conn:
+            conn.execute("BEGIN")
+            conn.execute("UPDATE planned_walks SET cancelled = 1 WHERE id = ?", (walk_id,))
+            conn.execute("DELETE FROM walk_reminders WHERE walk_id = ?", (walk_id,))
+    
+    def upcoming(self, user_id, limit=10):
+        """Предстоящие прогулки, которые пользователь организует или на которые приглашен"""
+        rows = self.connect().execute(
+            "SELECT id FROM planned_walks WHERE cancelled = 0 AND starts_at > ? AND (organizer_id = ? OR id IN "
+            "(SELECT walk_id FROM walk_rsvps WHERE user_id = ? AND (answer IS NULL OR answer = 'yes'))) "
+            "ORDER BY starts_at LIMIT ?",
+            (time.time(), user_id, user_id, limit)
+        ).fetchall()
+        return [self.get(walk_id) for (walk_id,) in rows]
+    
+    async def remind(self, walk_id, minutes):
+        self.connect().execute("DELETE FROM walk_reminders WHERE walk_id = ? AND minutes = ?", (walk_id, minutes))
+        walk = self.get(walk_id)
+        if walk is None or walk['cancelled'] or walk['starts_at'] <= time.time():
+            return
+        answers = self.answers(walk_id)
+        coming = [user_id for user_id, answer in answers.items() if answer == 'yes']
+        text = (
+            f"⏰ Напоминание: прогулка {format_walk_time(walk['starts_at'])}"
+            f" (через {max(1, round((walk['starts_at'] - time.time()) / 60))} мин)\n\n"
+            + format_planned_walk(walk, answers)
+        )
+        keyboard = None
+        if walk['map_url']:
+            keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("🗺️ Открыть на Яндекс картах", url=walk['map_url'])]])
+        for user_id in [walk['organizer_id']] + coming:
+            try:
+                await self._bot.send_message(chat_id=user_id, text=text, reply_markup=keyboard)
+                self.reminders_sent_total += 1
+            except Exception as e:
+                logger.warning("Не удалось отправить напоминание о прогулке %s пользователю %s: %s", walk_id, user_id, e)
+    
+    def load(self):
+        """Строит кучу напоминаний из базы и удаляет давно прошедшие прогулки"""
+        conn = self.connect()
+        # Таблицы общие для всех воркеров, старые прогулки всех организаторов удаляет воркер 0
+        if self.shard is None or self.shard[0] == 0:
+            expired = time.time() - self.keep_days * 86400
+            with conn:
+                conn.execute("BEGIN")
+                conn.execute(
+                    "DELETE FROM walk_rsvps WHERE walk_id IN (SELECT id FROM planned_walks WHERE starts_at < ?)", (expired,)
+                )
+                conn.execute(
+                    "DELETE FROM walk_reminders WHERE walk_id IN (SELECT id FROM planned_walks WHERE starts_at < ?)", (expired,)
+                )
+                conn.execute("DELETE FROM planned_walks WHERE starts_at < ?", (expired,))
+        rows = conn.execute(
+            "SELECT r.due_at, r.walk_id, r.minutes, w.organizer_id FROM walk_reminders r "
+            "JOIN planned_walks w ON w.id = r.walk_id"
+        ).fetchall()
+        self._heap = [
+            (due_at, walk_id, minutes) for due_at, walk_id, minutes, organizer_id in rows
+            if not self.shard or shard_for_user(organizer_id, self.shard[1]) == self.shard[0]
+        ]
+        heapq.heapify(self._heap)
+        if self._heap:
+            logger.info("Восстановлено напоминаний о прогулках: %s", len(self._heap))
+    
+    async def run(self):
+        while True:
+            now = time.time()
+            while self._heap and self._heap[0][0] <= now:
+                _, walk_id, minutes = heapq.heappop(self._heap)
+                try:
+                    await self.remind(walk_id, minutes)
+                except Exception as e:
+                    logger.error("Ошибка при отправке напоминания о прогулке %s: %s", walk_id, e, exc_info=True)
+            timeout = self._heap[0][0] - time.time() if self._heap else None
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+    
+    def start(self, application):
+        self._bot = application.bot
+        self._wakeup = asyncio.Event()
+        self.load()
+        self._task = asyncio.create_task(self.run())
+    
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+
+walk_planner = WalkPlanner(WALK_REMINDER_MINUTES, WALK_PLAN_KEEP_DAYS)
+
+
+def format_planned_walk(walk, answers):
+    """Место, организатор и ответы приглашенных"""
+    def names(user_ids):
+        return ", ".join((user_data.get(user_id) or {}).get('first_name') or 'Пользователь' for user_id in user_ids)
+    
+    coming = [user_id for user_id, answer in answers.items() if answer == 'yes']
+    declined = sum(1 for answer in answers.values() if answer == 'no')
+    waiting = sum(1 for answer in answers.values() if answer is None)
+    lines = [
+        f"🌳 {walk['place']}",
+        f"📍 {walk['place_full']}",
+        f"👤 Организатор: {names([walk['organizer_id']])}",
+        f"✅ Придут: {names(coming) if coming else 'пока никто'}"
     ]
+    if declined:
+        lines.append(f"❌ Не смогут: {declined}")
+    if waiting:
+        lines.append(f"❔ Не ответили: {waiting}")
+    return "\n".join(lines)
+
+
+def get_planned_walk_keyboard(walk, user_id, back=True):
+    """Кнопки прогулки: ответ для приглашенного, отмена для организатора"""
+    keyboard = []
+    if not walk['cancelled'] and walk['starts_at'] > time.time():
+        if walk['organizer_id'] == user_id:
+            keyboard.append([InlineKeyboardButton("❌ Отменить прогулку", callback_data=f"walk_cancel_{walk['id']}")])
+        else:
+            keyboard.append([
+                InlineKeyboardButton("✅ Приду", callback_data=f"walk_rsvp_{walk['id']}_yes"),
+                InlineKeyboardButton("❌ Не смогу", callback_data=f"walk_rsvp_{walk['id']}_no")
+            ])
+    if walk['map_url']:
+        keyboard.append([InlineKeyboardButton("🗺️ Открыть на Яндекс картах", url=walk['map_url'])])
+    if back:
+        keyboard.append([InlineKeyboardButton("Назад", callback_data="planned_walks")])
+    return InlineKeyboardMarkup(keyboard)
+
+
+def get_walking_distance(first_info, second_info):
+    """
+    Расстояние между местами прогулок двух пользователей, метры
     
-    return base_places
+    0 - одинаковое текстовое место, None - сравнить нельзя.
+    """
+    first_lat, first_lon = first_info.get('walking_location_lat'), first_info.get('walking_location_lon')
+    second_lat, second_lon = second_info.get('walking_location_lat'), second_info.get('walking_location_lon')
+    if None not in (first_lat, first_lon, second_lat, second_lon):
+        return haversine_meters(first_lat, first_lon, second_lat, second_lon)
+    first_place = ' '.join((first_info.get('walking_location') or '').casefold().split())
+    second_place = ' '.join((second_info.get('walking_location') or '').casefold().split())
+    if first_place and first_place == second_place and first_place != 'не указано':
+        return 0.0
+    return None
+
+
+class FriendSuggestions:
+    """
+    "Возможно, вы знакомы": друзья друзей по числу общих друзей и близости мест прогулок
+    
+    Для пользователя, открывшего экран, счетчики общих друзей считаются один раз
+    обходом на два шага, а дальше поддерживаются при изменениях графа: принятие
+    запроса и удаление из друзей правят счетчики только у закэшированных
+    пользователей, в чьих списках друзей есть изменившийся пользователь (обратный
+    индекс _watchers). Списки друзей односторонние (удаление из друзей убирает
+    друга только из своего списка), поэтому изменения приходят по одному ребру.
+    Кэш ограничен max_users пользователями, давно не открывавшие экран вытесняются.
+    
+    В режиме воркеров изменения списков друзей записываются в ChangeLog, и другие
+    воркеры вытесняют затронутые счетчики: они пересчитаются при следующем просмотре.
+    """
+    
+    def __init__(self, max_users, keep_changes):
+        self.max_users = max_users
+        self._counts = OrderedDict()  # {user_id: Counter({кандидат: общих друзей})}
+        self._friends = {}  # Друзья закэшированных пользователей: {user_id: set(друзей)}
+        self._watchers = {}  # {user_id: set(закэшированных пользователей, у которых он в друзьях)}
+        self._changes = ChangeLog('friend_graph_changes', keep_changes)
+    
+    def __len__(self):
+        return len(self._counts)
+    
+    def _evict(self, user_id):
+        self._counts.pop(user_id, None)
+        for friend_id in self._friends.pop(user_id, ()):
+            watchers = self._watchers.get(friend_id)
+            if watchers is not None:
+                watchers.discard(user_id)
+                if not watchers:
+                    del self._watchers[friend_id]
+    
+    def _evict_affected(self, user_id):
+        """Вытесняет счетчики, которые зависят от списка друзей user_id"""
+        for owner in list(self._watchers.get(user_id, ())):
+            self._evict(owner)
+        self._evict(user_id)
+    
+    @staticmethod
+    def _decrement(counts, candidate):
+        if counts.get(candidate, 0) > 1:
+            counts[candidate] -= 1
+        else:
+            counts.pop(candidate, None)
+    
+    def counts(self, user_id):
+        """Счетчики общих друзей пользователя (строятся при первом обращении)"""
+        changed = self._changes.read()
+        if changed is None:
+            for owner in list(self._counts):
+                self._evict(owner)
+        else:
+            for changed_id in changed:
+                self._evict_affected(changed_id)
+        
+        counts = self._counts.get(user_id)
+        if counts is not None:
+            self._counts.move_to_end(user_id)
+            return counts
+        friends = get_friend_ids(user_data.get(user_id))
+        counts = Counter()
+        for friend_id in friends:
+            for candidate in get_friend_ids(user_data.get(friend_id)):
+                if candidate != user_id and candidate not in friends:
+                    counts[candidate] += 1
+        self._counts[user_id] = counts
+        self._friends[user_id] = friends
+        for friend_id in friends:
+            self._watchers.setdefault(friend_id, set()).add(user_id)
+        while len(self._counts) > self.max_users:
+            self._evict(next(iter(self._counts)))
+        return counts
+    
+    def friendship_added(self, user_id, friend_id):
+        """friend_id добавлен в список друзей user_id (user_data уже изменен)"""
+        for owner in self._watchers.get(user_id, ()):
+            if owner != friend_id and friend_id not in self._friends[owner]:
+                self._counts[owner][friend_id] += 1
+        counts = self._counts.get(user_id)
+        friends = self._friends.get(user_id)
+        if counts is not None and friend_id not in friends:
+            friends.add(friend_id)
+            self._watchers.setdefault(friend_id, set()).add(user_id)
+            counts.pop(friend_id, None)
+            for candidate in get_friend_ids(user_data.get(friend_id)):
+                if candidate != user_id and candidate not in friends:
+                    counts[candidate] += 1
+        self._changes.append(user_id)
+    
+    def friendship_removed(self, user_id, friend_id):
+        """friend_id удален из списка друзей user_id (user_data уже изменен)"""
+        for owner in self._watchers.get(user_id, ()):
+            if owner != friend_id and friend_id not in self._friends[owner]:
+                self._decrement(self._counts[owner], friend_id)
+        counts = self._counts.get(user_id)
+        friends = self._friends.get(user_id)
+        if counts is not None and friend_id in friends:
+            friends.discard(friend_id)
+            watchers = self._watchers[friend_id]
+            watchers.discard(user_id)
+            if not watchers:
+                del self._watchers[friend_id]
+            for candidate in get_friend_ids(user_data.get(friend_id)):
+                if candidate != user_id and candidate not in friends:
+                    self._decrement(counts, candidate)
+            # Бывший друг снова становится кандидатом
+            mutual = sum(1 for other_id in friends if friend_id in get_friend_ids(user_data.get(other_id)))
+            if mutual:
+                counts[friend_id] = mutual
+        self._changes.append(user_id)
+    
+    def user_removed(self, user_id):
+        """Пользователь удален из базы: счетчики тех, у кого он был в друзьях, пересчитаются при просмотре"""
+        self._evict_affected(user_id)
+        for counts in self._counts.values():
+            counts.pop(user_id, None)
+        self._changes.append(user_id)
+    
+    def suggest(self, user_id, limit):
+        """
+        Лучшие кандидаты: больше общих друзей, при равенстве - ближе место прогулок
+        
+        Returns:
+            list: [(user_id, общих друзей, расстояние в метрах или None)]
+        """
+        user_info = user_data.get(user_id) or {}
+        # Удаленные пользователи и те, кому уже отправлен запрос, не предлагаются
+        counts = {}
+        for candidate, mutual in self.counts(user_id).items():
+            candidate_info = user_data.get(candidate)
+            if candidate_info and user_id not in friend_requests.get(candidate, []):
+                counts[candidate] = (mutual, candidate_info)
+        # Расстояние считается только для кандидатов не хуже limit-го по числу общих друзей,
+        # а из равных ему - не больше чем для limit * 5
+        top = heapq.nlargest(limit, (mutual for mutual, _ in counts.values()))
+        threshold = top[-1] if top else 1
+        best = [candidate for candidate, (mutual, _) in counts.items() if mutual > threshold]
+        best += itertools.islice((candidate for candidate, (mutual, _) in counts.items() if mutual == threshold), limit * 5)
+        scored = []
+        for candidate in best:
+            mutual, candidate_info = counts[candidate]
+            scored.append((candidate, mutual, get_walking_distance(user_info, candidate_info)))
+        scored.sort(key=lambda item: (-item[1], item[2] if item[2] is not None else math.inf, item[0]))
+        return scored[:limit]
+    
+    def start(self):
+        if isinstance(user_data, SharedMapping):
+            self._changes.open()
+
+
+friend_suggestions = FriendSuggestions(FRIEND_SUGGESTIONS_CACHE_USERS, FRIEND_GRAPH_CHANGES_KEEP)
+
+
+class FriendFollowers:
+    """
+    Обратный индекс друзей: у кого пользователь в списке друзей
+    
+    Списки друзей односторонние, поэтому без индекса найти всех, кто дружит с
+    пользователем, можно только просмотром всей базы. Индекс строится при запуске
+    и обновляется через update() там, где меняется список друзей. В режиме
+    воркеров update() записывает ID пользователя в ChangeLog, и перед чтением
+    индекса воркер переиндексирует пользователей, измененных другими воркерами.
+    """
+    
+    def __init__(self, keep_changes):
+        self._followers = {}  # {user_id: set(тех, у кого он в друзьях)}
+        self._friends = {}  # {user_id: set(друзей)} - для снятия старых ребер при обновлении
+        self._changes = ChangeLog('friend_followers_changes', keep_changes)
+    
+    def __len__(self):
+        return len(self._friends)
+    
+    def _reindex(self, user_id, user_info):
+        previous = self._friends.pop(user_id, set())
+        friends = get_friend_ids(user_info)
+        for friend_id in previous - friends:
+            followers = self._followers[friend_id]
+            followers.discard(user_id)
+            if not followers:
+                del self._followers[friend_id]
+        for friend_id in friends - previous:
+            self._followers.setdefault(friend_id, set()).add(user_id)
+        if friends:
+            self._friends[user_id] = friends
+    
+    def build(self):
+        self._followers = {}
+        self._friends = {}
+        for user_id, user_info in user_data.items():
+            self._reindex(user_id, user_info)
+    
+    def update(self, user_id, user_info):
+        """Переиндексирует пользователя после изменения списка друзей (user_info=None - пользователь удален)"""
+        self._reindex(user_id, user_info)
+        self._changes.append(user_id)
+    
+    def sync(self):
+        """Переиндексирует пользователей, измененных другими воркерами"""
+        changed = self._changes.read()
+        if changed is None:
+            self.build()
+            return
+        for user_id in changed:
+            self._reindex(user_id, user_data.get(user_id))
+    
+    def followers(self, user_id):
+        """ID пользователей, у которых user_id в списке друзей"""
+        self.sync()
+        return set(self._followers.get(user_id, ()))
+    
+    def start(self):
+        if isinstance(user_data, SharedMapping):
+            self._changes.open()
+        started = time.perf_counter()
+        begin_shared_session()
+        self.build()
+        begin_shared_session()
+        logger.info(
+            "Обратный индекс друзей построен: %s пользователей за %.2f с", len(self), time.perf_counter() - started
+        )
+
+
+friend_followers = FriendFollowers(FRIEND_GRAPH_CHANGES_KEEP)
+
+
+class TokenBucketLimiter:
+    """Ограничитель частоты запросов: отдельное ведро токенов на каждого пользователя"""
+    
+    def __init__(self, capacity, refill_per_second, prune_interval=60):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.prune_interval = prune_interval
+        self.throttled_total = 0
+        self._buckets = {}  # {user_id: [токены, время последнего пополнения]}
+        self._last_presses = {}  # {user_id: (callback_data, время нажатия)}
+        self._last_prune = time.monotonic()
+    
+    def is_repeated_press(self, user_id, callback_data, window):
+        """Проверяет, нажимал ли пользователь ту же кнопку меньше window секунд назад"""
+        now = time.monotonic()
+        previous = self._last_presses.get(user_id)
+        self._last_presses[user_id] = (callback_data, now)
+        return previous is not None and previous[0] == callback_data and now - previous[1] < window
+    
+    def consume(self, user_id, cost=1):
+        """Списывает cost токенов. Возвращает False, если токенов не хватает"""
+        now = time.monotonic()
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = self._buckets[user_id] = [self.capacity, now]
+        else:
+            bucket[0] = min(self.capacity, bucket[0] + (now - bucket[1]) * self.refill_per_second)
+            bucket[1] = now
+        
+        if now - self._last_prune > self.prune_interval:
+            self.prune(now)
+        
+        if bucket[0] < cost:
+            self.throttled_total += 1
+            return False
+        bucket[0] -= cost
+        return True
+    
+    def prune(self, now=None):
+        """Удаляет ведра, которые уже успели наполниться (пользователь давно не активен)"""
+        now = now or time.monotonic()
+        full_after = self.capacity / self.refill_per_second
+        for user_id in [uid for uid, (_, updated) in self._buckets.items() if now - updated >= full_after]:
+            del self._buckets[user_id]
+        for user_id in [uid for uid, (_, pressed) in self._last_presses.items() if now - pressed >= self.prune_interval]:
+            del self._last_presses[user_id]
+        self._last_prune = now
+    
+    def __len__(self):
+        return len(self._buckets)
+
+
+rate_limiter = TokenBucketLimiter(RATE_LIMIT_CAPACITY, RATE_LIMIT_REFILL_PER_SECOND)
+
+
+def get_callback_cost(callback_data):
+    """Стоимость нажатия кнопки в токенах"""
+    place_callback = decode_place_callback(callback_data)
+    if place_callback:
+        callback_data = PLACE_CALLBACK_ROUTES[place_callback[1]] + '_'
+    for prefix, cost in RATE_LIMIT_CALLBACK_COSTS.items():
+        if callback_data.startswith(prefix):
+            return cost
+    return 1
+
+
+async def rate_limit_guard(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Промежуточный обработчик (группа -1): ограничивает частоту запросов пользователя
+    и отбрасывает повторные быстрые нажатия одной и той же кнопки
+    """
+    user = update.effective_user
+    if user is None:
+        return
+    
+    query = update.callback_query
+    if query:
+        callback_data = query.data or ''
+        if rate_limiter.is_repeated_press(user.id, callback_data, CALLBACK_DEBOUNCE_SECONDS):
+            await query.answer()
+            raise ApplicationHandlerStop
+        
+        if not rate_limiter.consume(user.id, get_callback_cost(callback_data)):
+            await query.answer("⏳ Слишком часто. Подождите несколько секунд.")
+            raise ApplicationHandlerStop
+        return
+    
+    # Inline-запросы (поиск мест) не ограничиваются: клиент шлет их на каждое нажатие
+    # клавиши, а повторные ответы берутся из кеша индекса поиска
+    message = update.message
+    if message:
+        cost = RATE_LIMIT_CONTACT_COST if message.contact else 1
+        if not rate_limiter.consume(user.id, cost):
+            # Сообщения при превышении лимита отбрасываются без ответа - это самый дешевый вариант
+            raise ApplicationHandlerStop
+
+
+# Префиксы кнопок, после которых в callback_data идут ID или названия.
+# Более длинные префиксы должны идти раньше совпадающих с ними коротких.
+CALLBACK_ROUTE_PREFIXES = (
+    'view_friend_old_', 'view_friend_', 'remove_friend_', 'select_region_', 'select_district_',
+    'select_walking_place_', 'share_place_to_', 'select_user_', 'write_to_', 'add_friend_', 'find_company_', 'friend_suggestions_',
+    'already_friend_', 'request_sent_', 'walk_view_', 'walk_rsvp_', 'walk_cancel_', 'accept_friend_', 'decline_friend_', 'admin_view_subscriber_',
+    'admin_delete_', 'admin_message_', 'admin_add_tag_', 'admin_remove_tag_confirm_', 'admin_remove_tag_'
+)
+
+
+def get_callback_route(callback_data):
+    """Имя маршрута кнопки без ID и названий (чтобы число меток метрик было ограничено)"""
+    place_callback = decode_place_callback(callback_data)
+    if place_callback:
+        return PLACE_CALLBACK_ROUTES[place_callback[1]]
+    for prefix in CALLBACK_ROUTE_PREFIXES:
+        if callback_data.startswith(prefix):
+            return prefix.rstrip('_')
+    if callback_data.replace('_', '').isalpha() and len(callback_data) <= 40:
+        return callback_data
+    return 'other'
+
+
+def instrumented(handler):
+    """Оборачивает обработчик: замеряет время выполнения и считает ошибки по маршрутам"""
+    handler_name = handler.__name__
+    
+    @wraps(handler)
+    async def wrapper(update, context):
+        # Метка маршрута: для кнопок - callback_data без ID, для остальных - имя обработчика
+        route = handler_name
+        user_id = None
+        if isinstance(update, Update):
+            if update.callback_query:
+                route = get_callback_route(update.callback_query.data or '')
+            if update.effective_user:
+                user_id = update.effective_user.id
+        context_token = log_context.set({'user_id': user_id, 'route': route})
+        started = time.perf_counter()
+        try:
+            return await handler(update, context)
+        except ApplicationHandlerStop:
+            raise
+        except Exception:
+            metrics.inc('bot_handler_errors_total', handler=handler_name, route=route)
+            raise
+        finally:
+            duration = time.perf_counter() - started
+            log_context.reset(context_token)
+            metrics.observe('bot_handler_duration_seconds', duration, handler=handler_name, route=route)
+            level = logging.WARNING if duration >= SLOW_HANDLER_SECONDS else logging.DEBUG
+            if logger.isEnabledFor(level):
+                logger.log(
+                    level, "Обработчик %s (%s) выполнен за %.1f мс", handler_name, route, duration * 1000,
+                    extra={'user_id': user_id, 'route': route, 'duration_ms': round(duration * 1000, 1)}
+                )
+    
+    return wrapper
+
+
+class JournaledUpdatesRequest(HTTPXRequest):
+    """
+    Запросы getUpdates: перед каждым поступившие обновления дописываются в журнал,
+    потому что getUpdates с новым offset подтверждает Telegram их получение
+    """
+    
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        await update_journal.flush_received()
+        return await super().do_request(url, method, request_data, **kwargs)
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest, замеряющий время запросов к Bot API по методам"""
+    
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        try:
+            status_code, payload = await super().do_request(url, method, request_data, **kwargs)
+        except Exception:
+            metrics.inc('bot_telegram_request_errors_total', method=api_method)
+            raise
+        finally:
+            metrics.observe('bot_telegram_request_duration_seconds', time.perf_counter() - started, method=api_method)
+        if status_code >= 400:
+            metrics.inc('bot_telegram_request_errors_total', method=api_method)
+        return status_code, payload
 
 
-def get_coordinates_from_yandex_geocoder(search_query):
+# Код обертки общий для всех обработчиков: по нему профилировщик находит в стеке кадр
+# обертки и берет маршрут из его локальной переменной route
+INSTRUMENTED_WRAPPER_CODE = instrumented(lambda update, context: None).__code__
+
+
+class StackSampler:
+    """
+    Сэмплирующий профилировщик: фоновый поток периодически снимает стек потока
+    цикла событий и относит сэмпл к маршруту обработчика, который сейчас выполняется
     """
-    Получает координаты места через Яндекс.Геокодер API
     
-    Args:
-        search_query: Поисковый запрос (например, "Парк Горького, Москва")
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = 0
+        self.route_samples = Counter()
+        self.self_samples = {}  # {route: Counter(функция)}
+        self.total_samples = {}  # {route: Counter(функция)} - функция есть в стеке
+        self.started_at = None
+        self.finished_at = None
+        self._stop = threading.Event()
+        self._thread = None
     
-    Returns:
-        tuple: (latitude, longitude) или None в случае ошибки
-    """
-    if not YANDEX_GEOCODER_API_KEY:
-        return None
+    @staticmethod
+    def describe_frame(frame):
+        code = frame.f_code
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
     
-    try:
-        try:
-            import requests  # pyright: ignore[reportMissingImports]
-        except ImportError:
-            logger.warning("Библиотека requests не установлена. Установите её для использования Яндекс.Геокодер API: pip install requests")
-            return None
-        
-        base_url = "https://geocode-maps.yandex.ru/1.x/"
-        params = {
-            "apikey": YANDEX_GEOCODER_API_KEY,
-            "geocode": search_query,
-            "format": "json"
-        }
-        
-        response = requests.get(base_url, params=params, timeout=5)
-        if response.status_code == 200:
-            json_response = response.json()
-            try:
-                pos = json_response["response"]["GeoObjectCollection"]["featureMember"][0]["GeoObject"]["Point"]["pos"]
-                longitude, latitude = map(float, pos.split())
-                return latitude, longitude
-            except (IndexError, KeyError):
-                logger.debug(f"Не удалось найти координаты для запроса: {search_query}")
-                return None
-        else:
-            logger.warning(f"Ошибка при запросе к Яндекс.Геокодеру: {response.status_code}")
-            return None
-    except Exception as e:
-        logger.error(f"Ошибка при получении координат через Яндекс.Геокодер: {e}")
-        return None
-
-
-def get_place_info(region, district, place):
-    """Получает информацию о месте (координаты для Яндекс карт и фото)"""
-    import urllib.parse
+    def take_sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        if frame is None:
+            return
+        functions = []
+        route = None
+        while frame is not None:
+            if frame.f_code is INSTRUMENTED_WRAPPER_CODE:
+                # Кадры цикла событий над обработчиком одинаковы у всех сэмплов и в отчете не нужны
+                route = frame.f_locals.get('route')
+                break
+            functions.append(self.describe_frame(frame))
+            frame = frame.f_back
+        if not functions:
+            return
+        
+        # Вне обработчиков цикл событий либо ждет ввода-вывода, либо выполняет служебный код
+        route = route or '(вне обработчиков)'
+        self.samples += 1
+        self.route_samples[route] += 1
+        self.self_samples.setdefault(route, Counter())[functions[0]] += 1
+        self.total_samples.setdefault(route, Counter()).update(set(functions))
     
-    # Расширенная база координат для известных мест
-    # В реальном приложении это должно храниться в базе данных
-    places_coords = {
-        # Москва
-        "Парк Горького": {"lat": "55.7326", "lon": "37.6017"},
-        "Сокольники": {"lat": "55.7902", "lon": "37.6769"},
-        "Красная площадь": {"lat": "55.7539", "lon": "37.6208"},
-        "Александровский сад": {"lat": "55.7520", "lon": "37.6156"},
-        "Нескучный сад": {"lat": "55.7147", "lon": "37.5964"},
-        "Царицыно": {"lat": "55.6214", "lon": "37.6811"},
-        "Коломенское": {"lat": "55.6682", "lon": "37.6685"},
-        "Измайловский парк": {"lat": "55.7892", "lon": "37.7735"},
-        "Парк Дружбы": {"lat": "55.7786", "lon": "37.5179"},
-        "Парк Северного речного вокзала": {"lat": "55.7917", "lon": "37.4803"},
-        "Лихоборские пруды": {"lat": "55.8633", "lon": "37.5531"},
-        "Алтуфьевский парк": {"lat": "55.8919", "lon": "37.5864"},
-        "Лианозовский парк": {"lat": "55.9000", "lon": "37.5764"},
-        "Битцевский лесопарк": {"lat": "55.6081", "lon": "37.5833"},
-        "Царицынские пруды": {"lat": "55.6214", "lon": "37.6811"},
-        "Парк усадьбы Люблино": {"lat": "55.6819", "lon": "37.7494"},
-        # Санкт-Петербург
-        "Летний сад": {"lat": "59.9444", "lon": "30.3372"},
-        "Марсово поле": {"lat": "59.9439", "lon": "30.3323"},
-        "Михайловский сад": {"lat": "59.9394", "lon": "30.3322"},
-        "Парк 300-летия": {"lat": "59.9833", "lon": "30.2000"},
-        "Елагин остров": {"lat": "59.9781", "lon": "30.2589"},
-        "Таврический сад": {"lat": "59.9458", "lon": "30.3764"},
-        "Александровский парк": {"lat": "59.9544", "lon": "30.3233"},
-        "Парк 300-летия Санкт-Петербурга": {"lat": "59.9833", "lon": "30.2000"},
-        "Приморский парк Победы": {"lat": "59.9781", "lon": "30.2589"},
-        "Крестовский остров": {"lat": "59.9733", "lon": "30.2619"},
-    }
+    def run(self):
+        while not self._stop.wait(self.interval):
+            self.take_sample()
     
-    # Если есть координаты для места в базе - используем их для точной ссылки
-    if place in places_coords:
-        coords = places_coords[place]
-        yandex_map_url = f"https://yandex.ru/maps/?pt={coords['lon']},{coords['lat']}&z=15&l=map"
-    else:
-        # Пытаемся получить координаты через Яндекс.Геокодер API, если API ключ указан
-        search_query = f"{place}, {district}, {region}"
-        coordinates = get_coordinates_from_yandex_geocoder(search_query)
-        
-        if coordinates:
-            # Используем полученные координаты для точной ссылки
-            lat, lon = coordinates
-            yandex_map_url = f"https://yandex.ru/maps/?pt={lon},{lat}&z=15&l=map"
-        else:
-            # Если координаты не найдены, используем текстовый поиск
-            encoded_query = urllib.parse.quote(search_query)
-            yandex_map_url = f"https://yandex.ru/maps/?text={encoded_query}"
+    def start(self):
+        self.started_at = time.time()
+        self._thread = threading.Thread(target=self.run, name='stack-sampler', daemon=True)
+        self._thread.start()
     
-    # URL для фото (можно использовать placeholder или реальные фото)
-    # Для демонстрации используем placeholder изображение
-    photo_url = None  # Можно добавить реальные URL фото мест
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.finished_at = time.time()
     
-    return {
-        "yandex_map_url": yandex_map_url,
-        "photo_url": photo_url
-    }
+    def report(self, top=PROFILE_REPORT_TOP):
+        """Текстовый отчет: доля времени по маршрутам и самые дорогие функции каждого маршрута"""
+        duration = self.finished_at - self.started_at
+        # Поток сэмплера ждет GIL, поэтому реальный интервал между сэмплами больше заданного
+        seconds_per_sample = duration / self.samples if self.samples else 0
+        lines = [
+            f"Профиль за {duration:.0f} с: {self.samples} сэмплов (~{seconds_per_sample * 1000:.1f} мс на сэмпл)",
+            "self - функция на вершине стека, total - функция где-либо в стеке (кумулятивно).",
+            ""
+        ]
+        for route, route_count in self.route_samples.most_common():
+            share = route_count * 100 / self.samples
+            lines.append(f"== {route}: {route_count * seconds_per_sample:.2f} с ({share:.1f}%)")
+            self_counts = self.self_samples[route]
+            lines.append(f"{'total, с':>9} {'self, с':>9}  функция")
+            for function, count in self.total_samples[route].most_common(top):
+                lines.append(
+                    f"{count * seconds_per_sample:9.3f} {self_counts[function] * seconds_per_sample:9.3f}  {function}"
+                )
+            lines.append("")
+        return "\n".join(lines)
 
 
-def get_district_menu():
-    """Меню выбора района"""
-    keyboard = [
-        [InlineKeyboardButton("Назад", callback_data="find_location")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+profiling_session = None  # Текущий StackSampler, если профилирование запущено
 
 
-def get_admin_menu():
-    """Меню администратора"""
-    keyboard = [
-        [InlineKeyboardButton("👥 Список подписчиков", callback_data="admin_list_subscribers")],
-        [InlineKeyboardButton("Назад", callback_data="main_menu")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+def start_profiling_session(application, chat_id, duration):
+    """Запускает профилирование, если оно еще не идет. Возвращает False, если уже запущено"""
+    global profiling_session
+    if profiling_session is not None:
+        return False
+    profiling_session = StackSampler(threading.get_ident(), PROFILE_SAMPLE_INTERVAL)
+    application.create_task(
+        run_profiling_session(application.bot, chat_id, profiling_session, duration),
+        name="profiling_session"
+    )
+    return True
 
 
-def get_subscriber_management_menu(subscriber_id):
-    """Меню управления конкретным подписчиком"""
-    keyboard = [
-        [InlineKeyboardButton("Назад", callback_data="admin_list_subscribers")],
-        [InlineKeyboardButton("🏷️ Добавить метку", callback_data=f"admin_add_tag_{subscriber_id}")],
-        [InlineKeyboardButton("🏷️ Удалить метку", callback_data=f"admin_remove_tag_{subscriber_id}")],
-        [InlineKeyboardButton("✉️ Написать сообщение", callback_data=f"admin_message_{subscriber_id}")],
-        [InlineKeyboardButton("🗑️ Удалить контакт", callback_data=f"admin_delete_{subscriber_id}")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+async def run_profiling_session(bot, chat_id, sampler, duration):
+    """Профилирует процесс duration секунд и отправляет отчет администратору файлом"""
+    global profiling_session
+    sampler.start()
+    logger.info("Профилирование запущено на %.0f с", duration)
+    try:
+        await asyncio.sleep(duration)
+    finally:
+        await asyncio.to_thread(sampler.stop)
+        profiling_session = None
+    
+    report = sampler.report()
+    filename = time.strftime('profile-%Y%m%d-%H%M%S.txt', time.localtime(sampler.started_at))
+    try:
+        await bot.send_document(
+            chat_id=chat_id,
+            document=report.encode('utf-8'),
+            filename=filename,
+            caption=f"🔬 Профиль за {duration:.0f} с ({sampler.samples} сэмплов)"
+        )
+    except Exception as e:
+        logger.error("Ошибка при отправке отчета профилировщика: %s", e)
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик команды /start"""
     try:
-        logger.info(f"Получена команда /start от пользователя {update.effective_user.id}")
+        logger.info("Получена команда /start от пользователя %s", update.effective_user.id)
         user = update.effective_user
         user_id = user.id
         
-        # Инициализируем данные пользователя, если их еще нет
-        if user_id not in user_data:
-            user_data[user_id] = {
-                'walking_location': None,
-                'pet_photo_id': None,
-                'friends': [],
-                'username': user.username,
-                'first_name': user.first_name,
-                'last_name': user.last_name,
-                'phone_number': None,
-                'phone_verified': False,
-                'tags': [],
-                'age': None
-            }
-            save_user_data()  # Сохраняем нового пользователя
-        else:
-            # Обновляем данные пользователя при каждом старте
-            if 'username' not in user_data[user_id]:
-                user_data[user_id]['username'] = None
-            if 'first_name' not in user_data[user_id]:
-                user_data[user_id]['first_name'] = None
-            if 'last_name' not in user_data[user_id]:
-                user_data[user_id]['last_name'] = None
-            if 'tags' not in user_data[user_id]:
-                user_data[user_id]['tags'] = []
-            if 'age' not in user_data[user_id]:
-                user_data[user_id]['age'] = None
-            
-            user_data[user_id]['username'] = user.username
-            user_data[user_id]['first_name'] = user.first_name
-            user_data[user_id]['last_name'] = user.last_name
-            save_user_data()  # Сохраняем обновления
+        async with state_locks.hold(user_id):
+            # Инициализируем данные пользователя, если их еще нет
+            if user_id not in user_data:
+                user_data[user_id] = {
+                    'walking_location': None,
+                    'pet_photo_id': None,
+                    'friends': [],
+                    'username': user.username,
+                    'first_name': user.first_name,
+                    'last_name': user.last_name,
+                    'phone_number': None,
+                    'phone_verified': False,
+                    'tags': [],
+                    'age': None
+                }
+                save_user_data()  # Сохраняем нового пользователя
+            else:
+                # Обновляем данные пользователя при каждом старте
+                if 'username' not in user_data[user_id]:
+                    user_data[user_id]['username'] = None
+                if 'first_name' not in user_data[user_id]:
+                    user_data[user_id]['first_name'] = None
+                if 'last_name' not in user_data[user_id]:
+                    user_data[user_id]['last_name'] = None
+                if 'tags' not in user_data[user_id]:
+                    user_data[user_id]['tags'] = []
+                if 'age' not in user_data[user_id]:
+                    user_data[user_id]['age'] = None
+                
+                user_data[user_id]['username'] = user.username
+                user_data[user_id]['first_name'] = user.first_name
+                user_data[user_id]['last_name'] = user.last_name
+                save_user_data()  # Сохраняем обновления
         
         user_name = user.first_name or 'Друг'
         await update.message.reply_text(
@@ -469,9 +5169,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             'Выберите действие из меню:',
             reply_markup=get_main_menu(user_id)
         )
-        logger.info(f"Ответ отправлен пользователю {user_id}")
+        logger.info("Ответ отправлен пользователю %s", user_id)
     except Exception as e:
-        logger.error(f"Ошибка в обработчике start: {e}", exc_info=True)
+        logger.error("Ошибка в обработчике start: %s", e, exc_info=True)
         # Даже при ошибке пытаемся отправить сообщение пользователю
         try:
             await update.message.reply_text(
@@ -480,7 +5180,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                 reply_markup=get_main_menu(None)
             )
         except Exception as e2:
-            logger.error(f"Критическая ошибка при отправке ответа: {e2}", exc_info=True)
+            logger.error("Критическая ошибка при отправке ответа: %s", e2, exc_info=True)
 
 
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -516,9 +5216,13 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         phone_verified = user_data[user_id].get('phone_verified', False)
         phone_status = "✅ подтвержден" if phone_verified else "❌ не подтвержден" if phone_number != 'не указан' else "не указан"
         
+        walk_windows = user_data[user_id].get('walk_windows')
+        walk_schedule = format_walk_windows(walk_windows) if walk_windows else 'не указано'
+        
         text = (
             "📋 Мой профиль\n\n"
             f"📍 Где я гуляю: {walking_location}\n"
+            f"🕒 Когда я гуляю: {walk_schedule}\n"
             f"📷 Фото питомца: {pet_photo_status}\n"
             f"📱 Телефон: {phone_number} ({phone_status})\n\n"
             "Выберите действие:"
@@ -552,6 +5256,22 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         
         return WAITING_LOCATION_COORDS
     
+    elif callback_data == "my_walk_schedule":
+        walk_windows = user_data[user_id].get('walk_windows')
+        current = f"Сейчас: {format_walk_windows(walk_windows)}\n\n" if walk_windows else ""
+        await query.edit_message_text(
+            "🕒 Когда я гуляю\n\n"
+            f"{current}"
+            "Напишите дни и время прогулок, например:\n"
+            "• будни 7:00-8:00, 20:00-21:00\n"
+            "• выходные 10-12\n"
+            "• пн, ср, пт 19:00-20:30; сб 9-11\n\n"
+            "Без дней - каждый день. Чтобы убрать расписание, напишите «нет».\n\n"
+            "По расписанию и месту прогулок работает поиск «👫 Найти компанию».",
+            reply_markup=get_walking_location_menu()
+        )
+        return WAITING_WALK_SCHEDULE
+    
     elif callback_data == "pet_photo":
         await query.edit_message_text(
             "📷 Фото питомца\n\n"
@@ -604,6 +5324,35 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         
         return ConversationHandler.END
     
+    elif callback_data == "my_walks":
+        # Итоги по неделям и последние прогулки с живой геопозицией
+        weeks = walk_history.weeks(user_id)
+        recent = walk_history.recent(user_id)
+        if not weeks:
+            text = (
+                "📊 Мои прогулки\n\n"
+                "Пока нет записанных прогулок. Нажмите «🟢 Я гуляю сейчас» в разделе "
+                "«Гулять с друзьями» и включите трансляцию геопозиции - бот запишет маршрут."
+            )
+        else:
+            current_week = datetime.now(SCHEDULE_TZ).strftime('%G-W%V')
+            lines = ["📊 Мои прогулки", ""]
+            for week, walks, distance, duration in weeks:
+                title = "Эта неделя" if week == current_week else f"Неделя {week[-2:]}"
+                lines.append(f"{title}: {walks} прог., {format_distance(distance)}, {format_duration(duration)}")
+            lines += ["", "Последние прогулки:"]
+            for started_at, ended_at, distance in recent:
+                lines.append(
+                    f"• {datetime.fromtimestamp(started_at, SCHEDULE_TZ):%d.%m %H:%M} - "
+                    f"{format_distance(distance)}, {format_duration(ended_at - started_at)}"
+                )
+            text = "\n".join(lines)
+        await query.edit_message_text(
+            text,
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Назад", callback_data="profile")]])
+        )
+        return ConversationHandler.END
+    
     elif callback_data == "walk_with_friends":
         await query.edit_message_text(
             "👥 Гулять с друзьями\n\n"
@@ -730,16 +5479,21 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             await query.answer("Ошибка: данные пользователя не найдены", show_alert=True)
             return ConversationHandler.END
         
-        friends_list = user_data[user_id].get('friends', [])
-        
-        # Удаляем друга из списка
-        updated_friends = [
-            f for f in friends_list 
-            if isinstance(f, dict) and f.get('user_id') != friend_id
-        ]
-        
-        user_data[user_id]['friends'] = updated_friends
-        save_user_data()  # Сохраняем изменения
+        async with state_locks.hold(user_id, friend_id):
+            friends_list = user_data[user_id].get('friends', [])
+            was_friend = friend_id in get_friend_ids(user_data[user_id])
+            
+            # Удаляем друга из списка
+            updated_friends = [
+                f for f in friends_list 
+                if isinstance(f, dict) and f.get('user_id') != friend_id
+            ]
+            
+            user_data[user_id]['friends'] = updated_friends
+            save_user_data()  # Сохраняем изменения
+            if was_friend:
+                friend_suggestions.friendship_removed(user_id, friend_id)
+                friend_followers.update(user_id, user_data[user_id])
         
         friend_info = user_data.get(friend_id, {})
         friend_name = friend_info.get('first_name', 'Пользователь') if friend_info else 'Пользователь'
@@ -806,235 +5560,12 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return ConversationHandler.END
     
     elif callback_data == "choose_region":
-        # Показываем список регионов России
-        regions = get_regions_list()
-        text = "🗺️ Выбрать регион\n\nВыберите регион из списка:\n\n"
-        keyboard = []
-        
-        # Разбиваем на кнопки по 2 в ряд для компактности
-        for i in range(0, len(regions), 2):
-            row = []
-            row.append(InlineKeyboardButton(
-                regions[i],
-                callback_data=f"select_region_{i}"
-            ))
-            if i + 1 < len(regions):
-                row.append(InlineKeyboardButton(
-                    regions[i + 1],
-                    callback_data=f"select_region_{i + 1}"
-                ))
-            keyboard.append(row)
-        
-        keyboard.append([InlineKeyboardButton("Назад", callback_data="find_location")])
-        
-        await query.edit_message_text(
-            text,
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-        return ConversationHandler.END
-    
-    elif callback_data.startswith("select_region_"):
-        # Обработка выбора региона
-        try:
-            region_index = int(callback_data.split("_")[2])
-            regions = get_regions_list()
-            if 0 <= region_index < len(regions):
-                selected_region = regions[region_index]
-                
-                # Сохраняем выбранный регион в контексте для дальнейшей обработки
-                context.user_data['selected_region'] = selected_region
-                
-                # Показываем меню с кнопкой выбора района
-                keyboard = [
-                    [InlineKeyboardButton("Назад", callback_data="choose_region")],
-                    [InlineKeyboardButton("🏘️ Выбрать район", callback_data="choose_district_in_region")]
-                ]
-                
-                await query.edit_message_text(
-                    f"🗺️ Регион: {selected_region}\n\n"
-                    "Выберите район для поиска мест для прогулок:",
-                    reply_markup=InlineKeyboardMarkup(keyboard)
-                )
-            else:
-                await query.answer("Ошибка: некорректный регион", show_alert=True)
-                return ConversationHandler.END
-        except (ValueError, IndexError) as e:
-            logger.error(f"Ошибка при обработке выбора региона: {e}")
-            await query.answer("Ошибка: некорректный формат данных", show_alert=True)
-            return ConversationHandler.END
-        return ConversationHandler.END
-    
-    elif callback_data == "choose_district_in_region":
-        # Выбор района в выбранном регионе
-        selected_region = context.user_data.get('selected_region')
-        if not selected_region:
-            await query.answer("Ошибка: регион не выбран", show_alert=True)
-            return ConversationHandler.END
-        
-        districts = get_districts_by_region(selected_region)
-        
-        text = f"🏘️ Выбрать район\n\n"
-        text += f"Регион: {selected_region}\n\n"
-        text += "Выберите район:\n\n"
-        
-        keyboard = []
-        # Разбиваем на кнопки по 2 в ряд
-        for i in range(0, len(districts), 2):
-            row = []
-            row.append(InlineKeyboardButton(
-                districts[i],
-                callback_data=f"select_district_{i}"
-            ))
-            if i + 1 < len(districts):
-                row.append(InlineKeyboardButton(
-                    districts[i + 1],
-                    callback_data=f"select_district_{i + 1}"
-                ))
-            keyboard.append(row)
-        
-        # Сохраняем индекс региона для возврата
-        region_index = get_regions_list().index(selected_region) if selected_region in get_regions_list() else 0
-        # Вставляем кнопку "Назад" в начало
-        keyboard.insert(0, [InlineKeyboardButton("Назад", callback_data=f"select_region_{region_index}")])
-        
-        await query.edit_message_text(
-            text,
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-        return ConversationHandler.END
-    
-    elif callback_data.startswith("select_district_"):
-        # Обработка выбора района
-        try:
-            district_index = int(callback_data.split("_")[2])
-            selected_region = context.user_data.get('selected_region')
-            if not selected_region:
-                await query.answer("Ошибка: регион не выбран", show_alert=True)
-                return ConversationHandler.END
-            
-            districts = get_districts_by_region(selected_region)
-            if 0 <= district_index < len(districts):
-                selected_district = districts[district_index]
-                
-                # Сохраняем выбранный район в контексте
-                context.user_data['selected_district'] = selected_district
-                
-                # Получаем список мест для прогулок
-                walking_places = get_walking_places_by_district(selected_region, selected_district)
-                
-                text = f"🌳 Места для прогулок\n\n"
-                text += f"Регион: {selected_region}\n"
-                text += f"Район: {selected_district}\n\n"
-                text += "Нажмите на место, чтобы открыть его на Яндекс картах:\n\n"
-                
-                keyboard = []
-                for i, place in enumerate(walking_places):
-                    # Получаем URL для места
-                    place_info = get_place_info(selected_region, selected_district, place)
-                    yandex_map_url = place_info['yandex_map_url']
-                    
-                    text += f"{i + 1}. {place}\n"
-                    # Используем URL кнопку, чтобы сразу открывать Яндекс карты
-                    keyboard.append([InlineKeyboardButton(
-                        f"{i + 1}. {place}",
-                        url=yandex_map_url
-                    )])
-                
-                # Вставляем кнопку "Назад" в начало
-                keyboard.insert(0, [InlineKeyboardButton("Назад", callback_data="choose_district_in_region")])
-                
-                await query.edit_message_text(
-                    text,
-                    reply_markup=InlineKeyboardMarkup(keyboard)
-                )
-            else:
-                await query.answer("Ошибка: некорректный район", show_alert=True)
-                return ConversationHandler.END
-        except (ValueError, IndexError) as e:
-            logger.error(f"Ошибка при обработке выбора района: {e}")
-            await query.answer("Ошибка: некорректный формат данных", show_alert=True)
-            return ConversationHandler.END
+        text, keyboard = get_regions_screen(place_catalogs.current)
+        await query.edit_message_text(text, reply_markup=keyboard)
         return ConversationHandler.END
     
-    elif callback_data.startswith("select_walking_place_"):
-        # Обработка выбора места для прогулок
-        try:
-            place_index = int(callback_data.split("_")[3])
-            selected_region = context.user_data.get('selected_region')
-            selected_district = context.user_data.get('selected_district')
-            
-            if not selected_region or not selected_district:
-                await query.answer("Ошибка: регион или район не выбран", show_alert=True)
-                return ConversationHandler.END
-            
-            walking_places = get_walking_places_by_district(selected_region, selected_district)
-            if 0 <= place_index < len(walking_places):
-                selected_place = walking_places[place_index]
-                
-                # Сохраняем информацию о месте в контексте
-                context.user_data['selected_place'] = selected_place
-                context.user_data['selected_place_full'] = f"{selected_region}, {selected_district}, {selected_place}"
-                
-                # Получаем информацию о месте
-                place_info = get_place_info(selected_region, selected_district, selected_place)
-                
-                # Формируем текст с информацией о месте
-                text = f"🌳 {selected_place}\n\n"
-                text += f"📍 Регион: {selected_region}\n"
-                text += f"🏘️ Район: {selected_district}\n\n"
-                
-                # Создаем клавиатуру с кнопками
-                keyboard = []
-                
-                # Кнопка с ссылкой на Яндекс карты
-                keyboard.append([InlineKeyboardButton(
-                    "🗺️ Открыть на Яндекс картах",
-                    url=place_info['yandex_map_url']
-                )])
-                
-                # Кнопка "Поделиться местом с другом"
-                keyboard.append([InlineKeyboardButton(
-                    "📤 Поделиться местом с другом",
-                    callback_data="share_place_with_friend"
-                )])
-                
-                # Кнопка "Назад" в начало
-                districts = get_districts_by_region(selected_region)
-                district_index = districts.index(selected_district) if selected_district in districts else 0
-                keyboard.insert(0, [InlineKeyboardButton("Назад", callback_data=f"select_district_{district_index}")])
-                
-                # Если есть фото места, отправляем его с подписью
-                if place_info.get('photo_url'):
-                    try:
-                        await context.bot.send_photo(
-                            chat_id=query.from_user.id,
-                            photo=place_info['photo_url'],
-                            caption=text,
-                            reply_markup=InlineKeyboardMarkup(keyboard)
-                        )
-                        # Удаляем предыдущее сообщение
-                        await query.delete_message()
-                    except Exception as e:
-                        logger.error(f"Ошибка при отправке фото места: {e}")
-                        # Если не удалось отправить фото, отправляем текст
-                        await query.edit_message_text(
-                            text,
-                            reply_markup=InlineKeyboardMarkup(keyboard)
-                        )
-                else:
-                    # Если фото нет, просто показываем текст
-                    await query.edit_message_text(
-                        text,
-                        reply_markup=InlineKeyboardMarkup(keyboard)
-                    )
-            else:
-                await query.answer("Ошибка: некорректное место", show_alert=True)
-                return ConversationHandler.END
-        except (ValueError, IndexError) as e:
-            logger.error(f"Ошибка при обработке выбора места: {e}")
-            await query.answer("Ошибка: некорректный формат данных", show_alert=True)
-            return ConversationHandler.END
-        return ConversationHandler.END
+    elif callback_data.startswith(PLACE_CALLBACK_PREFIX) or callback_data.startswith(LEGACY_PLACE_CALLBACKS):
+        return await handle_place_callback(query, context, callback_data)
     
     elif callback_data == "share_place_with_friend":
         # Поделиться местом с другом
@@ -1077,19 +5608,148 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                     callback_data=f"share_place_to_{friend_id}"
                 )])
         
-        # Кнопка "Назад" в начало
-        districts = get_districts_by_region(context.user_data.get('selected_region', ''))
-        selected_district = context.user_data.get('selected_district', '')
-        district_index = districts.index(selected_district) if selected_district in districts else 0
-        place_index = 0  # Нужно найти индекс места
-        walking_places = get_walking_places_by_district(context.user_data.get('selected_region', ''), selected_district)
-        if selected_place in walking_places:
-            place_index = walking_places.index(selected_place)
-        keyboard.insert(0, [InlineKeyboardButton("Назад", callback_data=f"select_walking_place_{place_index}")])
+        # Кнопка "Назад" в начало
+        keyboard.insert(0, [InlineKeyboardButton("Назад", callback_data=get_selected_place_callback(context.user_data))])
+        
+        await query.edit_message_text(
+            text,
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+        return ConversationHandler.END
+    
+    elif callback_data == "plan_walk":
+        # Назначить прогулку в выбранном месте: дальше пользователь пишет время
+        selected_place = context.user_data.get('selected_place')
+        if not context.user_data.get('selected_place_full') or not selected_place:
+            await query.answer("Ошибка: место не выбрано", show_alert=True)
+            return ConversationHandler.END
+        
+        await query.edit_message_text(
+            f"📅 Назначить прогулку\n\n"
+            f"🌳 {selected_place}\n\n"
+            "Напишите, когда гуляем, например: «сегодня 19:30», «завтра 8:00», «сб 10:00» или «25.10 18:30».\n\n"
+            "Друзья с подтвержденным телефоном получат приглашение и смогут ответить, "
+            "а тем, кто придет, мы заранее напомним о прогулке.",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("Назад", callback_data=get_selected_place_callback(context.user_data))]
+            ])
+        )
+        return WAITING_WALK_TIME
+    
+    elif callback_data == "planned_walks":
+        walks = walk_planner.upcoming(user_id)
+        if not walks:
+            text = (
+                "📅 Запланированные прогулки\n\n"
+                "Предстоящих прогулок нет.\n\n"
+                "Чтобы назначить прогулку, выберите место в разделе «Найти локацию для прогулки» "
+                "и нажмите «📅 Назначить прогулку здесь»."
+            )
+        else:
+            text = "📅 Запланированные прогулки\n\nВыберите прогулку:"
+        keyboard = []
+        for walk in walks:
+            mark = "👤" if walk['organizer_id'] == user_id else "✉️"
+            keyboard.append([InlineKeyboardButton(
+                f"{mark} {format_walk_time(walk['starts_at'])}, {walk['place']}",
+                callback_data=f"walk_view_{walk['id']}"
+            )])
+        keyboard.append([InlineKeyboardButton("Назад", callback_data="walk_with_friends")])
+        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+        return ConversationHandler.END
+    
+    elif callback_data.startswith("walk_view_"):
+        try:
+            walk_id = int(callback_data.split("_")[2])
+        except (ValueError, IndexError):
+            await query.answer("Ошибка: некорректный формат данных", show_alert=True)
+            return ConversationHandler.END
+        walk = walk_planner.get(walk_id)
+        answers = walk_planner.answers(walk_id) if walk else {}
+        if walk is None or (walk['organizer_id'] != user_id and user_id not in answers):
+            await query.answer("Прогулка не найдена", show_alert=True)
+            return ConversationHandler.END
+        status = "❌ Прогулка отменена\n\n" if walk['cancelled'] else ""
+        await query.edit_message_text(
+            f"{status}📅 Прогулка {format_walk_time(walk['starts_at'])}\n\n{format_planned_walk(walk, answers)}",
+            reply_markup=get_planned_walk_keyboard(walk, user_id)
+        )
+        return ConversationHandler.END
+    
+    elif callback_data.startswith("walk_rsvp_"):
+        # Ответ на приглашение: walk_rsvp_<ID прогулки>_<yes|no>
+        try:
+            _, _, walk_id, answer = callback_data.split("_")
+            walk_id = int(walk_id)
+        except ValueError:
+            await query.answer("Ошибка: некорректный формат данных", show_alert=True)
+            return ConversationHandler.END
+        walk = walk_planner.get(walk_id)
+        if walk is None or answer not in ('yes', 'no'):
+            await query.answer("Прогулка не найдена", show_alert=True)
+            return ConversationHandler.END
+        if walk['cancelled'] or walk['starts_at'] <= time.time():
+            await query.answer("Эта прогулка уже отменена или прошла", show_alert=True)
+            return ConversationHandler.END
+        
+        previous = walk_planner.rsvp(walk_id, user_id, answer)
+        if previous == 'not_invited':
+            await query.answer("Вы не приглашены на эту прогулку", show_alert=True)
+            return ConversationHandler.END
+        answers = walk_planner.answers(walk_id)
+        your_answer = "✅ Вы придете" if answer == 'yes' else "❌ Вы не придете"
+        # Сообщение-приглашение заменяется актуальным составом, кнопки остаются, чтобы передумать
+        await query.edit_message_text(
+            f"📅 Прогулка {format_walk_time(walk['starts_at'])}\n\n"
+            f"{format_planned_walk(walk, answers)}\n\n{your_answer}",
+            reply_markup=get_planned_walk_keyboard(walk, user_id, back=False)
+        )
+        if previous != answer:
+            guest_name = query.from_user.first_name or 'Друг'
+            if query.from_user.username:
+                guest_name += f" (@{query.from_user.username})"
+            verb = "придет" if answer == 'yes' else "не сможет прийти"
+            update_journal.commit(update)
+            try:
+                await context.bot.send_message(
+                    chat_id=walk['organizer_id'],
+                    text=f"{'✅' if answer == 'yes' else '❌'} {guest_name} {verb} на прогулку "
+                         f"{format_walk_time(walk['starts_at'])} ({walk['place']})"
+                )
+            except Exception as e:
+                logger.warning("Не удалось уведомить организатора прогулки %s: %s", walk_id, e)
+        return ConversationHandler.END
+    
+    elif callback_data.startswith("walk_cancel_"):
+        try:
+            walk_id = int(callback_data.split("_")[2])
+        except (ValueError, IndexError):
+            await query.answer("Ошибка: некорректный формат данных", show_alert=True)
+            return ConversationHandler.END
+        walk = walk_planner.get(walk_id)
+        if walk is None or walk['organizer_id'] != user_id:
+            await query.answer("Прогулка не найдена", show_alert=True)
+            return ConversationHandler.END
+        if walk['cancelled']:
+            await query.answer("Прогулка уже отменена", show_alert=True)
+            return ConversationHandler.END
         
+        walk_planner.cancel(walk_id)
+        # Уведомляем всех, кто не отказался сам
+        update_journal.commit(update)
+        for guest_id, answer in walk_planner.answers(walk_id).items():
+            if answer == 'no':
+                continue
+            try:
+                await context.bot.send_message(
+                    chat_id=guest_id,
+                    text=f"❌ Прогулка {format_walk_time(walk['starts_at'])} ({walk['place']}) отменена организатором."
+                )
+            except Exception as e:
+                logger.warning("Не удалось сообщить %s об отмене прогулки %s: %s", guest_id, walk_id, e)
         await query.edit_message_text(
-            text,
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            f"❌ Прогулка {format_walk_time(walk['starts_at'])} ({walk['place']}) отменена. Приглашенные получили уведомление.",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Назад", callback_data="planned_walks")]])
         )
         return ConversationHandler.END
     
@@ -1116,7 +5776,9 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             return ConversationHandler.END
         
         # Получаем информацию о месте для Яндекс карт
-        place_info = get_place_info(selected_region, selected_district, selected_place)
+        place_info = await get_place_info(
+            selected_region, selected_district, selected_place, place_catalogs.for_user(context.user_data)
+        )
         
         # Имя пользователя, который делится местом
         sender_name = query.from_user.first_name or 'Друг'
@@ -1135,6 +5797,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         
         try:
             # Отправляем сообщение другу
+            update_journal.commit(update)
             await context.bot.send_message(
                 chat_id=friend_id,
                 text=message_text,
@@ -1149,9 +5812,9 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                 f"✅ Место успешно отправлено другу {friend_display_name}!",
                 reply_markup=get_walk_with_friends_menu()
             )
-            logger.info(f"Пользователь {user_id} поделился местом {selected_place} с другом {friend_id}")
+            logger.info("Пользователь %s поделился местом %s с другом %s", user_id, selected_place, friend_id)
         except Exception as e:
-            logger.error(f"Ошибка при отправке места другу: {e}")
+            logger.error("Ошибка при отправке места другу: %s", e)
             await query.answer("❌ Не удалось отправить место. Возможно, друг заблокировал бота.", show_alert=True)
         
         return ConversationHandler.END
@@ -1164,20 +5827,10 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         )
         return WAITING_DISTRICT
     
-    elif callback_data == "find_vet":
-        await query.edit_message_text(
-            "🏥 Найти ветклинику\n\n"
-            "Функция в разработке. Скоро здесь будет поиск ближайших ветклиник.",
-            reply_markup=get_main_menu(user_id)
-        )
-        return ConversationHandler.END
-    
-    elif callback_data == "find_pet_shop":
-        await query.edit_message_text(
-            "🛒 Найти зоомагазин\n\n"
-            "Функция в разработке. Скоро здесь будет поиск ближайших зоомагазинов.",
-            reply_markup=get_main_menu(user_id)
-        )
+    elif callback_data in ("find_vet", "find_pet_shop"):
+        kind = 'vet' if callback_data == "find_vet" else 'pet_shop'
+        text, keyboard = get_poi_screen(kind, user_data.get(user_id))
+        await query.edit_message_text(text, reply_markup=keyboard)
         return ConversationHandler.END
     
     elif callback_data.startswith("select_user_"):
@@ -1327,15 +5980,16 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                     reply_markup=get_walk_with_friends_menu()
                 )
             else:
-                # Проверяем, не отправлен ли уже запрос
-                if target_user_id not in friend_requests:
-                    friend_requests[target_user_id] = []
+                async with state_locks.hold(user_id, target_user_id):
+                    # Проверяем, не отправлен ли уже запрос
+                    request_added = False
+                    if target_user_id in user_data and user_id not in friend_requests.get(target_user_id, []):
+                        # Добавляем запрос: target_user_id получит запрос от user_id
+                        friend_requests.setdefault(target_user_id, []).append(user_id)
+                        save_user_data()  # Сохраняем изменения
+                        request_added = True
                 
-                if user_id not in friend_requests[target_user_id]:
-                    # Добавляем запрос: target_user_id получит запрос от user_id
-                    friend_requests[target_user_id].append(user_id)
-                    save_user_data()  # Сохраняем изменения
-                    
+                if request_added:
                     # Пытаемся отправить уведомление пользователю
                     try:
                         current_user_name = query.from_user.first_name or 'Пользователь'
@@ -1348,10 +6002,11 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                             f"Используйте меню '👥 Гулять с друзьями' → '📥 Входящие запросы' чтобы подтвердить."
                         )
                         # Отправляем уведомление пользователю
+                        update_journal.commit(update)
                         await context.bot.send_message(chat_id=target_user_id, text=notification_text)
-                        logger.info(f"Пользователь {user_id} отправил запрос на дружбу {target_user_id}")
+                        logger.info("Пользователь %s отправил запрос на дружбу %s", user_id, target_user_id)
                     except Exception as e:
-                        logger.error(f"Ошибка при отправке уведомления: {e}")
+                        logger.error("Ошибка при отправке уведомления: %s", e)
                     
                     await query.edit_message_text(
                         f"✅ Запрос на дружбу отправлен пользователю {friend_name}!\n\n"
@@ -1436,11 +6091,18 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                 'age': None
             }
         
-        requestor_info = user_data.get(requestor_id)
+        current_user_name = query.from_user.first_name or 'Пользователь'
+        if query.from_user.username:
+            current_user_name += f" (@{query.from_user.username})"
         
-        if requestor_info:
+        # Изменяем граф дружбы под блокировкой пары пользователей,
+        # чтобы параллельное удаление контакта администратором не оставило висячих ссылок
+        async with state_locks.hold(user_id, requestor_id):
+            requestor_info = user_data.get(requestor_id)
             # Проверяем, что запрос действительно существует
-            if user_id in friend_requests and requestor_id in friend_requests[user_id]:
+            request_found = bool(requestor_info) and requestor_id in friend_requests.get(user_id, [])
+            
+            if request_found:
                 # Удаляем запрос
                 friend_requests[user_id].remove(requestor_id)
                 if not friend_requests[user_id]:
@@ -1466,27 +6128,13 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                         'user_id': requestor_id,
                         'name': requestor_name
                     })
+                    friend_suggestions.friendship_added(user_id, requestor_id)
+                    friend_followers.update(user_id, user_data[user_id])
                 
                 # Добавляем user_id в друзья requestor_id
-                if requestor_id not in user_data:
-                    user_data[requestor_id] = {
-                        'walking_location': None,
-                        'pet_photo_id': None,
-                        'friends': [],
-                        'username': requestor_info.get('username'),
-                        'first_name': requestor_info.get('first_name'),
-                        'last_name': requestor_info.get('last_name'),
-                        'tags': [],
-                        'age': None
-                    }
-                
                 if 'friends' not in user_data[requestor_id]:
                     user_data[requestor_id]['friends'] = []
                 
-                current_user_name = query.from_user.first_name or 'Пользователь'
-                if query.from_user.username:
-                    current_user_name += f" (@{query.from_user.username})"
-                
                 is_current_user_friend = any(
                     isinstance(f, dict) and f.get('user_id') == user_id 
                     for f in user_data[requestor_id]['friends']
@@ -1497,31 +6145,35 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                         'user_id': user_id,
                         'name': current_user_name
                     })
+                    friend_suggestions.friendship_added(requestor_id, user_id)
+                    friend_followers.update(requestor_id, user_data[requestor_id])
                 
                 save_user_data()  # Сохраняем изменения
-                
-                # Отправляем уведомление пользователю, чей запрос был принят
-                try:
-                    notification_text = (
-                        f"✅ Запрос на дружбу принят!\n\n"
-                        f"{current_user_name} принял(а) ваш запрос на дружбу.\n\n"
-                        f"Используйте меню '👥 Гулять с друзьями' → '👥 Мои друзья' чтобы увидеть список."
-                    )
-                    await context.bot.send_message(chat_id=requestor_id, text=notification_text)
-                    logger.info(f"Пользователь {user_id} принял запрос на дружбу от {requestor_id}")
-                except Exception as e:
-                    logger.error(f"Ошибка при отправке уведомления: {e}")
-                
-                await query.edit_message_text(
+        
+        if request_found:
+            # Отправляем уведомление пользователю, чей запрос был принят
+            try:
+                notification_text = (
                     f"✅ Запрос на дружбу принят!\n\n"
-                    f"Пользователь {requestor_name} добавлен в ваш список друзей.",
-                    reply_markup=get_walk_with_friends_menu()
-                )
-            else:
-                await query.edit_message_text(
-                    "❌ Запрос не найден или уже обработан.",
-                    reply_markup=get_walk_with_friends_menu()
+                    f"{current_user_name} принял(а) ваш запрос на дружбу.\n\n"
+                    f"Используйте меню '👥 Гулять с друзьями' → '👥 Мои друзья' чтобы увидеть список."
                 )
+                update_journal.commit(update)
+                await context.bot.send_message(chat_id=requestor_id, text=notification_text)
+                logger.info("Пользователь %s принял запрос на дружбу от %s", user_id, requestor_id)
+            except Exception as e:
+                logger.error("Ошибка при отправке уведомления: %s", e)
+            
+            await query.edit_message_text(
+                f"✅ Запрос на дружбу принят!\n\n"
+                f"Пользователь {requestor_name} добавлен в ваш список друзей.",
+                reply_markup=get_walk_with_friends_menu()
+            )
+        elif requestor_info:
+            await query.edit_message_text(
+                "❌ Запрос не найден или уже обработан.",
+                reply_markup=get_walk_with_friends_menu()
+            )
         else:
             await query.edit_message_text(
                 "❌ Пользователь не найден.",
@@ -1536,31 +6188,34 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         except (ValueError, IndexError):
             await query.answer("Ошибка: некорректный формат данных", show_alert=True)
             return ConversationHandler.END
-        requestor_info = user_data.get(requestor_id)
         
-        if requestor_info:
+        async with state_locks.hold(user_id, requestor_id):
+            requestor_info = user_data.get(requestor_id)
             # Проверяем, что запрос действительно существует
-            if user_id in friend_requests and requestor_id in friend_requests[user_id]:
+            request_found = bool(requestor_info) and requestor_id in friend_requests.get(user_id, [])
+            
+            if request_found:
                 # Удаляем запрос
                 friend_requests[user_id].remove(requestor_id)
                 if not friend_requests[user_id]:
                     del friend_requests[user_id]
                 
                 save_user_data()  # Сохраняем изменения
-                
-                requestor_name = requestor_info.get('first_name', 'Пользователь')
-                if requestor_info.get('username'):
-                    requestor_name += f" (@{requestor_info['username']})"
-                
-                await query.edit_message_text(
-                    f"❌ Запрос на дружбу от {requestor_name} отклонен.",
-                    reply_markup=get_walk_with_friends_menu()
-                )
-            else:
-                await query.edit_message_text(
-                    "❌ Запрос не найден или уже обработан.",
-                    reply_markup=get_walk_with_friends_menu()
-                )
+        
+        if request_found:
+            requestor_name = requestor_info.get('first_name', 'Пользователь')
+            if requestor_info.get('username'):
+                requestor_name += f" (@{requestor_info['username']})"
+            
+            await query.edit_message_text(
+                f"❌ Запрос на дружбу от {requestor_name} отклонен.",
+                reply_markup=get_walk_with_friends_menu()
+            )
+        elif requestor_info:
+            await query.edit_message_text(
+                "❌ Запрос не найден или уже обработан.",
+                reply_markup=get_walk_with_friends_menu()
+            )
         else:
             await query.edit_message_text(
                 "❌ Пользователь не найден.",
@@ -1593,7 +6248,9 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         # Текст сообщения
         message_text = f"Пойдем гуляять! Возьми вкусняшки! 🐕"
         
-        # Отправляем сообщение всем подтвержденным друзьям
+        # Отправляем сообщение всем подтвержденным друзьям. Обновление отмечается
+        # обработанным заранее: после перезапуска приглашения не уйдут второй раз
+        update_journal.commit(update)
         sent_count = 0
         failed_count = 0
         
@@ -1604,6 +6261,10 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                     friend_info = user_data.get(friend_id, {})
                     # Проверяем, что у друга подтвержден телефон
                     if friend_info.get('phone_verified', False):
+                        # Под нагрузкой рассылка идет медленнее, уступая место другим обновлениям
+                        if load_monitor.degraded and sent_count + failed_count:
+                            metrics.inc('bot_load_shed_total', feature='broadcast')
+                            await asyncio.sleep(load_monitor.broadcast_delay())
                         try:
                             await context.bot.send_message(
                                 chat_id=friend_id,
@@ -1611,7 +6272,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                             )
                             sent_count += 1
                         except Exception as e:
-                            logger.error(f"Ошибка при отправке приглашения другу {friend_id}: {e}")
+                            logger.error("Ошибка при отправке приглашения другу %s: %s", friend_id, e)
                             failed_count += 1
         
         # Формируем ответное сообщение
@@ -1642,6 +6303,147 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         )
         return ConversationHandler.END
     
+    elif callback_data == "friend_suggestions" or callback_data.startswith("friend_suggestions_"):
+        # Друзья друзей: счетчики общих друзей поддерживаются при изменениях графа
+        try:
+            page = int(callback_data[len("friend_suggestions_"):]) if callback_data != "friend_suggestions" else 0
+        except ValueError:
+            page = 0
+        suggestions = friend_suggestions.suggest(user_id, FRIEND_SUGGESTIONS_LIMIT)
+        back_keyboard = [[InlineKeyboardButton("Назад", callback_data="walk_with_friends")]]
+        if not suggestions:
+            await query.edit_message_text(
+                "🤝 Возможно, вы знакомы\n\n"
+                "Пока некого предложить. Здесь появятся друзья ваших друзей, "
+                "когда у вас будут друзья в боте.",
+                reply_markup=InlineKeyboardMarkup(back_keyboard)
+            )
+            return ConversationHandler.END
+        
+        pages = (len(suggestions) + FRIEND_SUGGESTIONS_PAGE_SIZE - 1) // FRIEND_SUGGESTIONS_PAGE_SIZE
+        page = min(max(page, 0), pages - 1)
+        first = page * FRIEND_SUGGESTIONS_PAGE_SIZE
+        lines = ["🤝 Возможно, вы знакомы", ""]
+        keyboard = []
+        for number, (candidate_id, mutual, distance) in enumerate(suggestions[first:first + FRIEND_SUGGESTIONS_PAGE_SIZE], first + 1):
+            candidate_info = user_data.get(candidate_id) or {}
+            display_name = candidate_info.get('first_name') or 'Пользователь'
+            if candidate_info.get('username'):
+                display_name += f" (@{candidate_info['username']})"
+            details = f"общих друзей: {mutual}"
+            if distance == 0:
+                details += ", гуляет там же"
+            elif distance is not None:
+                details += f", гуляет в {format_distance(distance)} от вас"
+            lines.append(f"{number}. {display_name} - {details}")
+            keyboard.append([InlineKeyboardButton(f"➕ {display_name}", callback_data=f"add_friend_{candidate_id}")])
+        navigation = []
+        if page > 0:
+            navigation.append(InlineKeyboardButton("◀️", callback_data=f"friend_suggestions_{page - 1}"))
+        if page + 1 < pages:
+            navigation.append(InlineKeyboardButton("▶️", callback_data=f"friend_suggestions_{page + 1}"))
+        if navigation:
+            keyboard.append(navigation)
+        keyboard += back_keyboard
+        await query.edit_message_text("\n".join(lines), reply_markup=InlineKeyboardMarkup(keyboard))
+        return ConversationHandler.END
+    
+    elif callback_data == "find_company" or callback_data.startswith("find_company_"):
+        # Кто гуляет рядом в те же часы: поиск по индексу, страницы по WALK_PARTNER_PAGE_SIZE
+        try:
+            page = int(callback_data[len("find_company_"):]) if callback_data != "find_company" else 0
+        except ValueError:
+            page = 0
+        user_info = user_data.get(user_id) or {}
+        back_keyboard = [[InlineKeyboardButton("Назад", callback_data="walk_with_friends")]]
+        if not user_info.get('walk_windows'):
+            await query.edit_message_text(
+                "👫 Найти компанию\n\n"
+                "Укажите, когда вы гуляете: Мой профиль → «🕒 Когда я гуляю». "
+                "Мы найдем тех, кто гуляет рядом с вами в те же часы.",
+                reply_markup=InlineKeyboardMarkup(back_keyboard)
+            )
+            return ConversationHandler.END
+        
+        matches = walk_partners.find(user_id, user_info)
+        if not matches:
+            if get_partner_profile(user_info) is None:
+                hint = "Укажите в профиле, где вы гуляете."
+            else:
+                hint = "Пока никто не гуляет рядом с вами в те же часы. Загляните позже!"
+            await query.edit_message_text(
+                f"👫 Найти компанию\n\n{hint}",
+                reply_markup=InlineKeyboardMarkup(back_keyboard)
+            )
+            return ConversationHandler.END
+        
+        pages = (len(matches) + WALK_PARTNER_PAGE_SIZE - 1) // WALK_PARTNER_PAGE_SIZE
+        page = min(max(page, 0), pages - 1)
+        first = page * WALK_PARTNER_PAGE_SIZE
+        lines = [
+            "👫 Найти компанию",
+            "",
+            f"Гуляют рядом в те же часы: {len(matches)}",
+            ""
+        ]
+        keyboard = []
+        for number, (other_id, minutes, distance) in enumerate(matches[first:first + WALK_PARTNER_PAGE_SIZE], first + 1):
+            other_info = user_data.get(other_id) or {}
+            display_name = other_info.get('first_name') or 'Пользователь'
+            if other_info.get('username'):
+                display_name += f" (@{other_info['username']})"
+            where = f"~{format_distance(distance)}" if distance is not None else "то же место"
+            lines.append(f"{number}. {display_name}")
+            lines.append(f"   🕒 {format_walk_windows(other_info.get('walk_windows') or [])}")
+            lines.append(f"   Вместе {format_duration(minutes * 60)} в неделю, {where}")
+            keyboard.append([InlineKeyboardButton(f"{number}. {display_name}", callback_data=f"select_user_{other_id}")])
+        navigation = []
+        if page > 0:
+            navigation.append(InlineKeyboardButton("◀️", callback_data=f"find_company_{page - 1}"))
+        if page + 1 < pages:
+            navigation.append(InlineKeyboardButton("▶️", callback_data=f"find_company_{page + 1}"))
+        if navigation:
+            keyboard.append(navigation)
+        keyboard += back_keyboard
+        await query.edit_message_text("\n".join(lines), reply_markup=InlineKeyboardMarkup(keyboard))
+        return ConversationHandler.END
+    
+    elif callback_data == "walk_now":
+        # Режим прогулки с живой геопозицией
+        walk = live_walks.get(user_id)
+        if walk:
+            minutes = int((time.time() - walk['started_at']) // 60)
+            text = (
+                f"🟢 Вы гуляете уже {minutes} мин.\n\n"
+                f"📏 Пройдено: {format_distance(walk['track'].distance)}\n"
+                f"Друзей встречено рядом: {len(walk['notified'])}\n\n"
+                f"Чтобы закончить прогулку, остановите трансляцию геопозиции в Telegram "
+                f"или нажмите кнопку ниже."
+            )
+            keyboard = [
+                [InlineKeyboardButton("⏹ Закончить прогулку", callback_data="walk_now_stop")],
+                [InlineKeyboardButton("Назад", callback_data="walk_with_friends")]
+            ]
+        else:
+            text = (
+                "🟢 Я гуляю сейчас\n\n"
+                "Включите трансляцию геопозиции в этом чате: 📎 → Геопозиция → "
+                "«Транслировать геопозицию».\n\n"
+                f"Пока идет трансляция, мы сообщим вам о друзьях, которые тоже гуляют "
+                f"в радиусе {LIVE_WALK_RADIUS_METERS:.0f} м, а им - о вас. О каждом друге - "
+                f"не больше одного раза за прогулку."
+            )
+            keyboard = [[InlineKeyboardButton("Назад", callback_data="walk_with_friends")]]
+        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+    
+    elif callback_data == "walk_now_stop":
+        walk = live_walks.stop_walk(user_id)
+        if walk:
+            text = format_walk_summary(walk['track']) + "\n\nНе забудьте остановить трансляцию геопозиции в Telegram."
+        else:
+            text = "Сейчас вы не гуляете."
+        await query.edit_message_text(text, reply_markup=get_walk_with_friends_menu())
+    
     elif callback_data == "share_my_location":
         # Поделиться своим местоположением
         if user_id not in user_data:
@@ -1705,6 +6507,23 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         )
         return ConversationHandler.END
     
+    elif callback_data == "admin_profile":
+        # Проверяем, является ли пользователь администратором
+        if not ADMIN_ID or str(user_id) != str(ADMIN_ID):
+            await query.answer("У вас нет доступа к этой функции", show_alert=True)
+            return ConversationHandler.END
+        
+        if not start_profiling_session(context.application, query.message.chat_id, PROFILE_DURATION_SECONDS):
+            await query.answer("Профилирование уже запущено", show_alert=True)
+            return ConversationHandler.END
+        
+        await query.edit_message_text(
+            f"🔬 Профилирование запущено на {PROFILE_DURATION_SECONDS:.0f} с.\n\n"
+            "Отчет придет отдельным файлом.",
+            reply_markup=get_admin_menu()
+        )
+        return ConversationHandler.END
+    
     elif callback_data == "admin_list_subscribers":
         # Проверяем, является ли пользователь администратором
         if not ADMIN_ID or str(user_id) != str(ADMIN_ID):
@@ -1811,27 +6630,29 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             await query.answer("Ошибка: некорректный формат данных", show_alert=True)
             return ConversationHandler.END
         
-        if subscriber_id in user_data:
-            subscriber_info = user_data[subscriber_id]
-            display_name = subscriber_info.get('first_name', 'Пользователь') or 'Пользователь'
-            
-            # Удаляем пользователя из user_data
-            del user_data[subscriber_id]
-            
-            # Удаляем из friend_requests, если есть
-            if subscriber_id in friend_requests:
-                del friend_requests[subscriber_id]
-            
-            # Удаляем из списков друзей других пользователей
-            for uid, user_info in user_data.items():
-                if 'friends' in user_info:
-                    user_info['friends'] = [
-                        f for f in user_info['friends']
-                        if isinstance(f, dict) and f.get('user_id') != subscriber_id
-                    ]
-            
-            save_user_data()
-            
+        # delete_user_records меняет списки друзей всех, у кого подписчик в друзьях, поэтому
+        # блокируются и они. Новая дружба с подписчиком требует и его блокировки: если
+        # пока блокировки захватывались, такие пользователи добавились, захватываем заново
+        # Кто дружит с подписчиком, берется из обратного индекса, база не просматривается
+        affected = friend_followers.followers(subscriber_id)
+        while True:
+            async with state_locks.hold(subscriber_id, *affected):
+                current = friend_followers.followers(subscriber_id)
+                if not current <= affected:
+                    affected |= current
+                    continue
+                subscriber_info = delete_user_records(user_data, friend_requests, subscriber_id, affected)
+                if subscriber_info:
+                    display_name = subscriber_info.get('first_name', 'Пользователь') or 'Пользователь'
+                    save_user_data()
+                    walk_partners.update(subscriber_id, None)
+                    friend_suggestions.user_removed(subscriber_id)
+                    friend_followers.update(subscriber_id, None)
+                    for follower_id in affected:
+                        friend_followers.update(follower_id, user_data.get(follower_id))
+            break
+        
+        if subscriber_info:
             await query.edit_message_text(
                 f"✅ Контакт {display_name} удален из базы данных.",
                 reply_markup=get_admin_menu()
@@ -1954,7 +6775,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             subscriber_id = int(parts[4])
             tag = "_".join(parts[5:])  # На случай, если в метке есть подчеркивания
         except (ValueError, IndexError) as e:
-            logger.error(f"Ошибка при парсинге admin_remove_tag_confirm: {e}")
+            logger.error("Ошибка при парсинге admin_remove_tag_confirm: %s", e)
             await query.edit_message_text(
                 "❌ Ошибка: некорректный формат данных.",
                 reply_markup=get_admin_menu()
@@ -1963,13 +6784,16 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         
         subscriber_info = user_data.get(subscriber_id)
         if subscriber_info:
-            if 'tags' not in subscriber_info:
-                subscriber_info['tags'] = []
-            
-            if tag in subscriber_info['tags']:
-                subscriber_info['tags'].remove(tag)
-                save_user_data()
+            async with state_locks.hold(subscriber_id):
+                if 'tags' not in subscriber_info:
+                    subscriber_info['tags'] = []
                 
+                tag_removed = tag in subscriber_info['tags']
+                if tag_removed:
+                    subscriber_info['tags'].remove(tag)
+                    save_user_data()
+            
+            if tag_removed:
                 await query.edit_message_text(
                     f"✅ Метка '{tag}' удалена.",
                     reply_markup=get_subscriber_management_menu(subscriber_id)
@@ -2007,19 +6831,21 @@ async def handle_location_message(update: Update, context: ContextTypes.DEFAULT_
         latitude = location.latitude
         longitude = location.longitude
         
-        # Сохраняем координаты
-        user_data[user_id]['walking_location_lat'] = latitude
-        user_data[user_id]['walking_location_lon'] = longitude
-        
         # Формируем ссылку на Яндекс карты с координатами
         import urllib.parse
         yandex_map_url = f"https://yandex.ru/maps/?pt={longitude},{latitude}&z=15&l=map"
         
         # Формируем текст для сохранения (можно использовать координаты или адрес)
         location_text = f"Координаты: {latitude:.6f}, {longitude:.6f}"
-        user_data[user_id]['walking_location'] = location_text
         
-        save_user_data()  # Сохраняем изменения
+        async with state_locks.hold(user_id):
+            if user_id in user_data:
+                # Сохраняем координаты
+                user_data[user_id]['walking_location_lat'] = latitude
+                user_data[user_id]['walking_location_lon'] = longitude
+                user_data[user_id]['walking_location'] = location_text
+                save_user_data()  # Сохраняем изменения
+                walk_partners.update(user_id, user_data[user_id])
         
         # Убираем клавиатуру с кнопкой местоположения
         await update.message.reply_text(
@@ -2043,10 +6869,13 @@ async def handle_location_message(update: Update, context: ContextTypes.DEFAULT_
         # Пользователь ввел текст вручную
         location_text = update.message.text
         
-        user_data[user_id]['walking_location'] = location_text
-        user_data[user_id]['walking_location_lat'] = None
-        user_data[user_id]['walking_location_lon'] = None
-        save_user_data()  # Сохраняем изменения
+        async with state_locks.hold(user_id):
+            if user_id in user_data:
+                user_data[user_id]['walking_location'] = location_text
+                user_data[user_id]['walking_location_lat'] = None
+                user_data[user_id]['walking_location_lon'] = None
+                save_user_data()  # Сохраняем изменения
+                walk_partners.update(user_id, user_data[user_id])
         
         # Формируем ссылку на Яндекс карты с текстовым поиском
         import urllib.parse
@@ -2073,119 +6902,215 @@ async def handle_location_message(update: Update, context: ContextTypes.DEFAULT_
     return ConversationHandler.END
 
 
-async def handle_friend_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Обработка имени друга для отправки сообщения"""
+async def handle_walk_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Обработка расписания прогулок ("будни 7:00-8:00, 20:00-21:00")"""
     user_id = update.message.from_user.id
-    friend_name = update.message.text
+    text = update.message.text.strip()
+    back_keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("Назад в профиль", callback_data="profile")]])
     
-    # В реальном проекте здесь была бы отправка сообщения другу
-    # Пока просто подтверждаем
-    await update.message.reply_text(
-        f"✅ Сообщение отправлено другу: {friend_name}\n\n"
-        "В реальной версии здесь будет отправка сообщения.",
-        reply_markup=get_walk_with_friends_menu()
-    )
+    if text.casefold() in ('нет', '-', 'удалить'):
+        walk_windows = []
+    else:
+        walk_windows = parse_walk_windows(text)
+        if walk_windows is None or len(walk_windows) > WALK_WINDOWS_MAX:
+            await update.message.reply_text(
+                "❌ Не удалось разобрать расписание. Напишите, например: «будни 7:00-8:00, 20:00-21:00» "
+                f"или «выходные 10-12» (не больше {WALK_WINDOWS_MAX} прогулок в неделю).",
+                reply_markup=back_keyboard
+            )
+            return WAITING_WALK_SCHEDULE
+    
+    async with state_locks.hold(user_id):
+        if user_id not in user_data:
+            await update.message.reply_text("Сначала нажмите /start.")
+            return ConversationHandler.END
+        user_data[user_id]['walk_windows'] = walk_windows
+        save_user_data()
+        walk_partners.update(user_id, user_data[user_id])
     
+    if walk_windows:
+        text = f"✅ Расписание сохранено: {format_walk_windows(walk_windows)}"
+    else:
+        text = "✅ Расписание прогулок удалено."
+    await update.message.reply_text(text, reply_markup=back_keyboard)
     return ConversationHandler.END
 
 
-async def handle_search_username(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Обработка поиска пользователя по username, имени или номеру телефона"""
+async def handle_walk_time(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Обработка времени запланированной прогулки: создание прогулки и рассылка приглашений"""
     user_id = update.message.from_user.id
-    search_query = update.message.text.strip()
+    selected_place = context.user_data.get('selected_place')
+    selected_place_full = context.user_data.get('selected_place_full')
+    if not selected_place or not selected_place_full or user_id not in user_data:
+        await update.message.reply_text("Ошибка: место не выбрано", reply_markup=get_walk_with_friends_menu())
+        return ConversationHandler.END
     
-    # Определяем тип поиска: телефон или текст
-    # Убираем все нецифровые символы для проверки на телефон
-    phone_digits = ''.join(filter(str.isdigit, search_query))
-    is_phone_search = len(phone_digits) >= 7  # Минимум 7 цифр для номера телефона
+    starts_at = parse_walk_time(update.message.text)
+    if starts_at is None:
+        await update.message.reply_text(
+            "❌ Не удалось понять время. Напишите, например: «сегодня 19:30», «завтра 8:00» или «25.10 18:30». "
+            f"Прогулку можно назначить не больше чем на {WALK_PLAN_MAX_DAYS} дней вперед."
+        )
+        return WAITING_WALK_TIME
     
-    # Убираем @ если есть (для username)
-    if search_query.startswith('@'):
-        search_query = search_query[1:]
+    # Приглашения получают подтвержденные друзья, как и в "Позвать гулять"
+    invitees = []
+    for friend_id in get_friend_ids(user_data[user_id]):
+        if (user_data.get(friend_id) or {}).get('phone_verified', False):
+            invitees.append(friend_id)
+    if not invitees:
+        await update.message.reply_text(
+            "📅 Назначить прогулку\n\n"
+            "У вас нет друзей с подтвержденным номером телефона.\n\n"
+            "Добавьте друзей и попросите их подтвердить свой номер телефона.",
+            reply_markup=get_walk_with_friends_menu()
+        )
+        return ConversationHandler.END
     
-    # Нормализуем номер телефона для поиска (убираем + и пробелы)
-    normalized_search_phone = None
-    if is_phone_search:
-        # Убираем + в начале если есть
-        normalized_search_phone = phone_digits
-        if normalized_search_phone.startswith('7') and len(normalized_search_phone) == 11:
-            # Российский номер, оставляем как есть
-            pass
-        elif normalized_search_phone.startswith('8') and len(normalized_search_phone) == 11:
-            # Заменяем 8 на 7 для российских номеров
-            normalized_search_phone = '7' + normalized_search_phone[1:]
+    place_info = await get_place_info(
+        context.user_data.get('selected_region'), context.user_data.get('selected_district'), selected_place,
+        place_catalogs.for_user(context.user_data)
+    )
+    walk_id = walk_planner.create(
+        user_id, starts_at.timestamp(), selected_place, selected_place_full, place_info.get('yandex_map_url'), invitees
+    )
+    walk = walk_planner.get(walk_id)
+    answers = walk_planner.answers(walk_id)
+    logger.info("Пользователь %s назначил прогулку %s на %s, приглашено: %s", user_id, walk_id, starts_at, len(invitees))
     
-    search_lower = search_query.lower()
+    organizer_name = update.message.from_user.first_name or 'Друг'
+    if update.message.from_user.username:
+        organizer_name += f" (@{update.message.from_user.username})"
+    text = (
+        f"📢 {organizer_name} зовет гулять {format_walk_time(walk['starts_at'])}!\n\n"
+        f"{format_planned_walk(walk, answers)}"
+    )
     
-    # Логируем для отладки
-    logger.info(f"Поиск пользователя '{search_query}' от {user_id}. Всего пользователей в базе: {len(user_data)}")
+    # Приглашения не уйдут второй раз после перезапуска
+    update_journal.commit(update)
+    sent_count = 0
+    for friend_id in invitees:
+        if load_monitor.degraded and sent_count:
+            metrics.inc('bot_load_shed_total', feature='broadcast')
+            await asyncio.sleep(load_monitor.broadcast_delay())
+        try:
+            await context.bot.send_message(
+                chat_id=friend_id,
+                text=text,
+                reply_markup=get_planned_walk_keyboard(walk, friend_id, back=False)
+            )
+            sent_count += 1
+        except Exception as e:
+            logger.error("Ошибка при отправке приглашения на прогулку другу %s: %s", friend_id, e)
     
-    # Поиск пользователей
-    found_users = []
-    for uid, user_info in user_data.items():
-        # Не показываем самого пользователя в результатах
-        if uid == user_id:
-            continue
-        
-        # Пропускаем пользователей без базовой информации
-        if not user_info.get('first_name') and not user_info.get('username'):
-            continue
-        
-        match_found = False
-        
-        # Поиск по номеру телефона
-        if is_phone_search and normalized_search_phone:
-            user_phone = user_info.get('phone_number', '')
-            if user_phone:
-                # Нормализуем номер пользователя
-                user_phone_digits = ''.join(filter(str.isdigit, user_phone))
-                if user_phone_digits:
-                    # Проверяем совпадение (полное или частичное)
-                    if normalized_search_phone in user_phone_digits or user_phone_digits in normalized_search_phone:
-                        match_found = True
-                        # Показываем только последние 4 цифры для приватности
-                        phone_display = f"***{user_phone_digits[-4:]}" if len(user_phone_digits) >= 4 else "***"
-        
-        # Поиск по username
-        if not match_found:
-            username = user_info.get('username', '').lower() if user_info.get('username') else ''
-            if username and search_lower in username:
-                match_found = True
-        
-        # Поиск по имени
-        if not match_found:
-            first_name = user_info.get('first_name', '').lower() if user_info.get('first_name') else ''
-            if first_name and search_lower in first_name:
-                match_found = True
-        
-        # Поиск по фамилии
-        if not match_found:
-            last_name = user_info.get('last_name', '').lower() if user_info.get('last_name') else ''
-            if last_name and search_lower in last_name:
-                match_found = True
-        
-        # Поиск по полному имени (имя + фамилия)
-        if not match_found:
-            full_name = f"{user_info.get('first_name', '')} {user_info.get('last_name', '')}".strip().lower()
-            if full_name and search_lower in full_name:
-                match_found = True
-        
-        if match_found:
-            found_users.append({
-                'user_id': uid,
-                'username': user_info.get('username'),
-                'first_name': user_info.get('first_name'),
-                'last_name': user_info.get('last_name'),
-                'phone_number': user_info.get('phone_number'),
-                'phone_verified': user_info.get('phone_verified', False)
-            })
+    reminders = ", ".join(f"{minutes} мин" for minutes in walk_planner.reminder_minutes)
+    await update.message.reply_text(
+        f"✅ Прогулка назначена {format_walk_time(walk['starts_at'])}!\n\n"
+        f"🌳 {selected_place}\n"
+        f"📤 Приглашения отправлены: {sent_count} из {len(invitees)}\n"
+        f"⏰ Напомним за {reminders} до начала.",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("📅 Открыть прогулку", callback_data=f"walk_view_{walk_id}")],
+            [InlineKeyboardButton("Назад", callback_data="walk_with_friends")]
+        ])
+    )
+    return ConversationHandler.END
+
+
+class LiveLocationFilter(filters.MessageFilter):
+    """Сообщение с живой геопозицией (трансляцией)"""
+    
+    def filter(self, message):
+        return bool(message.location and message.location.live_period)
+
+
+def find_conversation(application, name):
+    """ConversationHandler с именем name среди обработчиков приложения"""
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            if isinstance(handler, ConversationHandler) and handler.name == name:
+                return handler
+    return None
+
+
+async def handle_live_location(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Живая геопозиция и остальные правки сообщений (группа -2, раньше ограничителя частоты)
+    
+    Новые позиции приходят правками сообщения каждые несколько секунд и только
+    запоминаются в live_walks. Правка без live_period означает, что пользователь
+    остановил трансляцию. Правки текста бот не обрабатывает. Трансляцию, которую
+    пользователь прислал в ответ на вопрос диалога (WAITING_LOCATION_COORDS), трекер
+    не забирает - она уходит диалогу.
+    """
+    message = update.effective_message
+    if update.edited_message is None:
+        conversation = find_conversation(context.application, "main_conversation")
+        if conversation is not None and conversation.check_update(update) is not None:
+            return
+    location = message.location
+    if location is not None and message.from_user is not None:
+        user_id = message.from_user.id
+        if location.live_period:
+            expires_at = message.date.timestamp() + location.live_period
+            started = live_walks.update(user_id, message.message_id, location.latitude, location.longitude, expires_at)
+            if started and update.edited_message is None:
+                await message.reply_text(
+                    "🟢 Прогулка началась!\n\n"
+                    f"Пока идет трансляция, мы сообщим вам о друзьях, которые тоже гуляют в радиусе "
+                    f"{LIVE_WALK_RADIUS_METERS:.0f} м, а им - о вас.\n\n"
+                    "Чтобы закончить, остановите трансляцию геопозиции."
+                )
+        elif update.edited_message is not None:
+            walk = live_walks.finish(user_id)
+            if walk:
+                await message.reply_text(format_walk_summary(walk['track']))
+    raise ApplicationHandlerStop
+
+
+async def handle_friend_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Обработка имени друга для отправки сообщения"""
+    user_id = update.message.from_user.id
+    friend_name = update.message.text
+    
+    # В реальном проекте здесь была бы отправка сообщения другу
+    # Пока просто подтверждаем
+    await update.message.reply_text(
+        f"✅ Сообщение отправлено другу: {friend_name}\n\n"
+        "В реальной версии здесь будет отправка сообщения.",
+        reply_markup=get_walk_with_friends_menu()
+    )
+    
+    return ConversationHandler.END
+
+
+async def handle_search_username(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Обработка поиска пользователя по username, имени или номеру телефона"""
+    user_id = update.message.from_user.id
+    search_query = update.message.text.strip()
+    
+    # Поиск проходит по всей базе, поэтому стоит дороже обычного сообщения
+    if not rate_limiter.consume(user_id, RATE_LIMIT_SEARCH_COST):
+        await update.message.reply_text(
+            "⏳ Слишком много запросов поиска. Подождите несколько секунд и попробуйте снова."
+        )
+        return WAITING_SEARCH_USERNAME
+    
+    search_query, normalized_search_phone = parse_search_query(search_query)
+    is_phone_search = normalized_search_phone is not None
+    
+    # Логируем для отладки (событие на каждый поиск: уровень DEBUG, в лог попадает выборочно)
+    logger.debug("Поиск пользователя '%s' от %s", search_query, user_id)
+    
+    users = await scan_records(user_data)
+    found_users = find_matching_users(users, search_query, normalized_search_phone, user_id)
     
     if not found_users:
         search_type = "номеру телефона" if is_phone_search else "запросу"
         
         # Показываем список всех пользователей для отладки (можно убрать в продакшене)
         all_users_info = []
-        for uid, user_info in user_data.items():
+        for uid, user_info in users.items():
             if uid != user_id:
                 name = user_info.get('first_name', 'Без имени')
                 username = user_info.get('username', 'нет username')
@@ -2286,22 +7211,7 @@ async def handle_location_choice(update: Update, context: ContextTypes.DEFAULT_T
             selected_location = locations[choice - 1]
             
             # Ищем пользователей, которые указали эту локацию в своем профиле
-            users_in_location = []
-            for uid, user_info in user_data.items():
-                # Пропускаем самого пользователя
-                if uid == user_id:
-                    continue
-                
-                # Получаем локацию пользователя
-                user_location = user_info.get('walking_location', '')
-                if user_location and selected_location.lower() in user_location.lower():
-                    users_in_location.append({
-                        'user_id': uid,
-                        'first_name': user_info.get('first_name', 'Пользователь'),
-                        'last_name': user_info.get('last_name', ''),
-                        'username': user_info.get('username', ''),
-                        'walking_location': user_location
-                    })
+            users_in_location = find_users_in_location(await scan_records(user_data), selected_location, user_id)
             
             if not users_in_location:
                 await update.message.reply_text(
@@ -2365,36 +7275,34 @@ async def handle_contact(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         if phone_number.startswith('+'):
             phone_number = phone_number[1:]
         
-        # Инициализируем данные пользователя, если их еще нет
-        if user_id not in user_data:
-            user_data[user_id] = {
-                'walking_location': None,
-                'pet_photo_id': None,
-                'friends': [],
-                'phone_number': None,
-                'phone_verified': False
-            }
+        async with state_locks.hold(user_id):
+            # Инициализируем данные пользователя, если их еще нет
+            if user_id not in user_data:
+                user_data[user_id] = {
+                    'walking_location': None,
+                    'pet_photo_id': None,
+                    'friends': [],
+                    'phone_number': None,
+                    'phone_verified': False
+                }
+            
+            # Сохраняем номер телефона
+            user_data[user_id]['phone_number'] = phone_number
+            
+            # Генерируем код верификации
+            verification_code = str(random.randint(1000, 9999))
+            code_issued = verification_codes.issue(user_id, verification_code, phone_number)
         
-        # Сохраняем номер телефона
-        user_data[user_id]['phone_number'] = phone_number
+        if not code_issued:
+            logger.warning("Хранилище кодов подтверждения переполнено, код для %s не выдан", user_id)
+            await update.message.reply_text(
+                "⏳ Сейчас слишком много запросов на подтверждение. Попробуйте через несколько минут.",
+                reply_markup=ReplyKeyboardRemove()
+            )
+            return
         
         # Ищем совпадения в базе данных (проверяем других пользователей с таким же номером)
-        matching_users = []
-        for uid, user_info in user_data.items():
-            if uid != user_id and user_info.get('phone_number') == phone_number:
-                matching_users.append({
-                    'user_id': uid,
-                    'name': user_info.get('first_name', 'Пользователь'),
-                    'username': user_info.get('username')
-                })
-        
-        # Генерируем код верификации
-        verification_code = str(random.randint(1000, 9999))
-        verification_codes[user_id] = {
-            'code': verification_code,
-            'phone': phone_number,
-            'timestamp': time.time()
-        }
+        matching_users = find_users_with_phone(await scan_records(user_data), phone_number, user_id)
         
         # Удаляем клавиатуру с кнопкой - отвечаем на сообщение с контактом с ReplyKeyboardRemove
         # Это уберет клавиатуру из чата
@@ -2409,7 +7317,7 @@ async def handle_contact(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             except Exception:
                 pass  # Игнорируем ошибку удаления, главное что клавиатура убрана
         except Exception as e:
-            logger.error(f"Ошибка при удалении клавиатуры: {e}")
+            logger.error("Ошибка при удалении клавиатуры: %s", e)
             # Пытаемся альтернативным способом
             try:
                 await context.bot.send_message(
@@ -2464,22 +7372,15 @@ async def handle_verification_code(update: Update, context: ContextTypes.DEFAULT
     entered_code = update.message.text.strip()
     
     # Проверяем код верификации
-    if user_id in verification_codes:
-        stored_code = verification_codes[user_id]['code']
-        timestamp = verification_codes[user_id]['timestamp']
-        
-        # Проверяем, не истек ли код (5 минут)
-        if time.time() - timestamp > 300:
-            await update.message.reply_text(
-                "❌ Код подтверждения истек. Пожалуйста, поделитесь контактом заново.\n\n"
-                "Или вернитесь в главное меню:",
-                reply_markup=get_main_menu(user_id)
-            )
-            del verification_codes[user_id]
-            context.user_data.pop('waiting_verification', None)
-            return ConversationHandler.END
-        
-        if entered_code == stored_code:
+    async with state_locks.hold(user_id):
+        verification = verification_codes.get(user_id)
+        if verification is None:
+            status = 'not_found'
+        elif time.time() >= verification['expires_at']:
+            # Код истек (5 минут)
+            verification_codes.remove(user_id)
+            status = 'expired'
+        elif entered_code == verification['code']:
             # Код верный - подтверждаем номер
             # Инициализируем данные пользователя, если их еще нет
             if user_id not in user_data:
@@ -2492,25 +7393,44 @@ async def handle_verification_code(update: Update, context: ContextTypes.DEFAULT
                 }
             
             user_data[user_id]['phone_verified'] = True
-            phone_number = verification_codes[user_id]['phone']
+            phone_number = verification['phone']
             user_data[user_id]['phone_number'] = phone_number
             save_user_data()
             
             # Удаляем код из временного хранилища
-            del verification_codes[user_id]
-            context.user_data.pop('waiting_verification', None)
-            
-            await update.message.reply_text(
-                f"✅ Номер телефона подтвержден!\n\n"
-                f"📱 Ваш номер: +{phone_number}\n\n"
-                f"Теперь вы можете использовать все функции бота.",
-                reply_markup=get_main_menu(user_id)
-            )
+            verification_codes.remove(user_id)
+            status = 'verified'
         else:
-            await update.message.reply_text(
-                "❌ Неверный код подтверждения. Попробуйте еще раз:"
-            )
-            return WAITING_VERIFICATION_CODE
+            attempts_left = verification_codes.register_failed_attempt(user_id)
+            status = 'wrong' if attempts_left else 'attempts_exceeded'
+    
+    if status == 'expired':
+        context.user_data.pop('waiting_verification', None)
+        await update.message.reply_text(
+            "❌ Код подтверждения истек. Пожалуйста, поделитесь контактом заново.\n\n"
+            "Или вернитесь в главное меню:",
+            reply_markup=get_main_menu(user_id)
+        )
+    elif status == 'verified':
+        context.user_data.pop('waiting_verification', None)
+        await update.message.reply_text(
+            f"✅ Номер телефона подтвержден!\n\n"
+            f"📱 Ваш номер: +{phone_number}\n\n"
+            f"Теперь вы можете использовать все функции бота.",
+            reply_markup=get_main_menu(user_id)
+        )
+    elif status == 'wrong':
+        await update.message.reply_text(
+            f"❌ Неверный код подтверждения. Осталось попыток: {attempts_left}. Попробуйте еще раз:"
+        )
+        return WAITING_VERIFICATION_CODE
+    elif status == 'attempts_exceeded':
+        context.user_data.pop('waiting_verification', None)
+        await update.message.reply_text(
+            "❌ Превышено число попыток ввода кода. Пожалуйста, поделитесь контактом заново.\n\n"
+            "Или вернитесь в главное меню:",
+            reply_markup=get_main_menu(user_id)
+        )
     else:
         await update.message.reply_text(
             "❌ Код подтверждения не найден. Пожалуйста, поделитесь контактом заново.\n\n"
@@ -2544,11 +7464,13 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     if update.message.photo:
         # Сохраняем file_id последнего (самого большого) фото
         photo = update.message.photo[-1]
-        user_data[user_id]['pet_photo_id'] = photo.file_id
-        save_user_data()  # Сохраняем изменения
+        async with state_locks.hold(user_id):
+            if user_id in user_data:
+                user_data[user_id]['pet_photo_id'] = photo.file_id
+                save_user_data()  # Сохраняем изменения
         
         # Показываем обновленный профиль
-        walking_location = user_data[user_id].get('walking_location', 'не указано')
+        walking_location = user_data.get(user_id, {}).get('walking_location', 'не указано')
         pet_photo_status = "загружено"
         
         text = (
@@ -2585,13 +7507,16 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
             
             if subscriber_id in user_data:
                 subscriber_info = user_data[subscriber_id]
-                if 'tags' not in subscriber_info:
-                    subscriber_info['tags'] = []
-                
-                if tag and tag not in subscriber_info['tags']:
-                    subscriber_info['tags'].append(tag)
-                    save_user_data()
+                async with state_locks.hold(subscriber_id):
+                    if 'tags' not in subscriber_info:
+                        subscriber_info['tags'] = []
                     
+                    tag_added = bool(tag) and tag not in subscriber_info['tags']
+                    if tag_added:
+                        subscriber_info['tags'].append(tag)
+                        save_user_data()
+                
+                if tag_added:
                     display_name = subscriber_info.get('first_name', 'Пользователь') or 'Пользователь'
                     await update.message.reply_text(
                         f"✅ Метка '{tag}' добавлена пользователю {display_name}.",
@@ -2630,6 +7555,7 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
             
             try:
                 # Отправляем сообщение получателю
+                update_journal.commit(update)
                 await context.bot.send_message(
                     chat_id=target_user_id,
                     text=f"✉️ Сообщение от {sender_name}:\n\n{message_text}"
@@ -2640,9 +7566,9 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
                     f"✅ Сообщение отправлено пользователю {target_display_name}!",
                     reply_markup=get_walk_with_friends_menu()
                 )
-                logger.info(f"Пользователь {user_id} отправил сообщение {target_user_id}")
+                logger.info("Пользователь %s отправил сообщение %s", user_id, target_user_id)
             except Exception as e:
-                logger.error(f"Ошибка при отправке сообщения: {e}")
+                logger.error("Ошибка при отправке сообщения: %s", e)
                 await update.message.reply_text(
                     f"❌ Не удалось отправить сообщение. Возможно, пользователь заблокировал бота или удалил аккаунт.",
                     reply_markup=get_walk_with_friends_menu()
@@ -2668,6 +7594,7 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
             if target_user:
                 try:
                     # Отправляем сообщение получателю
+                    update_journal.commit(update)
                     await context.bot.send_message(
                         chat_id=target_user_id,
                         text=f"📩 Сообщение от администратора:\n\n{message_text}"
@@ -2678,9 +7605,9 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
                         f"✅ Сообщение отправлено подписчику {target_display_name}!",
                         reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Назад к профилю", callback_data=f"admin_view_subscriber_{target_user_id}")]])
                     )
-                    logger.info(f"Администратор {user_id} отправил сообщение подписчику {target_user_id}")
+                    logger.info("Администратор %s отправил сообщение подписчику %s", user_id, target_user_id)
                 except Exception as e:
-                    logger.error(f"Ошибка при отправке сообщения администратора: {e}")
+                    logger.error("Ошибка при отправке сообщения администратора: %s", e)
                     await update.message.reply_text(
                         f"❌ Не удалось отправить сообщение. Возможно, подписчик заблокировал бота или удалил аккаунт.",
                         reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Назад к профилю", callback_data=f"admin_view_subscriber_{target_user_id}")]])
@@ -2702,91 +7629,670 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
     )
 
 
+async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Inline-режим: места для прогулок по запросу "@bot парк горь", которыми можно поделиться в любом чате"""
+    query = update.inline_query
+    catalog = place_catalogs.current
+    numbers = catalog.search_index.search(query.query)
+    
+    # Следующие страницы Telegram запрашивает с offset из next_offset прошлого ответа
+    try:
+        offset = max(0, int(query.offset or 0))
+    except ValueError:
+        offset = 0
+    page = numbers[offset:offset + INLINE_PAGE_SIZE]
+    next_offset = str(offset + INLINE_PAGE_SIZE) if offset + INLINE_PAGE_SIZE < len(numbers) else ''
+    
+    # Ответ не зависит от пользователя: Telegram может отдавать его из своего кеша всем
+    await query.answer(
+        [get_inline_place_result(catalog, number) for number in page],
+        cache_time=INLINE_CACHE_TIME,
+        is_personal=False,
+        next_offset=next_offset
+    )
+
+
+def format_latency_line(title, histogram):
+    """Строка отчета /stats: число вызовов и квантили задержки в миллисекундах"""
+    p50, p95, p99 = (histogram.quantile(q) * 1000 for q in (0.5, 0.95, 0.99))
+    return f"{title}: {histogram.count} шт., p50 {p50:.0f} мс, p95 {p95:.0f} мс, p99 {p99:.0f} мс"
+
+
+async def reload_places_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Команда /reload_places (только для администратора): перечитать PLACES_FILE без перезапуска"""
+    user_id = update.effective_user.id
+    if not ADMIN_ID or str(user_id) != str(ADMIN_ID):
+        return
+    
+    started = time.perf_counter()
+    try:
+        changed = await place_catalogs.reload()
+    except (OSError, ValueError) as e:
+        await update.message.reply_text(
+            f"❌ Каталог мест не загружен: {e}\n\n"
+            f"Остается версия {place_catalogs.current.version}."
+        )
+        return
+    
+    catalog = place_catalogs.current
+    await update.message.reply_text(
+        f"{'✅ Каталог мест обновлен' if changed else 'Каталог мест не изменился'}\n\n"
+        f"Версия: {catalog.version}\n"
+        f"Регионов: {len(catalog.regions)}, районов: {catalog.district_count}, мест: {catalog.place_count}\n"
+        f"Загрузка: {(time.perf_counter() - started) * 1000:.0f} мс"
+    )
+
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Команда /stats (только для администратора): сводка задержек по маршрутам"""
+    user_id = update.effective_user.id
+    if not ADMIN_ID or str(user_id) != str(ADMIN_ID):
+        return
+    
+    handlers = []
+    outbound = []
+    other = []
+    for (name, labels), histogram in metrics.histograms.items():
+        labels = dict(labels)
+        if name == 'bot_handler_duration_seconds':
+            handlers.append((histogram, f"{labels['handler']} / {labels['route']}"))
+        elif name == 'bot_telegram_request_duration_seconds':
+            outbound.append((histogram, labels['method']))
+        else:
+            other.append((histogram, name.removeprefix('bot_').removesuffix('_duration_seconds')))
+    
+    lines = ["📊 Статистика с момента запуска", ""]
+    for title, section in (("Обработчики", handlers), ("Запросы к Telegram", outbound), ("Прочее", other)):
+        if not section:
+            continue
+        lines.append(f"{title}:")
+        # Сортируем по суммарному времени - сверху самые нагруженные маршруты
+        section.sort(key=lambda item: item[0].sum, reverse=True)
+        lines.extend(format_latency_line(label, histogram) for histogram, label in section[:15])
+        lines.append("")
+    
+    errors = sum(value for (name, _), value in metrics.counters.items() if name.endswith('_errors_total'))
+    lines.append(f"Ошибок: {errors}")
+    lines.append(f"Активных сессий: {session_sweeper.live_sessions}, ограничено запросов: {rate_limiter.throttled_total}")
+    
+    text = "\n".join(lines)
+    await update.message.reply_text(text[:4096])
+
+
+HTTP_STATUS_TEXT = {
+    200: 'OK',
+    400: 'Bad Request',
+    403: 'Forbidden',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    413: 'Payload Too Large'
+}
+
+
+async def read_http_request(reader):
+    """
+    Читает один HTTP/1.1 запрос из потока
+    
+    Returns:
+        tuple: (method, path, headers, body) или None, если соединение закрыто
+    """
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    
+    try:
+        method, target, _ = request_line.decode('latin-1').split(' ', 2)
+    except ValueError:
+        return None
+    
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    
+    try:
+        content_length = int(headers.get('content-length') or 0)
+    except ValueError:
+        content_length = 0
+    if content_length > WEBHOOK_MAX_BODY_SIZE:
+        return method.upper(), target, headers, None
+    
+    body = await reader.readexactly(content_length) if content_length else b''
+    return method.upper(), target.split('?', 1)[0], headers, body
+
+
+async def write_http_response(writer, status, body=b'', content_type='text/plain; charset=utf-8', keep_alive=True):
+    """Отправляет HTTP-ответ в поток"""
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    head = (
+        f"HTTP/1.1 {status} {HTTP_STATUS_TEXT.get(status, 'OK')}\r\n"
+        f"Content-Type: {content_type}\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+        "\r\n"
+    )
+    writer.write(head.encode('latin-1') + body)
+    await writer.drain()
+
+
+async def handle_webhook_request(bot, update_queue, method, path, headers, body):
+    """Обрабатывает запрос к вебхуку и ставит обновление в очередь. Возвращает HTTP-статус"""
+    if path == '/healthz':
+        return 200
+    if path != WEBHOOK_PATH:
+        return 404
+    if method != 'POST':
+        return 405
+    if body is None:
+        return 413
+    
+    if WEBHOOK_SECRET_TOKEN:
+        received_token = headers.get('x-telegram-bot-api-secret-token', '')
+        if not hmac.compare_digest(received_token.encode('utf-8'), WEBHOOK_SECRET_TOKEN.encode('utf-8')):
+            logger.warning("Запрос к вебхуку с неверным секретным токеном отклонен")
+            return 403
+    
+    try:
+        update = Update.de_json(json.loads(body), bot)
+    except Exception as e:
+        logger.warning("Некорректное обновление в вебхуке: %s", e)
+        return 400
+    
+    await update_queue.put(update)
+    # Ответ 200 подтверждает получение обновления, поэтому сначала оно записывается в журнал
+    await update_journal.flush_received()
+    return 200
+
+
+async def handle_webhook_connection(bot, update_queue, reader, writer):
+    """Обслуживает HTTP-соединение вебхука (с поддержкой keep-alive)"""
+    try:
+        while True:
+            request = await read_http_request(reader)
+            if request is None:
+                break
+            method, path, headers, body = request
+            status = await handle_webhook_request(bot, update_queue, method, path, headers, body)
+            keep_alive = headers.get('connection', '').lower() != 'close' and body is not None
+            await write_http_response(writer, status, 'ok' if status == 200 else '', keep_alive=keep_alive)
+            if not keep_alive:
+                break
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    except Exception as e:
+        logger.error("Ошибка при обработке запроса вебхука: %s", e, exc_info=True)
+    finally:
+        writer.close()
+
+
+def install_stop_signal_handlers(stop_event):
+    """Останавливает бота по SIGINT/SIGTERM (PM2 отправляет SIGINT)"""
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass  # На Windows обработчики сигналов в цикле событий не поддерживаются
+
+
+async def serve_webhook(bot, update_queue, stop_event):
+    """Регистрирует вебхук (если указан WEBHOOK_URL) и принимает обновления до stop_event"""
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            url=WEBHOOK_URL,
+            allowed_updates=ALLOWED_UPDATES,
+            secret_token=WEBHOOK_SECRET_TOKEN,
+            drop_pending_updates=False
+        )
+        logger.info("Вебхук зарегистрирован: %s", WEBHOOK_URL)
+    else:
+        logger.info("WEBHOOK_URL не указан, setWebhook не вызывается (локальный режим)")
+    
+    server = await asyncio.start_server(
+        partial(handle_webhook_connection, bot, update_queue),
+        WEBHOOK_LISTEN,
+        WEBHOOK_PORT
+    )
+    logger.info("Бот принимает вебхуки на http://%s:%s%s", WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH)
+    async with server:
+        await stop_event.wait()
+
+
+async def handle_metrics_connection(reader, writer):
+    """Отдает метрики в формате Prometheus на /metrics"""
+    try:
+        while True:
+            request = await read_http_request(reader)
+            if request is None:
+                break
+            method, path, headers, _ = request
+            if path != '/metrics':
+                status, body = 404, ''
+            elif method != 'GET':
+                status, body = 405, ''
+            else:
+                status, body = 200, metrics.render()
+            keep_alive = headers.get('connection', '').lower() != 'close'
+            await write_http_response(writer, status, body, 'text/plain; version=0.0.4; charset=utf-8', keep_alive)
+            if not keep_alive:
+                break
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    except Exception as e:
+        logger.error("Ошибка при отдаче метрик: %s", e, exc_info=True)
+    finally:
+        writer.close()
+
+
+class MetricsServer:
+    """Локальный HTTP-сервер с метриками"""
+    
+    def __init__(self, listen, port):
+        self.listen = listen
+        self.port = port
+        self._server = None
+    
+    async def start(self):
+        if not self.port:
+            return
+        try:
+            self._server = await asyncio.start_server(handle_metrics_connection, self.listen, self.port)
+        except OSError as e:
+            logger.error("Не удалось запустить сервер метрик на %s:%s: %s", self.listen, self.port, e)
+            return
+        logger.info("Метрики доступны на http://%s:%s/metrics", self.listen, self.port)
+    
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+
+metrics_server = MetricsServer(METRICS_LISTEN, METRICS_PORT)
+
+
+async def start_application(application: Application) -> None:
+    """Инициализирует и запускает приложение без встроенного Updater (вебхук, воркеры)"""
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+
+
+async def stop_application(application: Application) -> None:
+    """Останавливает приложение, запущенное через start_application"""
+    if application.running:
+        await application.stop()
+    if application.post_stop:
+        await application.post_stop(application)
+    await application.shutdown()
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+
+
+async def run_webhook(application: Application) -> None:
+    """Запускает бота в режиме вебхука со встроенным асинхронным HTTP-сервером"""
+    stop_event = asyncio.Event()
+    install_stop_signal_handlers(stop_event)
+    
+    await start_application(application)
+    try:
+        await serve_webhook(application.bot, application.update_queue, stop_event)
+    finally:
+        logger.info("Остановка бота...")
+        await stop_application(application)
+
+
+def sync_shared_store(store):
+    """
+    Подготавливает общее хранилище к запуску воркеров
+    
+    Если DATA_FILE изменялся после последней выгрузки (например, бот запускался
+    в однопроцессном режиме), данные импортируются из него заново.
+    """
+    data_mtime = os.path.getmtime(DATA_FILE) if os.path.exists(DATA_FILE) else 0
+    exported_mtime = float(store.get_meta('exported_data_mtime') or -1)
+    if data_mtime != exported_mtime:
+        load_user_data()
+        store.replace_all('users', user_data)
+        store.replace_all('friend_requests', friend_requests)
+        store.set_meta('exported_data_mtime', data_mtime)
+        logger.info("Общее хранилище заполнено из %s: %s пользователей", DATA_FILE, len(user_data))
+
+
+def export_shared_store(store):
+    """Выгружает общее хранилище обратно в DATA_FILE при остановке"""
+    global user_data, friend_requests
+    user_data = SharedMapping(store, 'users').snapshot()
+    friend_requests = SharedMapping(store, 'friend_requests').snapshot()
+    write_user_data()
+    store.set_meta('exported_data_mtime', os.path.getmtime(DATA_FILE))
+    logger.info("Данные %s пользователей выгружены в %s", len(user_data), DATA_FILE)
+
+
+def run_worker(worker_index, updates_queue):
+    """Точка входа процесса-воркера: обрабатывает обновления своей доли пользователей"""
+    # Останавливается по сигналу от основного процесса, а не по Ctrl+C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if metrics_server.port:
+        metrics_server.port += worker_index
+    use_shared_store(SharedStore(STATE_DB_FILE))
+    update_journal.shard = (worker_index, BOT_WORKERS)
+    update_journal.received_upstream = True
+    verification_codes.shard = (worker_index, BOT_WORKERS)
+    live_walks.shard = (worker_index, BOT_WORKERS)
+    walk_planner.shard = (worker_index, BOT_WORKERS)
+    application = build_application()
+    asyncio.run(serve_worker(application, worker_index, updates_queue))
+
+
+async def serve_worker(application, worker_index, updates_queue):
+    """Передает обновления из межпроцессной очереди в приложение воркера"""
+    loop = asyncio.get_running_loop()
+    await start_application(application)
+    logger.info("Воркер %s запущен (PID %s)", worker_index, os.getpid())
+    try:
+        while True:
+            data = await loop.run_in_executor(None, updates_queue.get)
+            if data is None:
+                break
+            await application.update_queue.put(Update.de_json(data, application.bot))
+    finally:
+        await stop_application(application)
+        logger.info("Воркер %s остановлен", worker_index)
+
+
+class JournaledUpdateQueue(asyncio.Queue):
+    """Очередь основного процесса режима воркеров: добавляет обновление в пачку журнала"""
+    
+    def put_nowait(self, item):
+        # Пачка записывается до подтверждения: перед следующим getUpdates или ответом вебхука
+        if isinstance(item, Update):
+            update_journal.receive(item)
+        super().put_nowait(item)
+
+
+async def route_updates(source_queue, worker_queues):
+    """Распределяет обновления по воркерам по хешу ID пользователя"""
+    while True:
+        update = await source_queue.get()
+        update_recorder.record(update)
+        user = update.effective_user
+        shard = shard_for_user(user.id, len(worker_queues)) if user else 0
+        worker_queues[shard].put(update.to_dict())
+
+
+async def run_front(worker_queues):
+    """Основной процесс режима воркеров: принимает обновления (polling или вебхук) и маршрутизирует их"""
+    stop_event = asyncio.Event()
+    install_stop_signal_handlers(stop_event)
+    
+    update_journal.open()
+    source_queue = JournaledUpdateQueue()
+    bot = Bot(BOT_TOKEN, base_url=TELEGRAM_API_BASE_URL, get_updates_request=JournaledUpdatesRequest())
+    async with bot:
+        router = asyncio.create_task(route_updates(source_queue, worker_queues))
+        try:
+            if BOT_MODE == 'webhook':
+                await serve_webhook(bot, source_queue, stop_event)
+            else:
+                updater = Updater(bot, source_queue)
+                async with updater:
+                    await updater.start_polling(
+                        allowed_updates=ALLOWED_UPDATES,
+                        drop_pending_updates=False
+                    )
+                    logger.info("Бот запущен в режиме %s воркеров...", len(worker_queues))
+                    await stop_event.wait()
+                    await updater.stop()
+            # Дожидаемся, пока маршрутизатор раздаст уже полученные обновления
+            while not source_queue.empty():
+                await asyncio.sleep(0.05)
+        finally:
+            router.cancel()
+
+
+def run_sharded():
+    """Запускает основной процесс и BOT_WORKERS процессов-воркеров"""
+    store = SharedStore(STATE_DB_FILE)
+    sync_shared_store(store)
+    
+    mp_context = multiprocessing.get_context('spawn')
+    worker_queues = [mp_context.Queue() for _ in range(BOT_WORKERS)]
+    workers = [
+        mp_context.Process(target=run_worker, args=(index, worker_queues[index]), name=f"bot-worker-{index}")
+        for index in range(BOT_WORKERS)
+    ]
+    for worker in workers:
+        worker.start()
+    
+    try:
+        asyncio.run(run_front(worker_queues))
+    finally:
+        for worker_queue in worker_queues:
+            worker_queue.put(None)
+        for worker in workers:
+            worker.join(timeout=30)
+            if worker.is_alive():
+                logger.warning("Воркер %s не остановился вовремя, завершаем принудительно", worker.name)
+                worker.terminate()
+        export_shared_store(store)
+
+
+metrics.gauge('bot_users', lambda: len(user_data), 'Зарегистрированные пользователи')
+metrics.gauge('bot_live_sessions', lambda: session_sweeper.live_sessions, 'Пользователи, активные в пределах SESSION_TTL')
+metrics.gauge('bot_sessions_evicted_total', lambda: session_sweeper.evicted_total, 'Сессии, вытесненные по SESSION_TTL', kind='counter')
+metrics.gauge('bot_rate_limited_total', lambda: rate_limiter.throttled_total, 'Запросы, отклоненные ограничителем частоты', kind='counter')
+metrics.gauge('bot_verification_codes', lambda: len(verification_codes), 'Действующие коды подтверждения')
+metrics.gauge('bot_live_walkers', lambda: len(live_walks), 'Пользователи, транслирующие живую геопозицию')
+metrics.gauge('bot_walk_partner_profiles', lambda: len(walk_partners), 'Пользователи с расписанием прогулок в индексе поиска компании')
+metrics.gauge('bot_live_walk_notifications_total', lambda: live_walks.notifications_total, 'Уведомления о друзьях рядом', kind='counter')
+metrics.gauge('bot_friend_suggestion_users', lambda: len(friend_suggestions), 'Пользователи со счетчиками общих друзей в памяти')
+metrics.gauge('bot_place_catalog_places', lambda: place_catalogs.current.place_count, 'Места для прогулок в текущей версии каталога')
+metrics.gauge('bot_place_catalog_reloads_total', lambda: place_catalogs.reloads_total, 'Загруженные новые версии каталога мест', kind='counter')
+metrics.gauge('bot_poi_places', lambda: len(poi_index), 'Ветклиники и зоомагазины из POI_FILE')
+metrics.gauge('bot_walk_reminders_pending', lambda: len(walk_planner), 'Напоминания о запланированных прогулках в очереди')
+metrics.gauge('bot_walk_reminders_sent_total', lambda: walk_planner.reminders_sent_total, 'Отправленные напоминания о прогулках', kind='counter')
+metrics.gauge('bot_duplicate_updates_total', lambda: update_journal.duplicates_total, 'Повторные обновления, пропущенные по журналу', kind='counter')
+metrics.gauge('bot_updates_recorded_total', lambda: update_recorder.recorded_total, 'Обновления, записанные в UPDATE_RECORD_FILE', kind='counter')
+
+
+async def post_init(application: Application) -> None:
+    """Запускает фоновые задачи после инициализации приложения"""
+    # Обновления, не обработанные до остановки, обрабатываются первыми
+    for data in update_journal.start():
+        await application.update_queue.put(Update.de_json(data, application.bot))
+    live_walks.start(application)
+    walk_partners.start()
+    friend_followers.start()
+    friend_suggestions.start()
+    poi_index.start()
+    place_catalogs.start()
+    walk_planner.start(application)
+    session_sweeper.start(application)
+    verification_codes.start()
+    load_monitor.start()
+    await metrics_server.start()
+
+
+async def post_stop(application: Application) -> None:
+    """Останавливает фоновые задачи"""
+    update_journal.stop()
+    live_walks.stop()
+    walk_planner.stop()
+    place_catalogs.stop()
+    session_sweeper.stop()
+    verification_codes.stop()
+    load_monitor.stop()
+    await metrics_server.stop()
+
+
+def build_application() -> Application:
+    """Создает приложение и регистрирует обработчики"""
+    update_queue = PerUserUpdateQueue()
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .base_url(TELEGRAM_API_BASE_URL)
+        .request(InstrumentedRequest())
+        .get_updates_request(JournaledUpdatesRequest())
+        .update_queue(update_queue)
+        .concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES, update_queue))
+        .post_init(post_init)
+        .post_stop(post_stop)
+    )
+    if SESSION_PERSISTENCE:
+        builder = builder.persistence(SessionPersistence(STATE_DB_FILE, PERSISTENCE_UPDATE_INTERVAL))
+    application = builder.build()
+    
+    # Обработчики с замером времени и подсчетом ошибок по маршрутам
+    start_handler = instrumented(start)
+    button_callback_handler = instrumented(button_callback)
+    handle_location_message_handler = instrumented(handle_location_message)
+    handle_friend_name_handler = instrumented(handle_friend_name)
+    handle_district_handler = instrumented(handle_district)
+    handle_location_choice_handler = instrumented(handle_location_choice)
+    handle_search_username_handler = instrumented(handle_search_username)
+    handle_verification_code_handler = instrumented(handle_verification_code)
+    handle_text_message_handler = instrumented(handle_text_message)
+    handle_photo_handler = instrumented(handle_photo)
+    handle_contact_handler = instrumented(handle_contact)
+    handle_live_location_handler = instrumented(handle_live_location)
+    handle_walk_schedule_handler = instrumented(handle_walk_schedule)
+    handle_walk_time_handler = instrumented(handle_walk_time)
+    
+    # ConversationHandler для обработки состояний
+    conv_handler = ConversationHandler(
+        entry_points=[
+            CallbackQueryHandler(button_callback_handler, pattern="^(my_walking_location|my_walk_schedule|plan_walk|write_friend|choose_district|search_user|share_contact|admin_add_tag_|write_to_|admin_message_)")
+        ],
+        per_message=False,
+        states={
+            WAITING_LOCATION_COORDS: [
+                MessageHandler(filters.LOCATION, handle_location_message_handler),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_location_message_handler),
+                CallbackQueryHandler(button_callback_handler, pattern="^profile$")
+            ],
+            WAITING_WALK_SCHEDULE: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_walk_schedule_handler),
+                CallbackQueryHandler(button_callback_handler, pattern="^profile$")
+            ],
+            WAITING_WALK_TIME: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_walk_time_handler),
+                CallbackQueryHandler(button_callback_handler, pattern=f"^({PLACE_CALLBACK_PREFIX}|select_walking_place_|choose_region$)")
+            ],
+            WAITING_LOCATION: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_location_message_handler),
+                CallbackQueryHandler(button_callback_handler, pattern="^profile$")
+            ],
+            WAITING_FRIEND_NAME: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_friend_name_handler),
+                CallbackQueryHandler(button_callback_handler, pattern="^walk_with_friends$")
+            ],
+            WAITING_DISTRICT: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_district_handler),
+                CallbackQueryHandler(button_callback_handler, pattern="^find_location$")
+            ],
+            WAITING_LOCATION_CHOICE: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_location_choice_handler),
+                CallbackQueryHandler(button_callback_handler, pattern="^choose_district$")
+            ],
+            WAITING_SEARCH_USERNAME: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_search_username_handler),
+                CallbackQueryHandler(button_callback_handler, pattern="^walk_with_friends$")
+            ],
+            WAITING_VERIFICATION_CODE: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_verification_code_handler),
+                CallbackQueryHandler(button_callback_handler, pattern="^profile$")
+            ],
+            WAITING_ADMIN_TAG: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_message_handler),
+                CallbackQueryHandler(button_callback_handler, pattern="^admin_view_subscriber_")
+            ],
+            WAITING_MESSAGE_TEXT: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_message_handler),
+                CallbackQueryHandler(button_callback_handler, pattern="^walk_with_friends$")
+            ],
+            WAITING_ADMIN_MESSAGE_TEXT: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_message_handler),
+                CallbackQueryHandler(button_callback_handler, pattern="^admin_view_subscriber_")
+            ]
+        },
+        fallbacks=[CommandHandler("start", start_handler), CallbackQueryHandler(button_callback_handler)],
+        name="main_conversation",
+        persistent=SESSION_PERSISTENCE,
+        # Незавершенный диалог неактивного пользователя завершается, как при возврате END
+        conversation_timeout=SESSION_TTL
+    )
+    
+    # Живые геопозиции и правки сообщений не проходят через ограничитель частоты и
+    # обычные обработчики: позиция только запоминается, это дешевле проверки лимита
+    application.add_handler(
+        MessageHandler(filters.UpdateType.EDITED_MESSAGE | (filters.UpdateType.MESSAGE & LiveLocationFilter()), handle_live_location_handler),
+        group=-2
+    )
+    
+    # Ограничение частоты запросов выполняется раньше всех остальных обработчиков
+    application.add_handler(TypeHandler(Update, rate_limit_guard), group=-1)
+    
+    # Регистрируем обработчики (ВАЖНО: порядок имеет значение!)
+    # Сначала регистрируем команду /start, чтобы она обрабатывалась до ConversationHandler
+    application.add_handler(CommandHandler("start", start_handler))
+    logger.info("Обработчик команды /start зарегистрирован")
+    application.add_handler(CommandHandler("stats", instrumented(stats_command)))
+    application.add_handler(CommandHandler("reload_places", instrumented(reload_places_command)))
+    
+    application.add_handler(conv_handler)
+    logger.info("ConversationHandler зарегистрирован")
+    
+    application.add_handler(CallbackQueryHandler(button_callback_handler))
+    application.add_handler(InlineQueryHandler(instrumented(inline_query)))
+    application.add_handler(MessageHandler(filters.PHOTO, handle_photo_handler))
+    application.add_handler(MessageHandler(filters.CONTACT, handle_contact_handler))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_message_handler))
+    
+    return application
+
+
 def main() -> None:
     """Запуск бота"""
     try:
-        logger.info(f"Запуск бота с токеном: {BOT_TOKEN[:10]}..." if BOT_TOKEN else "Токен не найден!")
+        if BOT_TOKEN:
+            logger.info("Запуск бота с токеном: %s...", BOT_TOKEN[:10])
+        else:
+            logger.info("Токен не найден!")
+        
+        update_recorder.start()
+        if BOT_WORKERS > 1:
+            # Основной процесс только принимает обновления, данные загружают воркеры
+            run_sharded()
+            return
         
         # Загружаем данные пользователей из файла
         load_user_data()
         
         # Создаем приложение
-        application = Application.builder().token(BOT_TOKEN).build()
-        
-        # ConversationHandler для обработки состояний
-        conv_handler = ConversationHandler(
-            entry_points=[
-                CallbackQueryHandler(button_callback, pattern="^(my_walking_location|write_friend|choose_district|search_user|share_contact|admin_add_tag_|write_to_|admin_message_)")
-            ],
-            per_message=False,
-            states={
-                WAITING_LOCATION_COORDS: [
-                    MessageHandler(filters.LOCATION, handle_location_message),
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, handle_location_message),
-                    CallbackQueryHandler(button_callback, pattern="^profile$")
-                ],
-                WAITING_LOCATION: [
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, handle_location_message),
-                    CallbackQueryHandler(button_callback, pattern="^profile$")
-                ],
-                WAITING_FRIEND_NAME: [
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, handle_friend_name),
-                    CallbackQueryHandler(button_callback, pattern="^walk_with_friends$")
-                ],
-                WAITING_DISTRICT: [
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, handle_district),
-                    CallbackQueryHandler(button_callback, pattern="^find_location$")
-                ],
-                WAITING_LOCATION_CHOICE: [
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, handle_location_choice),
-                    CallbackQueryHandler(button_callback, pattern="^choose_district$")
-                ],
-                WAITING_SEARCH_USERNAME: [
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, handle_search_username),
-                    CallbackQueryHandler(button_callback, pattern="^walk_with_friends$")
-                ],
-                WAITING_VERIFICATION_CODE: [
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, handle_verification_code),
-                    CallbackQueryHandler(button_callback, pattern="^profile$")
-                ],
-                WAITING_ADMIN_TAG: [
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_message),
-                    CallbackQueryHandler(button_callback, pattern="^admin_view_subscriber_")
-                ],
-                WAITING_MESSAGE_TEXT: [
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_message),
-                    CallbackQueryHandler(button_callback, pattern="^walk_with_friends$")
-                ],
-                WAITING_ADMIN_MESSAGE_TEXT: [
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_message),
-                    CallbackQueryHandler(button_callback, pattern="^admin_view_subscriber_")
-                ]
-            },
-            fallbacks=[CommandHandler("start", start), CallbackQueryHandler(button_callback)]
-        )
-        
-        # Регистрируем обработчики (ВАЖНО: порядок имеет значение!)
-        # Сначала регистрируем команду /start, чтобы она обрабатывалась до ConversationHandler
-        application.add_handler(CommandHandler("start", start))
-        logger.info("Обработчик команды /start зарегистрирован")
-        
-        application.add_handler(conv_handler)
-        logger.info("ConversationHandler зарегистрирован")
-        
-        application.add_handler(CallbackQueryHandler(button_callback))
-        application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
-        application.add_handler(MessageHandler(filters.CONTACT, handle_contact))
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_message))
+        application = build_application()
         
         # Запускаем бота
-        logger.info("Бот запущен и готов к работе...")
-        application.run_polling(
-            allowed_updates=Update.ALL_TYPES,
-            drop_pending_updates=True  # Игнорировать старые обновления при запуске
-        )
+        if BOT_MODE == 'webhook':
+            asyncio.run(run_webhook(application))
+        else:
+            logger.info("Бот запущен и готов к работе...")
+            application.run_polling(
+                allowed_updates=ALLOWED_UPDATES,
+                drop_pending_updates=False  # Обновления, пришедшие во время перезапуска, не теряются
+            )
     except Exception as e:
-        logger.error(f"Критическая ошибка при запуске бота: {e}", exc_info=True)
+        logger.error("Критическая ошибка при запуске бота: %s", e, exc_info=True)
         raise
+    finally:
+        update_recorder.stop()
 
 
 if __name__ == '__main__':
@@ -5,7 +5,11 @@ module.exports = {
     interpreter: '/root/dog-walking-bot/venv/bin/python',
     cwd: '/root/dog-walking-bot',
     env: {
-      NODE_ENV: 'production'
+      NODE_ENV: 'production',
+      // Число процессов-воркеров (основной процесс распределяет обновления между ними)
+      BOT_WORKERS: '1',
+      // text или json (одна JSON-строка на запись лога)
+      LOG_FORMAT: 'text'
     },
     error_file: './logs/err.log',
     out_file: './logs/out.log',
@@ -14,6 +18,8 @@ module.exports = {
     autorestart: true,
     watch: false,
     max_memory_restart: '1G',
+    // Время на корректную остановку воркеров и выгрузку данных
+    kill_timeout: 30000,
     instances: 1,
     exec_mode: 'fork'
   }]
@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+"""
+Локальная замена Telegram Bot API для нагрузочных тестов
+
+Реализует методы, которые использует бот: getMe, getUpdates, deleteWebhook,
+setWebhook, sendMessage, editMessageText, editMessageReplyMarkup,
+answerCallbackQuery, sendPhoto, sendDocument и deleteMessage. Задержка ответа
+и ограничения частоты (ответ 429, как у настоящего Telegram) настраиваются.
+
+Обновления для бота добавляются через FakeBotAPI.push_update(); вызовы бота
+передаются подписчикам (listeners) - так нагрузочный драйвер (load_test.py)
+видит ответы бота и замеряет задержку.
+
+Бот подключается к серверу через переменную окружения:
+    TELEGRAM_API_BASE_URL=http://127.0.0.1:8081/bot python bot.py
+"""
+import os
+import json
+import time
+import random
+import asyncio
+import argparse
+import urllib.parse
+from collections import Counter
+from email.parser import BytesParser
+from email.policy import HTTP
+
+# Сервер использует HTTP-разбор из бота, токен нужен только для импорта модуля
+os.environ.setdefault('BOT_TOKEN', '0:fake')
+
+from bot import read_http_request, write_http_response  # noqa: E402
+
+BOT_USER = {
+    'id': 1000000001,
+    'is_bot': True,
+    'first_name': 'Fake Dog Walking Bot',
+    'username': 'fake_dog_walking_bot',
+    'can_join_groups': False,
+    'can_read_all_group_messages': False,
+    'supports_inline_queries': True
+}
+# Методы, которые Telegram ограничивает по частоте (~30 сообщений в секунду на бота, ~1 в секунду в чат)
+RATE_LIMITED_METHODS = {'sendMessage', 'sendPhoto', 'sendDocument', 'editMessageText', 'editMessageReplyMarkup'}
+TEXT_PARAMETERS = {'text', 'caption', 'callback_query_id', 'query', 'file_name'}
+
+
+def parse_parameters(headers, body):
+    """Разбирает параметры метода: JSON, application/x-www-form-urlencoded или multipart/form-data"""
+    content_type = headers.get('content-type', '')
+    if not body:
+        return {}
+    if content_type.startswith('application/json'):
+        return json.loads(body)
+
+    raw = {}
+    if content_type.startswith('multipart/form-data'):
+        message = BytesParser(policy=HTTP).parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode('latin-1') + body
+        )
+        for part in message.iter_parts():
+            name = part.get_param('name', header='content-disposition')
+            payload = part.get_payload(decode=True)
+            raw[name] = payload if part.get_filename() else payload.decode('utf-8')
+    else:
+        raw = {name: values[-1] for name, values in urllib.parse.parse_qs(body.decode('utf-8')).items()}
+
+    # python-telegram-bot передает непростые значения закодированными в JSON
+    params = {}
+    for name, value in raw.items():
+        if isinstance(value, str) and name not in TEXT_PARAMETERS:
+            try:
+                value = json.loads(value)
+            except ValueError:
+                pass
+        params[name] = value
+    return params
+
+
+class RateBucket:
+    """Ведро токенов для имитации ограничений Telegram"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class FakeBotAPI:
+    """Состояние и методы поддельного Bot API"""
+
+    def __init__(self, latency=0.0, jitter=0.0, global_rate=0.0, chat_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.calls = Counter()
+        self.rate_limited = Counter()
+        self.listeners = []  # Функции (method, params, result), вызываются после каждого успешного вызова
+        self.polling = asyncio.Event()  # Установлено после первого getUpdates
+        self._pending = []  # Обновления, еще не подтвержденные ботом через offset
+        self._new_updates = asyncio.Event()
+        self._last_update_id = 0
+        self._message_ids = Counter()
+        self._file_ids = 0
+        self._global_bucket = RateBucket(global_rate, max(global_rate, 1)) if global_rate else None
+        self._chat_buckets = {}
+
+    def push_update(self, update):
+        """Ставит обновление в очередь getUpdates. Возвращает присвоенный update_id"""
+        self._last_update_id += 1
+        update = dict(update, update_id=self._last_update_id)
+        self._pending.append(update)
+        self._new_updates.set()
+        return self._last_update_id
+
+    @property
+    def pending_updates(self):
+        return len(self._pending)
+
+    def make_message(self, chat_id, **fields):
+        self._message_ids[chat_id] += 1
+        message = {
+            'message_id': self._message_ids[chat_id],
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': BOT_USER
+        }
+        message.update({name: value for name, value in fields.items() if value is not None})
+        return message
+
+    def next_file_id(self, prefix):
+        self._file_ids += 1
+        return {'file_id': f"{prefix}-{self._file_ids}", 'file_unique_id': f"u{prefix}{self._file_ids}"}
+
+    def check_rate_limit(self, method, params):
+        """Возвращает retry_after в секундах, если вызов превышает ограничения, иначе None"""
+        if method not in RATE_LIMITED_METHODS:
+            return None
+        if self._global_bucket and not self._global_bucket.take():
+            return 1
+        if self.chat_rate and 'chat_id' in params:
+            bucket = self._chat_buckets.get(params['chat_id'])
+            if bucket is None:
+                bucket = self._chat_buckets[params['chat_id']] = RateBucket(self.chat_rate, 3)
+            if not bucket.take():
+                return 1
+        return None
+
+    async def get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        timeout = float(params.get('timeout') or 0)
+        limit = int(params.get('limit') or 100)
+        if offset:
+            # Обновления с меньшим update_id бот подтвердил
+            self._pending = [update for update in self._pending if update['update_id'] >= offset]
+        if not self._pending and timeout:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self._pending[:limit]
+
+    def call_result(self, method, params):
+        """Результат синхронного метода или None, если метод не поддерживается"""
+        inline_markup = params.get('reply_markup')
+        if not (isinstance(inline_markup, dict) and 'inline_keyboard' in inline_markup):
+            inline_markup = None
+
+        if method == 'getMe':
+            return BOT_USER
+        if method in ('deleteWebhook', 'setWebhook'):
+            if params.get('drop_pending_updates'):
+                self._pending.clear()
+            return True
+        if method in ('answerCallbackQuery', 'deleteMessage', 'setMyCommands', 'close', 'logOut', 'answerInlineQuery'):
+            return True
+        if method == 'sendMessage':
+            return self.make_message(params['chat_id'], text=params.get('text'), reply_markup=inline_markup)
+        if method in ('editMessageText', 'editMessageReplyMarkup'):
+            message = self.make_message(params['chat_id'], text=params.get('text'), reply_markup=inline_markup)
+            message['message_id'] = int(params['message_id'])
+            message['edit_date'] = message['date']
+            return message
+        if method == 'sendPhoto':
+            photo = dict(self.next_file_id('photo'), width=800, height=600)
+            return self.make_message(params['chat_id'], photo=[photo], caption=params.get('caption'), reply_markup=inline_markup)
+        if method == 'sendDocument':
+            document = dict(self.next_file_id('document'), file_name=params.get('file_name') or 'document')
+            return self.make_message(params['chat_id'], document=document, caption=params.get('caption'))
+        return None
+
+    async def handle(self, method, params):
+        """Выполняет метод. Возвращает (HTTP-статус, тело ответа)"""
+        self.calls[method] += 1
+        if method == 'getUpdates':
+            self.polling.set()
+            return 200, {'ok': True, 'result': await self.get_updates(params)}
+
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + random.random() * self.jitter)
+
+        retry_after = self.check_rate_limit(method, params)
+        if retry_after:
+            self.rate_limited[method] += 1
+            return 429, {
+                'ok': False,
+                'error_code': 429,
+                'description': f"Too Many Requests: retry after {retry_after}",
+                'parameters': {'retry_after': retry_after}
+            }
+
+        result = self.call_result(method, params)
+        if result is None:
+            return 404, {'ok': False, 'error_code': 404, 'description': 'Not Found: method not found'}
+        for listener in self.listeners:
+            listener(method, params, result)
+        return 200, {'ok': True, 'result': result}
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request = await read_http_request(reader)
+                if request is None:
+                    break
+                _, path, headers, body = request
+                # Путь: /bot<token>/<method>
+                method = path.rsplit('/', 1)[-1]
+                try:
+                    status, payload = await self.handle(method, parse_parameters(headers, body or b''))
+                except (KeyError, ValueError) as e:
+                    status, payload = 400, {'ok': False, 'error_code': 400, 'description': f"Bad Request: {e}"}
+                await write_http_response(writer, status, json.dumps(payload, ensure_ascii=False), 'application/json')
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except asyncio.CancelledError:
+            pass  # Остановка сервера во время долгого опроса getUpdates
+        finally:
+            writer.close()
+
+    async def start(self, host='127.0.0.1', port=0):
+        """Запускает HTTP-сервер. Возвращает фактический порт"""
+        self._server = await asyncio.start_server(self.handle_connection, host, port)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+
+def make_user(user_id, first_name, last_name=None, username=None):
+    user = {'id': user_id, 'is_bot': False, 'first_name': first_name, 'language_code': 'ru'}
+    if last_name:
+        user['last_name'] = last_name
+    if username:
+        user['username'] = username
+    return user
+
+
+def message_update(user, text=None, **fields):
+    """Обновление с сообщением пользователя (команды получают entity bot_command)"""
+    message = {
+        'message_id': random.randint(1, 2 ** 31),
+        'date': int(time.time()),
+        'chat': {'id': user['id'], 'type': 'private', 'first_name': user['first_name']},
+        'from': user
+    }
+    if text is not None:
+        message['text'] = text
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    message.update(fields)
+    return {'message': message}
+
+
+def contact_update(user, phone_number):
+    contact = {'phone_number': phone_number, 'first_name': user['first_name'], 'user_id': user['id']}
+    return message_update(user, contact=contact)
+
+
+def location_update(user, latitude, longitude, live_period=None, message_id=None, edited=False):
+    """Сообщение с геопозицией; edited=True - новая позиция живой геопозиции (правка сообщения message_id)"""
+    location = {'latitude': latitude, 'longitude': longitude}
+    if live_period:
+        location['live_period'] = live_period
+    update = message_update(user, location=location)
+    message = update['message']
+    if message_id is not None:
+        message['message_id'] = message_id
+    if edited:
+        message['edit_date'] = message['date']
+        return {'edited_message': message}
+    return update
+
+
+def callback_update(user, message, data):
+    """Нажатие inline-кнопки под сообщением бота message"""
+    return {
+        'callback_query': {
+            'id': f"{user['id']}-{random.getrandbits(48)}",
+            'from': user,
+            'chat_instance': str(user['id']),
+            'message': message,
+            'data': data
+        }
+    }
+
+
+
+def inline_query_update(user, query, offset=''):
+    """Inline-запрос "@bot <query>" (ID, как у нажатий, начинается с ID пользователя)"""
+    return {
+        'inline_query': {
+            'id': f"{user['id']}-{random.getrandbits(48)}",
+            'from': user,
+            'query': query,
+            'offset': offset
+        }
+    }
+
+async def serve_forever(args):
+    api = FakeBotAPI(args.latency, args.jitter, args.global_rate, args.chat_rate)
+    port = await api.start(args.host, args.port)
+    print(f"Поддельный Bot API: TELEGRAM_API_BASE_URL=http://{args.host}:{port}/bot")
+    await asyncio.Event().wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальная замена Telegram Bot API")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.0, help="Задержка ответа, секунды")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Случайная добавка к задержке, секунды")
+    parser.add_argument('--global-rate', type=float, default=0.0, help="Сообщений в секунду на бота (0 - без ограничения)")
+    parser.add_argument('--chat-rate', type=float, default=0.0, help="Сообщений в секунду в один чат (0 - без ограничения)")
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve_forever(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
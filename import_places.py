@@ -0,0 +1,501 @@
+#!/usr/bin/env python3
+"""
+Импорт каталога мест для прогулок из выгрузки OpenStreetMap или CSV
+
+Читает выгрузку потоком, не загружая ее в память целиком, отбирает парки, скверы,
+сады и площадки для выгула собак и раскладывает их по регионам и районам: точка
+места проверяется на попадание в полигоны границ из GeoJSON-файлов. Результат -
+компактный каталог мест бота (по умолчанию places.json). Попутно можно собрать
+ветклиники и зоомагазины в формате POI_FILE (--pois).
+
+Поддерживаемые выгрузки:
+    *.osm, *.osm.gz, *.osm.bz2 - OSM XML. Памяти нужно столько, сколько занимают
+        найденные места, а не сама выгрузка: узлы контуров парков читаются
+        отдельным проходом, только те, что нужны;
+    *.osm.pbf - через pyosmium (pip install osmium);
+    *.csv - столбцы name, lat, lon и необязательные kind, region, district,
+        address, opening_hours, phone. Без файлов границ регион и район берутся
+        из столбцов region и district.
+
+Границы - GeoJSON с полигонами (Polygon, MultiPolygon), название берется из
+свойства --name-field. Выгрузки границ регионов и районов можно получить из
+того же OSM (boundary=administrative, admin_level 4 и 5/8).
+
+Примеры:
+    python import_places.py moscow.osm.bz2 --regions regions.geojson --districts districts.geojson
+    python import_places.py russia.osm.pbf --regions regions.geojson --districts districts.geojson --pois pois.json
+    python import_places.py places.csv -o places.json
+"""
+import io
+import os
+import sys
+import bz2
+import csv
+import gzip
+import json
+import math
+import time
+import argparse
+import xml.etree.ElementTree as ET
+from array import array
+from collections import Counter, defaultdict
+
+PROGRESS_INTERVAL = 2.0  # Секунды между строками прогресса
+PROGRESS_CHECK_EVERY = 10_000  # Элементов между проверками времени
+BOUNDARY_GRID_DEGREES = 1.0  # Ячейка сетки кандидатов для границ
+BOUNDARY_BAND_DEGREES = 0.01  # Полоса широт, по которой ищутся ребра полигона
+DUPLICATE_METERS = 300  # Одноименные места ближе считаются одним местом
+DOG_PARK_NAME = "Площадка для выгула собак"
+
+# Виды мест каталога и виды точек для POI_FILE
+PLACE_KINDS = ('park', 'garden', 'square', 'dog_park')
+POI_KINDS = ('vet', 'pet_shop')
+
+
+def classify(tags):
+    """Вид места по тегам OSM или None, если место не нужно"""
+    leisure = tags.get('leisure')
+    if leisure == 'dog_park':
+        return 'dog_park'
+    if leisure == 'park':
+        return 'park'
+    if leisure == 'garden' and tags.get('access') not in ('private', 'no'):
+        return 'garden'
+    if tags.get('place') == 'square':
+        return 'square'
+    if tags.get('amenity') == 'veterinary':
+        return 'vet'
+    if tags.get('shop') == 'pet':
+        return 'pet_shop'
+    return None
+
+
+def format_bytes(count):
+    if count < 1024:
+        return f"{count} Б"
+    for unit in ("КБ", "МБ", "ГБ"):
+        count /= 1024
+        if count < 1024 or unit == "ГБ":
+            return f"{count:.1f} {unit}"
+
+
+def haversine_meters(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * 6371000 * math.asin(math.sqrt(a))
+
+
+class Progress:
+    """Периодический отчет о прочитанном объеме и скорости"""
+
+    def __init__(self, label, total_bytes):
+        self.label = label
+        self.total_bytes = total_bytes
+        self.started = time.perf_counter()
+        self.last_report = self.started
+        self.elements = 0
+        self.position = 0
+        self.found = 0
+
+    def tick(self, position_func=None):
+        """Учесть элемент. position_func - позиция в файле, если ее можно узнать"""
+        self.elements += 1
+        if self.elements % PROGRESS_CHECK_EVERY:
+            return
+        now = time.perf_counter()
+        if now - self.last_report < PROGRESS_INTERVAL:
+            return
+        self.last_report = now
+        elapsed = now - self.started
+        read = ""
+        if position_func:
+            self.position = position_func()
+            share = f" ({self.position / self.total_bytes:.0%})" if self.total_bytes else ""
+            read = f"{format_bytes(self.position)}{share}, {self.position / elapsed / 2 ** 20:.1f} МБ/с, "
+        print(
+            f"  {self.label}: {read}элементов {self.elements:,} ({self.elements / elapsed:,.0f} в секунду), "
+            f"найдено {self.found:,}",
+            file=sys.stderr
+        )
+
+    def finish(self, position):
+        self.position = position
+        return time.perf_counter() - self.started
+
+
+def open_extract(path):
+    """(текстовый или двоичный поток, функция текущей позиции в сжатом файле)"""
+    raw = open(path, 'rb')
+    if path.endswith('.gz'):
+        stream = gzip.GzipFile(fileobj=raw)
+    elif path.endswith('.bz2'):
+        stream = bz2.BZ2File(raw)
+    else:
+        stream = raw
+    return stream, raw.tell
+
+
+class Boundaries:
+    """
+    Полигоны границ из GeoJSON и поиск полигона, содержащего точку
+
+    Кандидаты берутся из сетки по габаритам полигонов, а проверка луча смотрит только
+    ребра из полосы широт точки, поэтому даже подробные границы регионов проверяются
+    за микросекунды.
+    """
+
+    def __init__(self, path, name_field):
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        features = data.get('features', []) if data.get('type') == 'FeatureCollection' else [data]
+        self.names = []
+        self._bands = []  # {номер полосы: array('d', [x1, y1, x2, y2, ...])} для каждого полигона
+        self._grid = defaultdict(list)
+        for feature in features:
+            name = (feature.get('properties') or {}).get(name_field)
+            geometry = feature.get('geometry') or {}
+            if not name or geometry.get('type') not in ('Polygon', 'MultiPolygon'):
+                continue
+            polygons = geometry['coordinates'] if geometry['type'] == 'MultiPolygon' else [geometry['coordinates']]
+            self._add(str(name), [ring for polygon in polygons for ring in polygon])
+        print(f"Границы {path}: {len(self.names)} полигонов", file=sys.stderr)
+
+    def _add(self, name, rings):
+        index = len(self.names)
+        self.names.append(name)
+        bands = defaultdict(lambda: array('d'))
+        min_x = min_y = math.inf
+        max_x = max_y = -math.inf
+        for ring in rings:
+            for start, end in zip(ring, ring[1:] + ring[:1]):
+                (x1, y1), (x2, y2) = start[:2], end[:2]
+                if y1 == y2:
+                    continue  # Горизонтальное ребро луч не пересекает
+                low, high = sorted((y1, y2))
+                for band in range(int(math.floor(low / BOUNDARY_BAND_DEGREES)),
+                                  int(math.floor(high / BOUNDARY_BAND_DEGREES)) + 1):
+                    bands[band].extend((x1, y1, x2, y2))
+                min_x, max_x = min(min_x, x1, x2), max(max_x, x1, x2)
+                min_y, max_y = min(min_y, low), max(max_y, high)
+        self._bands.append(dict(bands))
+        if min_x > max_x:
+            return
+        for cell_x in range(int(math.floor(min_x / BOUNDARY_GRID_DEGREES)), int(math.floor(max_x / BOUNDARY_GRID_DEGREES)) + 1):
+            for cell_y in range(int(math.floor(min_y / BOUNDARY_GRID_DEGREES)), int(math.floor(max_y / BOUNDARY_GRID_DEGREES)) + 1):
+                self._grid[cell_x, cell_y].append(index)
+
+    def _contains(self, index, lat, lon):
+        # Правило четности: дырки и части мультиполигона учитываются сами собой
+        edges = self._bands[index].get(int(math.floor(lat / BOUNDARY_BAND_DEGREES)))
+        if not edges:
+            return False
+        inside = False
+        for i in range(0, len(edges), 4):
+            x1, y1, x2, y2 = edges[i], edges[i + 1], edges[i + 2], edges[i + 3]
+            if (y1 > lat) != (y2 > lat) and lon < x1 + (lat - y1) * (x2 - x1) / (y2 - y1):
+                inside = not inside
+        return inside
+
+    def find(self, lat, lon):
+        """Название первого полигона, содержащего точку, или None"""
+        cell = (int(math.floor(lon / BOUNDARY_GRID_DEGREES)), int(math.floor(lat / BOUNDARY_GRID_DEGREES)))
+        for index in self._grid.get(cell, ()):
+            if self._contains(index, lat, lon):
+                return self.names[index]
+        return None
+
+
+def xml_tags(elem):
+    return {tag.get('k'): tag.get('v') for tag in elem.iterfind('tag')}
+
+
+def iterate_xml(path, label, total_bytes, stop_at=None):
+    """
+    Элементы node/way/relation выгрузки OSM XML по одному
+
+    Обработанные элементы сразу удаляются из дерева, поэтому память не растет.
+    stop_at - тег, на первом элементе которого чтение прекращается (в OSM XML
+    все узлы идут перед линиями, а линии - перед отношениями).
+    """
+    stream, position = open_extract(path)
+    progress = Progress(label, total_bytes)
+    try:
+        context = ET.iterparse(stream, events=('start', 'end'))
+        _, root = next(context)
+        for event, elem in context:
+            if event == 'start':
+                if elem.tag == stop_at:
+                    break
+                continue
+            if elem.tag in ('node', 'way', 'relation'):
+                progress.tick(position)
+                yield elem, progress
+                root.clear()
+    finally:
+        seconds = progress.finish(position())
+        stream.close()
+        print(
+            f"  {label}: {format_bytes(progress.position)} за {seconds:.1f} с, "
+            f"элементов {progress.elements:,}", file=sys.stderr
+        )
+
+
+def read_osm_xml(path):
+    """
+    Места из OSM XML: пары (теги, (lat, lon), вид)
+
+    Проход 1 отбирает нужные точки, линии и мультиполигоны (для линий запоминаются
+    ID узлов, координат у линий в OSM нет). Проход 2 нужен только для
+    мультиполигонов: он читает узлы их внешних контуров. Проход 3 читает координаты
+    только нужных узлов и останавливается на первой линии.
+    """
+    total_bytes = os.path.getsize(path)
+    ways = {}  # {ID линии: (теги, вид, array ID узлов)}
+    relations = []  # [(теги, вид, [ID внешних линий])]
+    for elem, progress in iterate_xml(path, "проход 1", total_bytes):
+        tags = xml_tags(elem)
+        kind = classify(tags) if tags else None
+        if not kind:
+            continue
+        progress.found += 1
+        if elem.tag == 'node':
+            yield tags, (float(elem.get('lat')), float(elem.get('lon'))), kind
+        elif elem.tag == 'way':
+            ways[int(elem.get('id'))] = (tags, kind, array('q', (int(nd.get('ref')) for nd in elem.iterfind('nd'))))
+        elif tags.get('type') == 'multipolygon':
+            outer = [
+                int(member.get('ref')) for member in elem.iterfind('member')
+                if member.get('type') == 'way' and member.get('role') in ('outer', '')
+            ]
+            relations.append((tags, kind, outer))
+
+    member_refs = {}  # {ID линии из мультиполигона: array ID узлов}
+    wanted_ways = {way_id for _, _, outer in relations for way_id in outer}
+    if wanted_ways:
+        for elem, progress in iterate_xml(path, "проход 2", total_bytes, stop_at='relation'):
+            if elem.tag == 'way':
+                way_id = int(elem.get('id'))
+                if way_id in wanted_ways:
+                    member_refs[way_id] = array('q', (int(nd.get('ref')) for nd in elem.iterfind('nd')))
+                    progress.found += 1
+
+    wanted_nodes = set()
+    for _, _, refs in ways.values():
+        wanted_nodes.update(refs)
+    for refs in member_refs.values():
+        wanted_nodes.update(refs)
+    coords = {}
+    if wanted_nodes:
+        for elem, progress in iterate_xml(path, "проход 3", total_bytes, stop_at='way'):
+            if elem.tag == 'node':
+                node_id = int(elem.get('id'))
+                if node_id in wanted_nodes:
+                    coords[node_id] = (float(elem.get('lat')), float(elem.get('lon')))
+                    progress.found += 1
+
+    for tags, kind, refs in ways.values():
+        point = centroid(coords, refs)
+        if point:
+            yield tags, point, kind
+    for tags, kind, outer in relations:
+        refs = [ref for way_id in outer for ref in member_refs.get(way_id, ())]
+        point = centroid(coords, refs)
+        if point:
+            yield tags, point, kind
+
+
+def centroid(coords, refs):
+    """Середина габаритов контура: для ссылки на карту этого достаточно"""
+    points = [coords[ref] for ref in refs if ref in coords]
+    if not points:
+        return None
+    lats = [lat for lat, _ in points]
+    lons = [lon for _, lon in points]
+    return (min(lats) + max(lats)) / 2, (min(lons) + max(lons)) / 2
+
+
+def read_osm_pbf(path):
+    """Места из OSM PBF через pyosmium: контуры собираются библиотекой"""
+    try:
+        import osmium  # pyright: ignore[reportMissingImports]
+    except ImportError:
+        sys.exit("Для чтения .osm.pbf установите pyosmium: pip install osmium")
+
+    found = []
+    progress = Progress("PBF", os.path.getsize(path))
+
+    def add(tags, points):
+        kind = classify(tags)
+        if kind and points:
+            lats = [lat for lat, _ in points]
+            lons = [lon for _, lon in points]
+            found.append((tags, ((min(lats) + max(lats)) / 2, (min(lons) + max(lons)) / 2), kind))
+            progress.found += 1
+
+    class Handler(osmium.SimpleHandler):
+        def node(self, node):
+            progress.tick()
+            if node.tags and node.location.valid():
+                add(dict(node.tags), [(node.location.lat, node.location.lon)])
+
+        def area(self, area):
+            progress.tick()
+            if area.tags:
+                add(dict(area.tags), [
+                    (node.lat, node.lon) for ring in area.outer_rings() for node in ring if node.location.valid()
+                ])
+
+    # Разреженный индекс узлов на диске: выгрузка страны не помещается в память
+    Handler().apply_file(path, locations=True, idx='sparse_file_array,' + path + '.nodes.tmp')
+    if os.path.exists(path + '.nodes.tmp'):
+        os.remove(path + '.nodes.tmp')
+    seconds = progress.finish(os.path.getsize(path))
+    print(f"  PBF: {format_bytes(progress.position)} за {seconds:.1f} с, элементов {progress.elements:,}", file=sys.stderr)
+    yield from found
+
+
+def read_csv(path, delimiter):
+    """Места из CSV: вид из столбца kind (по умолчанию park), остальные столбцы - как теги"""
+    stream, position = open_extract(path)
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    progress = Progress("CSV", os.path.getsize(path))
+    try:
+        for row in csv.DictReader(text, delimiter=delimiter):
+            progress.tick(position)
+            try:
+                point = (float(row['lat']), float(row['lon']))
+            except (KeyError, TypeError, ValueError):
+                continue
+            kind = (row.get('kind') or 'park').strip()
+            if kind in PLACE_KINDS or kind in POI_KINDS:
+                progress.found += 1
+                yield {key: value for key, value in row.items() if key and value}, point, kind
+    finally:
+        seconds = progress.finish(position())
+        text.close()
+        print(f"  CSV: {format_bytes(progress.position)} за {seconds:.1f} с, строк {progress.elements:,}", file=sys.stderr)
+
+
+class Catalog:
+    """Места, разложенные по регионам и районам, и ветклиники с зоомагазинами"""
+
+    def __init__(self, regions, districts):
+        self.regions = regions
+        self.districts = districts
+        self.places = defaultdict(lambda: defaultdict(list))  # {регион: {район: [[название, lat, lon, вид]]}}
+        self._by_name = defaultdict(list)  # {(регион, район, название): [(lat, lon)]} для поиска повторов
+        self.pois = []
+        self.kinds = Counter()
+        self.skipped = Counter()
+
+    def add(self, tags, point, kind):
+        lat, lon = point
+        if kind in POI_KINDS:
+            self.add_poi(tags, lat, lon, kind)
+            return
+        name = (tags.get('name') or '').strip() or (DOG_PARK_NAME if kind == 'dog_park' else '')
+        if not name:
+            self.skipped['без названия'] += 1
+            return
+        region = self.regions.find(lat, lon) if self.regions else tags.get('region')
+        district = self.districts.find(lat, lon) if self.districts else tags.get('district')
+        if not region or not district:
+            self.skipped['без региона или района'] += 1
+            return
+        same_name = self._by_name[region, district, name]
+        if any(haversine_meters(lat, lon, *other) < DUPLICATE_METERS for other in same_name):
+            self.skipped['повторы'] += 1
+            return
+        same_name.append((lat, lon))
+        self.places[region][district].append([name, round(lat, 6), round(lon, 6), kind])
+        self.kinds[kind] += 1
+
+    def add_poi(self, tags, lat, lon, kind):
+        address = tags.get('address') or ', '.join(
+            part for part in (tags.get('addr:street'), tags.get('addr:housenumber')) if part
+        )
+        poi = {'kind': kind, 'name': tags.get('name', ''), 'lat': round(lat, 6), 'lon': round(lon, 6)}
+        for key, value in (
+            ('address', address),
+            ('opening_hours', tags.get('opening_hours')),
+            ('phone', tags.get('phone') or tags.get('contact:phone')),
+        ):
+            if value:
+                poi[key] = value
+        self.pois.append(poi)
+        self.kinds[kind] += 1
+
+    def catalog(self):
+        """Компактный каталог: регионы и районы по алфавиту, одноименные места пронумерованы"""
+        regions = {}
+        for region in sorted(self.places):
+            regions[region] = {}
+            for district in sorted(self.places[region]):
+                places = sorted(self.places[region][district])
+                seen = Counter(place[0] for place in places)
+                numbers = Counter()
+                for place in places:
+                    if seen[place[0]] > 1:
+                        numbers[place[0]] += 1
+                        place[0] = f"{place[0]} ({numbers[place[0]]})"
+                regions[region][district] = places
+        return {'regions': regions}
+
+
+def write_json(path, data):
+    """Запись через временный файл: бот не прочитает наполовину записанный каталог"""
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(temp_path, path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Импорт каталога мест для прогулок из OSM или CSV")
+    parser.add_argument('extract', help="Выгрузка: .osm, .osm.gz, .osm.bz2, .osm.pbf или .csv")
+    parser.add_argument('-o', '--output', default='places.json', help="Файл каталога мест")
+    parser.add_argument('--regions', help="GeoJSON с границами регионов")
+    parser.add_argument('--districts', help="GeoJSON с границами районов")
+    parser.add_argument('--name-field', default='name', help="Свойство GeoJSON с названием")
+    parser.add_argument('--pois', help="Куда записать ветклиники и зоомагазины (формат POI_FILE)")
+    parser.add_argument('--delimiter', default=',', help="Разделитель CSV")
+    args = parser.parse_args()
+
+    is_csv = args.extract.endswith(('.csv', '.csv.gz', '.csv.bz2'))
+    if not is_csv and not (args.regions and args.districts):
+        parser.error("для выгрузки OSM нужны --regions и --districts")
+
+    started = time.perf_counter()
+    regions = Boundaries(args.regions, args.name_field) if args.regions else None
+    districts = Boundaries(args.districts, args.name_field) if args.districts else None
+    catalog = Catalog(regions, districts)
+    if is_csv:
+        features = read_csv(args.extract, args.delimiter)
+    elif args.extract.endswith('.pbf'):
+        features = read_osm_pbf(args.extract)
+    else:
+        features = read_osm_xml(args.extract)
+    for tags, point, kind in features:
+        catalog.add(tags, point, kind)
+
+    data = catalog.catalog()
+    write_json(args.output, data)
+    if args.pois:
+        write_json(args.pois, catalog.pois)
+
+    elapsed = time.perf_counter() - started
+    size = os.path.getsize(args.extract)
+    district_count = sum(len(districts) for districts in data['regions'].values())
+    place_count = sum(catalog.kinds[kind] for kind in PLACE_KINDS)
+    print()
+    print(f"Готово за {elapsed:.1f} с: {format_bytes(size)} выгрузки, {size / elapsed / 2 ** 20:.1f} МБ/с")
+    print(f"Мест в каталоге {args.output}: {place_count} в {len(data['regions'])} регионах и {district_count} районах")
+    print("По видам: " + ", ".join(f"{kind} {count}" for kind, count in catalog.kinds.most_common()))
+    if catalog.skipped:
+        print("Пропущено: " + ", ".join(f"{reason} {count}" for reason, count in catalog.skipped.most_common()))
+    if args.pois:
+        print(f"Ветклиник и зоомагазинов в {args.pois}: {len(catalog.pois)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,503 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный тест бота без Telegram
+
+Запускает поддельный Bot API (fake_bot_api.py), настоящий bot.py отдельным
+процессом и тысячи имитируемых пользователей, которые ходят по меню, ищут друг
+друга, отправляют и принимают запросы в друзья, подтверждают телефон и зовут
+друзей гулять. В конце печатает пропускную способность и задержки (от отправки
+обновления до ответа бота) по типам действий.
+
+Примеры:
+    python load_test.py --users 1000 --duration 60
+    python load_test.py --users 5000 --duration 120 --workers 4 --latency 0.05
+    python load_test.py --global-rate 30 --chat-rate 1   # Ограничения как у Telegram
+"""
+import os
+import re
+import json
+import sys
+import time
+import signal
+import resource
+import random
+import asyncio
+import argparse
+import tempfile
+from collections import Counter, defaultdict
+
+from fake_bot_api import FakeBotAPI, make_user, message_update, contact_update, callback_update, location_update, inline_query_update
+from bench import FIRST_NAMES, LAST_NAMES, USERNAME_WORDS
+from bot import get_callback_route
+
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bot.py')
+RESPONSE_TIMEOUT = 15  # Секунды ожидания ответа бота на действие
+# Методы, которыми бот показывает пользователю результат действия
+VISIBLE_METHODS = {'sendMessage', 'editMessageText', 'editMessageReplyMarkup', 'sendPhoto', 'sendDocument', 'answerInlineQuery'}
+# Кнопки, которые случайная прогулка по меню не нажимает (у них есть отдельные сценарии)
+BROWSE_EXCLUDED_PREFIXES = ('admin_', 'share_contact', 'invite_to_walk', 'add_friend_', 'accept_friend_')
+CODE_PATTERN = re.compile(r'Код подтверждения: (\d{4})')
+# Что пользователи ищут в inline-режиме ("@bot парк горь")
+INLINE_QUERIES = ("Парк Горького", "Сокольники", "Летний сад", "парк", "набережная", "сквер", "лесопарк")
+# Сценарии и их веса
+SCENARIOS = {
+    'browse': 45,
+    'search_and_add_friend': 20,
+    'accept_requests': 15,
+    'verify_phone': 8,
+    'set_location': 7,
+    'invite': 5,
+    'search_places': 5
+}
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+class LoadStats:
+    def __init__(self):
+        self.latencies = defaultdict(list)  # {действие: [секунды]}
+        self.timeouts = Counter()
+        self.started = None
+        self.finished = None
+
+    def record(self, action, latency):
+        if latency is None:
+            self.timeouts[action] += 1
+        else:
+            self.latencies[action].append(latency)
+
+    def report(self, api):
+        duration = self.finished - self.started
+        everything = sorted(value for values in self.latencies.values() for value in values)
+        completed = len(everything)
+        lines = [
+            f"Длительность: {duration:.1f} с, выполнено действий: {completed}, "
+            f"без ответа за {RESPONSE_TIMEOUT} с: {sum(self.timeouts.values())}",
+            f"Пропускная способность: {completed / duration:.1f} действий/с",
+            "",
+            f"{'действие':<32}{'кол-во':>8}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}  (мс)"
+        ]
+
+        def row(title, values):
+            values = sorted(values)
+            return (
+                f"{title:<32}{len(values):>8}" + "".join(
+                    f"{percentile(values, q) * 1000:>9.1f}" for q in (0.5, 0.9, 0.99)
+                ) + f"{(values[-1] if values else 0) * 1000:>9.1f}"
+            )
+
+        lines.append(row("ВСЕ", everything))
+        for action, values in sorted(self.latencies.items(), key=lambda item: -len(item[1])):
+            lines.append(row(action, values))
+        if self.timeouts:
+            lines.append("")
+            lines.append("Без ответа: " + ", ".join(f"{action} {count}" for action, count in self.timeouts.most_common()))
+        lines.append("")
+        lines.append("Вызовы Bot API: " + ", ".join(f"{method} {count}" for method, count in api.calls.most_common()))
+        if api.rate_limited:
+            lines.append("Ответы 429: " + ", ".join(f"{method} {count}" for method, count in api.rate_limited.most_common()))
+        return "\n".join(lines)
+
+
+class SimulatedUser:
+    """Пользователь, который ходит по меню бота"""
+
+    def __init__(self, harness, user_id, rng):
+        self.harness = harness
+        self.rng = rng
+        first_name = rng.choice(FIRST_NAMES)
+        last_name = rng.choice(LAST_NAMES)
+        username = f"{rng.choice(USERNAME_WORDS)}{user_id % 100000}" if rng.random() < 0.7 else None
+        self.user = make_user(user_id, first_name, last_name, username)
+        self.phone_number = f"79{rng.randint(0, 999_999_999):09d}"
+        self.screen = None  # Последнее сообщение бота с inline-кнопками
+        self.verification_code = None
+        self.inbox = asyncio.Queue()
+
+    @property
+    def user_id(self):
+        return self.user['id']
+
+    def buttons(self, prefix=''):
+        if not self.screen:
+            return []
+        return [
+            button['callback_data']
+            for row in self.screen['reply_markup']['inline_keyboard']
+            for button in row
+            if button.get('callback_data', '').startswith(prefix)
+        ]
+
+    def receive(self, method, params, result):
+        """Вызов бота, адресованный этому пользователю (вызывается из FakeBotAPI)"""
+        if isinstance(result, dict):
+            if result.get('reply_markup'):
+                self.screen = result
+            match = CODE_PATTERN.search(result.get('text') or '')
+            if match:
+                self.verification_code = match.group(1)
+        self.inbox.put_nowait((method, params))
+
+    async def act(self, action, update):
+        """Отправляет обновление и ждет видимого ответа бота. Возвращает False, если ответа нет"""
+        while not self.inbox.empty():
+            self.inbox.get_nowait()
+        started = time.perf_counter()
+        self.harness.api.push_update(update)
+        deadline = started + RESPONSE_TIMEOUT
+        while True:
+            try:
+                method, params = await asyncio.wait_for(self.inbox.get(), deadline - time.perf_counter())
+            except asyncio.TimeoutError:
+                self.harness.stats.record(action, None)
+                return False
+            # Ответ на нажатие без текста - это только снятие "часиков" с кнопки
+            if method in VISIBLE_METHODS or (method == 'answerCallbackQuery' and params.get('text')):
+                self.harness.stats.record(action, time.perf_counter() - started)
+                return True
+
+    async def send_text(self, action, text):
+        return await self.act(action, message_update(self.user, text))
+
+    async def click(self, prefix):
+        """Нажимает кнопку с callback_data, начинающимся с prefix. Возвращает False, если кнопки нет"""
+        candidates = self.buttons(prefix)
+        if not candidates:
+            return False
+        data = self.rng.choice(candidates)
+        return await self.act(f"callback:{get_callback_route(data)}", callback_update(self.user, self.screen, data))
+
+    async def open_main_menu(self):
+        if self.buttons('walk_with_friends') and self.buttons('profile'):
+            return True
+        if await self.click('main_menu'):
+            return True
+        return await self.send_text('command:/start', '/start')
+
+    async def think(self):
+        await asyncio.sleep(self.rng.expovariate(1 / self.harness.think_time))
+
+    async def browse(self):
+        for _ in range(self.rng.randint(2, 6)):
+            candidates = [data for data in self.buttons() if not data.startswith(BROWSE_EXCLUDED_PREFIXES)]
+            if not candidates:
+                await self.open_main_menu()
+                continue
+            data = self.rng.choice(candidates)
+            await self.act(f"callback:{get_callback_route(data)}", callback_update(self.user, self.screen, data))
+            await self.think()
+
+    async def search_and_add_friend(self):
+        if not (await self.open_main_menu() and await self.click('walk_with_friends') and await self.click('search_user')):
+            return
+        await self.think()
+        other = self.harness.random_started_user(self)
+        if other is None:
+            return
+        query = other.user.get('username') or other.user['first_name']
+        if not await self.send_text('text:search', query):
+            return
+        await self.think()
+        if await self.click('select_user_'):
+            await self.think()
+            await self.click('add_friend_')
+
+    async def accept_requests(self):
+        if await self.open_main_menu() and await self.click('walk_with_friends') and await self.click('friend_requests_incoming'):
+            await self.think()
+            await self.click('accept_friend_')
+
+    async def verify_phone(self):
+        if not (await self.open_main_menu() and await self.click('profile') and await self.click('share_contact')):
+            return
+        await self.think()
+        self.verification_code = None
+        await self.act('contact', contact_update(self.user, self.phone_number))
+        # Код приходит отдельным сообщением после удаления клавиатуры
+        for _ in range(20):
+            if self.verification_code:
+                break
+            await asyncio.sleep(0.1)
+        if self.verification_code:
+            await self.think()
+            await self.send_text('text:verification_code', self.verification_code)
+
+    async def set_location(self):
+        if await self.open_main_menu() and await self.click('profile') and await self.click('my_walking_location'):
+            await self.think()
+            await self.send_text('text:walking_location', self.rng.choice(["Парк Горького", "Сокольники", "Летний сад"]))
+
+    async def invite(self):
+        if await self.open_main_menu() and await self.click('walk_with_friends'):
+            await self.think()
+            await self.click('invite_to_walk')
+
+    async def search_places(self):
+        # Клиент Telegram отправляет inline-запрос по мере ввода текста
+        text = self.rng.choice(INLINE_QUERIES)
+        lengths = sorted(self.rng.sample(range(2, len(text) + 1), min(3, len(text) - 1)))
+        for length in lengths:
+            await self.act('inline_query', inline_query_update(self.user, text[:length]))
+
+    async def run(self):
+        await self.send_text('command:/start', '/start')
+        self.harness.started_users.append(self)
+        names = list(SCENARIOS)
+        weights = list(SCENARIOS.values())
+        while True:
+            await self.think()
+            await getattr(self, self.rng.choices(names, weights)[0])()
+
+
+class LiveWalker(SimulatedUser):
+    """Пользователь, который гуляет с живой геопозицией: новая позиция каждые --walker-interval секунд"""
+
+    def __init__(self, harness, user_id, rng, latitude, longitude):
+        super().__init__(harness, user_id, rng)
+        self.latitude = latitude
+        self.longitude = longitude
+
+    def receive(self, method, params, result):
+        if (params.get('text') or '').startswith('🐕 Друг рядом'):
+            self.harness.live_notifications += 1
+        super().receive(method, params, result)
+
+    async def run(self):
+        message_id = self.rng.randint(1, 2 ** 31)
+        await self.act('live:start', location_update(
+            self.user, self.latitude, self.longitude, live_period=3600, message_id=message_id
+        ))
+        interval = self.harness.args.walker_interval
+        while True:
+            await asyncio.sleep(interval * self.rng.uniform(0.8, 1.2))
+            # Несколько метров за шаг
+            self.latitude += self.rng.gauss(0, 0.00005)
+            self.longitude += self.rng.gauss(0, 0.00008)
+            self.harness.api.push_update(location_update(
+                self.user, self.latitude, self.longitude, live_period=3600, message_id=message_id, edited=True
+            ))
+            self.harness.live_positions += 1
+
+
+class BotProcess:
+    """bot.py в отдельном процессе, подключенный к поддельному Bot API"""
+
+    def __init__(self, api, workers=1, log_path=None, env=None):
+        self.api = api
+        self.workers = workers
+        self.log_path = log_path
+        self.env = env or {}
+        self.process = None
+
+    async def start(self, data_dir):
+        port = await self.api.start()
+        env = dict(
+            os.environ,
+            BOT_TOKEN='123456:load-test',
+            TELEGRAM_API_BASE_URL=f"http://127.0.0.1:{port}/bot",
+            DATA_FILE=os.path.join(data_dir, 'user_data.json'),
+            STATE_DB_FILE=os.path.join(data_dir, 'bot_state.sqlite3'),
+            BOT_WORKERS=str(self.workers),
+            BOT_MODE='polling',
+            METRICS_PORT='0',
+            LOG_LEVEL=os.environ.get('LOG_LEVEL', 'WARNING'),
+            PYTHONUNBUFFERED='1'
+        )
+        env.pop('ADMIN_ID', None)
+        env.pop('UPDATE_RECORD_FILE', None)
+        env.update(self.env)
+        self.log = open(self.log_path or os.path.join(data_dir, 'bot.log'), 'w')
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable, BOT_SCRIPT, env=env, stdout=self.log, stderr=self.log
+        )
+        try:
+            await asyncio.wait_for(self.api.polling.wait(), 60)
+        except asyncio.TimeoutError:
+            raise RuntimeError(f"Бот не начал опрос getUpdates за 60 с, см. {self.log.name}")
+
+    async def stop(self):
+        if self.process.returncode is None:
+            self.process.send_signal(signal.SIGINT)
+            try:
+                await asyncio.wait_for(self.process.wait(), 30)
+            except asyncio.TimeoutError:
+                self.process.kill()
+                await self.process.wait()
+        self.log.close()
+        await self.api.stop()
+        if self.process.returncode not in (0, None, -signal.SIGINT):
+            print(f"Бот завершился с кодом {self.process.returncode}")
+
+
+def print_cpu_usage():
+    # Если драйвер загружен сильнее бота, измеряется драйвер, а не бот
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    bot_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    print(
+        f"Процессорное время: бот {bot_usage.ru_utime + bot_usage.ru_stime:.1f} с, "
+        f"драйвер и поддельный API {own.ru_utime + own.ru_stime:.1f} с"
+    )
+
+
+class LoadHarness:
+    def __init__(self, args):
+        self.args = args
+        self.think_time = args.think
+        self.api = FakeBotAPI(args.latency, args.jitter, args.global_rate, args.chat_rate)
+        self.api.listeners.append(self.route_bot_call)
+        env = {}
+        if args.record:
+            # Запись обновлений для replay_updates.py
+            env = {'UPDATE_RECORD_FILE': os.path.abspath(args.record), 'UPDATE_RECORD_SECRET': 'load-test'}
+        self.bot = BotProcess(self.api, args.workers, args.bot_log, env)
+        self.stats = LoadStats()
+        self.users = {}
+        self.started_users = []
+        self._callback_owners = {}
+        self._rng = random.Random(args.seed)
+        self.live_positions = 0
+        self.live_notifications = 0
+
+    def route_bot_call(self, method, params, result):
+        chat_id = params.get('chat_id')
+        if method in ('answerCallbackQuery', 'answerInlineQuery'):
+            # ID нажатия и inline-запроса имеет вид "<user_id>-<случайное число>"
+            query_id = params.get('callback_query_id') or params.get('inline_query_id') or '0'
+            chat_id = int(str(query_id).split('-', 1)[0])
+        user = self.users.get(int(chat_id)) if chat_id is not None else None
+        if user is not None:
+            user.receive(method, params, result)
+
+    def random_started_user(self, exclude):
+        for _ in range(5):
+            if not self.started_users:
+                return None
+            other = self._rng.choice(self.started_users)
+            if other is not exclude:
+                return other
+        return None
+
+    async def start_bot(self, data_dir):
+        port = await self.api.start()
+        env = dict(
+            os.environ,
+            BOT_TOKEN='123456:load-test',
+            TELEGRAM_API_BASE_URL=f"http://127.0.0.1:{port}/bot",
+            DATA_FILE=os.path.join(data_dir, 'user_data.json'),
+            STATE_DB_FILE=os.path.join(data_dir, 'bot_state.sqlite3'),
+            BOT_WORKERS=str(self.args.workers),
+            BOT_MODE='polling',
+            METRICS_PORT='0',
+            LOG_LEVEL=os.environ.get('LOG_LEVEL', 'WARNING'),
+            PYTHONUNBUFFERED='1'
+        )
+        env.pop('ADMIN_ID', None)
+        self.bot_log = open(self.args.bot_log or os.path.join(data_dir, 'bot.log'), 'w')
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable, BOT_SCRIPT, env=env, stdout=self.bot_log, stderr=self.bot_log
+        )
+        try:
+            await asyncio.wait_for(self.api.polling.wait(), 60)
+        except asyncio.TimeoutError:
+            raise RuntimeError(f"Бот не начал опрос getUpdates за 60 с, см. {self.bot_log.name}")
+
+    async def stop_bot(self):
+        if self.process.returncode is None:
+            self.process.send_signal(signal.SIGINT)
+            try:
+                await asyncio.wait_for(self.process.wait(), 30)
+            except asyncio.TimeoutError:
+                self.process.kill()
+                await self.process.wait()
+        self.bot_log.close()
+        await self.api.stop()
+
+    def seed_walkers(self, data_dir):
+        """
+        Создает гуляющих пользователей в user_data.json бота
+
+        Гуляющие объединены в компании по 5 друзей, компания гуляет в радиусе
+        ~300 м, поэтому каждый должен получить уведомления о четырех друзьях.
+        """
+        walkers = []
+        users = {}
+        for index in range(self.args.walkers):
+            if index % 5 == 0:
+                center = (self._rng.uniform(55.6, 55.9), self._rng.uniform(37.4, 37.8))
+                group = [300_000_000 + index + offset for offset in range(min(5, self.args.walkers - index))]
+            user_id = 300_000_000 + index
+            walker = LiveWalker(
+                self, user_id, random.Random(self.args.seed + user_id),
+                center[0] + self._rng.uniform(-0.002, 0.002), center[1] + self._rng.uniform(-0.003, 0.003)
+            )
+            users[str(user_id)] = {
+                'first_name': walker.user['first_name'],
+                'username': walker.user.get('username'),
+                'walking_location': None,
+                'pet_photo_id': None,
+                'friends': [{'user_id': friend_id, 'name': 'Друг'} for friend_id in group if friend_id != user_id],
+                'phone_number': None,
+                'phone_verified': False
+            }
+            walkers.append(walker)
+        with open(os.path.join(data_dir, 'user_data.json'), 'w', encoding='utf-8') as f:
+            json.dump({'users': users, 'friend_requests': {}}, f, ensure_ascii=False)
+        return walkers
+
+    async def run(self):
+        with tempfile.TemporaryDirectory(prefix='bot-load-') as data_dir:
+            walkers = self.seed_walkers(data_dir) if self.args.walkers else []
+            await self.bot.start(data_dir)
+            print(f"Бот запущен, {self.args.users} пользователей, {len(walkers)} гуляющих, {self.args.duration:.0f} с...")
+            tasks = []
+            self.stats.started = time.perf_counter()
+            try:
+                for walker in walkers:
+                    self.users[walker.user_id] = walker
+                    tasks.append(asyncio.create_task(walker.run()))
+                ramp_delay = self.args.ramp / max(1, self.args.users)
+                for index in range(self.args.users):
+                    user = SimulatedUser(self, 200_000_000 + index, random.Random(self.args.seed + index))
+                    self.users[user.user_id] = user
+                    tasks.append(asyncio.create_task(user.run()))
+                    await asyncio.sleep(ramp_delay)
+                await asyncio.sleep(max(0.0, self.args.duration - (time.perf_counter() - self.stats.started)))
+            finally:
+                self.stats.finished = time.perf_counter()
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                await self.bot.stop()
+        print()
+        print(self.stats.report(self.api))
+        if self.args.walkers:
+            print(f"Живые геопозиции: {self.live_positions} позиций, уведомлений о друзьях рядом: {self.live_notifications}")
+        print_cpu_usage()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест bot.py на поддельном Bot API")
+    parser.add_argument('--users', type=int, default=1000, help="Число имитируемых пользователей")
+    parser.add_argument('--duration', type=float, default=60, help="Длительность теста, секунды")
+    parser.add_argument('--ramp', type=float, default=10, help="За сколько секунд подключаются все пользователи")
+    parser.add_argument('--think', type=float, default=2.0, help="Средняя пауза пользователя между действиями, секунды")
+    parser.add_argument('--walkers', type=int, default=0, help="Пользователи с живой геопозицией (\"Я гуляю сейчас\")")
+    parser.add_argument('--walker-interval', type=float, default=5.0, help="Секунды между позициями гуляющего")
+    parser.add_argument('--workers', type=int, default=1, help="BOT_WORKERS для бота")
+    parser.add_argument('--latency', type=float, default=0.0, help="Задержка ответов Bot API, секунды")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Случайная добавка к задержке, секунды")
+    parser.add_argument('--global-rate', type=float, default=0.0, help="Ограничение сообщений в секунду на бота")
+    parser.add_argument('--chat-rate', type=float, default=0.0, help="Ограничение сообщений в секунду в один чат")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--bot-log', help="Файл для вывода бота (по умолчанию во временном каталоге)")
+    parser.add_argument('--record', help="Записать обновления в файл для replay_updates.py")
+    args = parser.parse_args()
+    asyncio.run(LoadHarness(args).run())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+Воспроизведение записанных обновлений на поддельном Bot API
+
+Читает файл, записанный ботом с UPDATE_RECORD_FILE, и подает обновления настоящему
+bot.py (отдельный процесс, как в load_test.py) с исходными интервалами или быстрее.
+Так в бенчмарках повторяются реальные всплески: ответы на рассылку приглашений,
+вечерние прогулки. В конце печатаются задержки ответов бота по маршрутам.
+
+Бот стартует с пустыми данными или с копией --data-file. Пользователи из записи
+регистрируются по мере того, как присылают /start.
+
+Примеры:
+    UPDATE_RECORD_FILE=updates.jsonl.gz UPDATE_RECORD_SECRET=... python bot.py
+    python replay_updates.py updates.jsonl.gz                  # Исходная скорость
+    python replay_updates.py updates.jsonl.gz --speed 20       # В 20 раз быстрее
+    python replay_updates.py updates.jsonl.gz --speed 0        # Без пауз
+"""
+import os
+import sys
+import gzip
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import tempfile
+import itertools
+from collections import defaultdict, deque
+
+from fake_bot_api import FakeBotAPI
+from load_test import LoadStats, BotProcess, VISIBLE_METHODS, RESPONSE_TIMEOUT, print_cpu_usage
+from bot import get_callback_route
+
+
+def read_recorded_updates(path):
+    """Записи файла по порядку. Оборванный конец (бот остановлен аварийно) пропускается"""
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        try:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+        except (EOFError, gzip.BadGzipFile, ValueError) as e:
+            print(f"Запись оборвана: {e}", file=sys.stderr)
+
+
+def update_chat_id(update):
+    for key in ('callback_query', 'inline_query'):
+        if key in update:
+            return update[key]['from']['id']
+    message = update.get('message') or update.get('edited_message')
+    return message['chat']['id'] if message else None
+
+
+def update_route(update):
+    """Название действия для отчета"""
+    if 'callback_query' in update:
+        return get_callback_route(update['callback_query'].get('data') or '')
+    if 'inline_query' in update:
+        return 'inline_query'
+    message = update.get('message') or update.get('edited_message') or {}
+    prefix = 'edited ' if 'edited_message' in update else ''
+    text = message.get('text')
+    if text is not None:
+        return prefix + (text if text.startswith('/') else 'text')
+    for kind in ('contact', 'location', 'photo'):
+        if kind in message:
+            return prefix + kind
+    return prefix + 'other'
+
+
+class Replayer:
+    def __init__(self, args):
+        self.args = args
+        self.api = FakeBotAPI(args.latency, args.jitter, args.global_rate, args.chat_rate)
+        self.api.listeners.append(self.route_bot_call)
+        env = {'ADMIN_ID': str(args.admin_id)} if args.admin_id else {}
+        self.bot = BotProcess(self.api, args.workers, args.bot_log, env)
+        self.stats = LoadStats()
+        # Обновления, ожидающие ответа: {chat_id: deque[(маршрут, время отправки)]}.
+        # Обновления одного пользователя бот обрабатывает по очереди, поэтому первый
+        # видимый ответ в чат относится к самому старому из ожидающих.
+        self.waiting = defaultdict(deque)
+        self.replayed = 0
+        self.behind = 0.0  # Наибольшее отставание от расписания, секунды
+        self._query_ids = itertools.count(1)
+
+    def route_bot_call(self, method, params, result):
+        chat_id = params.get('chat_id')
+        if method in ('answerCallbackQuery', 'answerInlineQuery'):
+            # ID нажатия и inline-запроса подменяется на "<user_id>-<номер>", как в fake_bot_api.callback_update
+            query_id = params.get('callback_query_id') or params.get('inline_query_id') or '0'
+            chat_id = str(query_id).split('-', 1)[0]
+        elif method not in VISIBLE_METHODS:
+            return
+        try:
+            waiting = self.waiting.get(int(chat_id))
+        except (TypeError, ValueError):
+            return
+        if waiting:
+            route, sent = waiting.popleft()
+            self.stats.record(route, time.perf_counter() - sent)
+
+    def prepare(self, update):
+        """Копия записанного обновления с текущей датой и ID нажатия, по которому виден чат"""
+        update = json.loads(json.dumps(update))
+        now = int(time.time())
+        for key in ('message', 'edited_message'):
+            if key in update:
+                update[key]['date'] = now
+        for key in ('callback_query', 'inline_query'):
+            if key in update:
+                query = update[key]
+                query['id'] = f"{query['from']['id']}-{next(self._query_ids)}"
+        return update
+
+    def expire_waiting(self):
+        deadline = time.perf_counter() - RESPONSE_TIMEOUT
+        for waiting in self.waiting.values():
+            while waiting and waiting[0][1] < deadline:
+                route, _ = waiting.popleft()
+                self.stats.record(route, None)
+
+    async def feed(self):
+        previous_ts = None
+        schedule = time.perf_counter()
+        for index, record in enumerate(read_recorded_updates(self.args.file)):
+            if self.args.limit and index >= self.args.limit:
+                break
+            if previous_ts is not None and self.args.speed:
+                # Долгие паузы (ночь, простой) сокращаются до --max-gap
+                gap = min(max(0.0, record['ts'] - previous_ts), self.args.max_gap)
+                schedule += gap / self.args.speed
+                delay = schedule - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                else:
+                    self.behind = max(self.behind, -delay)
+            previous_ts = record['ts']
+
+            update = self.prepare(record['update'])
+            chat_id = update_chat_id(update)
+            if chat_id is not None:
+                self.waiting[chat_id].append((update_route(update), time.perf_counter()))
+            self.api.push_update(update)
+            self.replayed += 1
+            if self.replayed % 1000 == 0:
+                self.expire_waiting()
+
+    async def run(self):
+        with tempfile.TemporaryDirectory(prefix='bot-replay-') as data_dir:
+            if self.args.data_file:
+                shutil.copy(self.args.data_file, os.path.join(data_dir, 'user_data.json'))
+            await self.bot.start(data_dir)
+            speed = f"x{self.args.speed:g}" if self.args.speed else "без пауз"
+            print(f"Бот запущен, воспроизведение {self.args.file} ({speed})...")
+            self.stats.started = time.perf_counter()
+            try:
+                await self.feed()
+                # Ждем ответов на последние обновления
+                deadline = time.perf_counter() + RESPONSE_TIMEOUT
+                while any(self.waiting.values()) and time.perf_counter() < deadline:
+                    await asyncio.sleep(0.1)
+            finally:
+                self.stats.finished = time.perf_counter()
+                self.expire_waiting()
+                for waiting in self.waiting.values():
+                    for route, _ in waiting:
+                        self.stats.record(route, None)
+                await self.bot.stop()
+        print()
+        print(f"Воспроизведено обновлений: {self.replayed}, наибольшее отставание от расписания: {self.behind:.2f} с")
+        print(self.stats.report(self.api))
+        print_cpu_usage()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Воспроизведение записанных обновлений на поддельном Bot API")
+    parser.add_argument('file', help="Файл записи (UPDATE_RECORD_FILE)")
+    parser.add_argument('--speed', type=float, default=1.0, help="Ускорение относительно записи (0 - без пауз)")
+    parser.add_argument('--max-gap', type=float, default=60, help="Предел паузы между обновлениями в записи, секунды")
+    parser.add_argument('--limit', type=int, default=0, help="Воспроизвести только первые N обновлений")
+    parser.add_argument('--data-file', help="Начальный user_data.json для бота (копируется)")
+    parser.add_argument('--admin-id', type=int, help="ID администратора в записи (бот пишет его в лог при записи)")
+    parser.add_argument('--workers', type=int, default=1, help="BOT_WORKERS для бота")
+    parser.add_argument('--latency', type=float, default=0.0, help="Задержка ответов Bot API, секунды")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Случайная добавка к задержке, секунды")
+    parser.add_argument('--global-rate', type=float, default=0.0, help="Ограничение сообщений в секунду на бота")
+    parser.add_argument('--chat-rate', type=float, default=0.0, help="Ограничение сообщений в секунду в один чат")
+    parser.add_argument('--bot-log', help="Файл для вывода бота (по умолчанию во временном каталоге)")
+    args = parser.parse_args()
+    asyncio.run(Replayer(args).run())
+
+
+if __name__ == '__main__':
+    main()